@@ -0,0 +1,9 @@
+"""
+サンプル（sample0・sample1・sample2）で共有するモジュール
+
+LLMクライアントのレジストリ、再試行・サーキットブレーカー、レート制限、応答キャッシュ、
+コンテキストウィンドウ、メッセージレコード、ターンの計測、履歴の表示、偽のプロバイダ、
+起動時間のレポートをまとめる。各サンプルは `from llm_common.llm_registry import registry`
+のように読み込む（リポジトリのルートで `pip install -e .` するか、各サンプルの
+requirements.txtでインストールする）。
+"""
@@ -0,0 +1,96 @@
+"""
+トークン予算に基づいて送信する会話履歴の範囲を選択するコンテキストウィンドウ管理
+
+メッセージごとのトークン数は最初の1回だけ計算してレコードにキャッシュし、
+選択範囲は前回の結果から増分で更新するため、毎ターン全履歴を数え直すことはない。
+"""
+
+from typing import Any, Callable, Dict, List, Optional
+
+# メッセージごとのロールや区切りに使われるトークン数の目安
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算する
+
+    ASCII文字は約4文字で1トークン、日本語などの非ASCII文字は約1文字で1トークンとみなす。
+    非ASCII文字数はUTF-8のバイト長から求めるため、Pythonのループを回さずに計算できる。
+    """
+    n_chars = len(text)
+    n_non_ascii = (len(text.encode("utf-8")) - n_chars) // 2
+    return (n_chars - n_non_ascii) // 4 + n_non_ascii
+
+
+class ContextWindow:
+    """最新のメッセージから、トークン予算に収まる範囲を選択するクラス
+
+    select()は履歴の先頭側の開始位置を返す。前回以降に追加されたメッセージだけを数え、
+    予算を超えた分を古い方から外すため、1ターンあたりの計算量は追加・除外した件数にのみ比例する。
+    """
+
+    def __init__(self, counter: Callable[[str], int] = estimate_tokens):
+        """counterにはテキストのトークン数を返す関数を指定する"""
+        self.counter = counter
+        self._system_message: Optional[str] = None
+        self._system_tokens = 0
+        self.reset()
+
+    def reset(self):
+        """選択範囲を破棄する（履歴が編集された場合に呼び出す）"""
+        self.start = 0
+        self.end = 0
+        self.total = 0
+        self._last_source = None
+
+    def message_tokens(self, message: Dict[str, Any]) -> int:
+        """メッセージのトークン数を返す（初回のみ計算してレコードの"tokens"にキャッシュする）"""
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = self.counter(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            message["tokens"] = tokens
+        return tokens
+
+    def system_tokens(self, system_message: Optional[str]) -> int:
+        """システムメッセージのトークン数を返す（同じ文字列であれば再計算しない）"""
+        if not system_message:
+            return 0
+        if system_message is not self._system_message:
+            self._system_message = system_message
+            self._system_tokens = self.counter(system_message) + MESSAGE_OVERHEAD_TOKENS
+        return self._system_tokens
+
+    def select(self, messages: List[Dict[str, Any]], budget: int, system_message: Optional[str] = None) -> int:
+        """システムメッセージを含めて予算に収まる履歴の開始位置を返す
+
+        最新のメッセージは予算を超えても必ず含める。また、開始位置がユーザーの
+        メッセージになるように揃える。
+        """
+        # 前回選択した範囲が履歴の接頭辞でなくなっていれば作り直す
+        if len(messages) < self.end or (self.end and messages[self.end - 1] is not self._last_source):
+            self.reset()
+
+        # 前回以降に追加されたメッセージだけを数える
+        for message in messages[self.end:]:
+            self.total += self.message_tokens(message)
+        self.end = len(messages)
+        self._last_source = messages[-1] if messages else None
+
+        budget -= self.system_tokens(system_message)
+
+        # 予算を超えている間は古いメッセージから外す
+        while self.start < self.end - 1 and self.total > budget:
+            self.total -= self.message_tokens(messages[self.start])
+            self.start += 1
+
+        # 予算が増えた場合は古い方へ範囲を広げる
+        while self.start > 0 and self.total + self.message_tokens(messages[self.start - 1]) <= budget:
+            self.start -= 1
+            self.total += self.message_tokens(messages[self.start])
+
+        # 開始位置をユーザーのメッセージに揃える
+        while self.start < self.end - 1 and messages[self.start]["role"] != "human":
+            self.total -= self.message_tokens(messages[self.start])
+            self.start += 1
+
+        return self.start
@@ -0,0 +1,239 @@
+"""
+ネットワークに接続しない偽のLLMプロバイダ（テスト・ベンチマーク用）
+
+install()でレジストリのクライアント生成を差し替えると、すべてのプロバイダの
+クライアントがFakeChatModelになる。応答は最後のユーザーメッセージを元にした固定の文で、
+レイテンシと失敗（HTTPステータス付きの例外）をプロバイダごとに注入できる。
+
+    fake = install(registry, latency=0.05)
+    fake.fail("anthropic", rate=1.0)          # anthropicは常に503で失敗
+    fake.fail("openai", times=2, status_code=429)  # openaiは次の2回だけ429で失敗
+    fake.set_latency("google", 1.0, jitter=0.5)    # googleは1〜1.5秒かかる
+"""
+
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+import asyncio
+import random
+import threading
+import time
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+
+class FakeProviderError(Exception):
+    """偽のプロバイダが注入した失敗（status_codeでHTTPステータスを表す）"""
+
+    def __init__(self, provider: str, status_code: int = 503):
+        super().__init__(f"{provider}: 注入されたエラー (HTTP {status_code})")
+        self.provider = provider
+        self.status_code = status_code
+
+
+class FakeProvider:
+    """偽のクライアント全体で共有する設定（レイテンシ・失敗の注入・呼び出し回数）"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, chunk_delay: float = 0.0,
+                 chunk_words: int = 4, seed: Optional[int] = 0, tokens_per_second: Optional[float] = None,
+                 reply_words: int = 0):
+        """latency: 最初の応答までの秒数、jitter: latencyに加えるばらつきの上限、chunk_delay: チャンク間の秒数
+
+        tokens_per_secondを指定すると、1単語を1トークンとみなした生成速度からチャンク間の秒数を決める。
+        reply_wordsを指定すると応答をその単語数まで水増しする。seedを固定すると、
+        ばらつきと失敗の注入が実行ごとに同じになる。
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_words / tokens_per_second if tokens_per_second else chunk_delay
+        self.chunk_words = chunk_words
+        self.reply_words = reply_words
+        self._random = random.Random(seed)
+        self._failures: Dict[str, Dict[str, Any]] = {}
+        self._latencies: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        # 待ち時間として消費した秒数の合計（計測値からこれを引くとバックエンド側の時間になる）
+        self.simulated_seconds = 0.0
+
+    def fail(self, provider: str, rate: float = 1.0, times: Optional[int] = None,
+             status_code: int = 503, mid_stream: bool = False):
+        """プロバイダに失敗を注入する
+
+        rate: 失敗させる確率、times: 失敗させる回数の上限（Noneなら無制限）、
+        mid_stream: ストリーミングでは最初のチャンクを返した後に失敗させる
+        """
+        with self._lock:
+            self._failures[provider] = {
+                "rate": rate, "times": times, "status_code": status_code, "mid_stream": mid_stream,
+            }
+
+    def set_latency(self, provider: str, latency: float, jitter: float = 0.0):
+        """プロバイダごとに最初の応答までの秒数を変える"""
+        with self._lock:
+            self._latencies[provider] = (latency, jitter)
+
+    def heal(self, provider: Optional[str] = None):
+        """注入した失敗を取り消す（providerを省略するとすべて）"""
+        with self._lock:
+            if provider is None:
+                self._failures.clear()
+            else:
+                self._failures.pop(provider, None)
+
+    def next_failure(self, provider: str) -> Optional[Dict[str, Any]]:
+        """この呼び出しで失敗させる場合はその内容を返す（呼び出し回数も記録する）"""
+        with self._lock:
+            self.calls[provider] = self.calls.get(provider, 0) + 1
+            plan = self._failures.get(provider)
+            if plan is None or self._random.random() >= plan["rate"]:
+                return None
+            if plan["times"] is not None:
+                if plan["times"] <= 0:
+                    return None
+                plan["times"] -= 1
+            self.errors[provider] = self.errors.get(provider, 0) + 1
+            return plan
+
+    def delay(self, provider: str) -> float:
+        """最初の応答までの待ち時間"""
+        with self._lock:
+            latency, jitter = self._latencies.get(provider, (self.latency, self.jitter))
+            return self._account(latency + (self._random.uniform(0, jitter) if jitter else 0.0))
+
+    def _account(self, seconds: float) -> float:
+        self.simulated_seconds += seconds
+        return seconds
+
+    def account(self, seconds: float) -> float:
+        """待ち時間として消費する秒数を記録して返す"""
+        with self._lock:
+            return self._account(seconds)
+
+    def model(self, provider: str, model: str, temperature: float = 0.7, *_, **params) -> "FakeChatModel":
+        """レジストリから呼び出されるクライアント生成関数"""
+        return FakeChatModel(self, provider, model, temperature)
+
+
+def _last_human_text(messages: List) -> str:
+    """最後のユーザーメッセージの本文を取り出す"""
+    for message in reversed(messages):
+        if getattr(message, "type", None) == "human":
+            content = message.content
+            return content if isinstance(content, str) else " ".join(
+                block.get("text", "") for block in content if isinstance(block, dict)
+            )
+    return ""
+
+
+def _usage(messages: List, reply: str) -> Dict[str, int]:
+    """おおよそのトークン数を返す（履歴の長さに比例する処理を偽のプロバイダ側で行わないよう、件数から見積もる）"""
+    input_tokens = len(messages) * 16
+    output_tokens = len(reply) // 4 + 1
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+
+class FakeChatModel:
+    """LangChainのチャットモデルと同じ呼び出し方ができる偽のクライアント"""
+
+    def __init__(self, fake: FakeProvider, provider: str, model: str, temperature: float = 0.7):
+        self.fake = fake
+        self.provider = provider
+        self.model_name = model
+        self.temperature = temperature
+
+    def _reply(self, messages: List) -> str:
+        reply = f"[{self.model_name}] {_last_human_text(messages)} への回答です。"
+        padding = self.fake.reply_words - len(reply.split(" "))
+        return reply + " 回答" * padding if padding > 0 else reply
+
+    def _generation_time(self, reply: str) -> float:
+        """invokeでストリーミングと同じだけ時間がかかるよう、チャンク間の待ち時間の合計を返す"""
+        return (len(self._chunks(reply)) - 1) * self.fake.chunk_delay
+
+    def _chunks(self, reply: str) -> List[str]:
+        words = reply.split(" ")
+        size = self.fake.chunk_words
+        return [" ".join(words[i:i + size]) + (" " if i + size < len(words) else "")
+                for i in range(0, len(words), size)]
+
+    def _check(self, failure: Optional[Dict[str, Any]]):
+        if failure is not None:
+            raise FakeProviderError(self.provider, failure["status_code"])
+
+    def invoke(self, messages: List, *args, **kwargs) -> AIMessage:
+        failure = self.fake.next_failure(self.provider)
+        time.sleep(self.fake.delay(self.provider))
+        self._check(failure)
+        reply = self._reply(messages)
+        time.sleep(self.fake.account(self._generation_time(reply)))
+        return AIMessage(content=reply, usage_metadata=_usage(messages, reply))
+
+    async def ainvoke(self, messages: List, *args, **kwargs) -> AIMessage:
+        failure = self.fake.next_failure(self.provider)
+        await asyncio.sleep(self.fake.delay(self.provider))
+        self._check(failure)
+        reply = self._reply(messages)
+        await asyncio.sleep(self.fake.account(self._generation_time(reply)))
+        return AIMessage(content=reply, usage_metadata=_usage(messages, reply))
+
+    def batch(self, inputs: List[List], config=None, *, return_exceptions: bool = False, **kwargs) -> List:
+        """LangChainと同じく、return_exceptionsがTrueなら失敗した入力の位置に例外を返す"""
+        results = []
+        for messages in inputs:
+            try:
+                results.append(self.invoke(messages))
+            except FakeProviderError as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    async def abatch(self, inputs: List[List], config=None, *, return_exceptions: bool = False, **kwargs) -> List:
+        """LangChainと同じく、configのmax_concurrencyで同時に処理する入力の数を制限する"""
+        semaphore = asyncio.Semaphore((config or {}).get("max_concurrency") or len(inputs) or 1)
+
+        async def one(messages):
+            async with semaphore:
+                return await self.ainvoke(messages)
+
+        return list(await asyncio.gather(*(one(messages) for messages in inputs), return_exceptions=return_exceptions))
+
+    def stream(self, messages: List, *args, **kwargs) -> Iterator[AIMessageChunk]:
+        failure = self.fake.next_failure(self.provider)
+        time.sleep(self.fake.delay(self.provider))
+        if failure is not None and not failure["mid_stream"]:
+            self._check(failure)
+        reply = self._reply(messages)
+        for i, text in enumerate(self._chunks(reply)):
+            if i:
+                if failure is not None:
+                    self._check(failure)
+                time.sleep(self.fake.account(self.fake.chunk_delay))
+            yield AIMessageChunk(content=text)
+        yield AIMessageChunk(content="", usage_metadata=_usage(messages, reply))
+
+    async def astream(self, messages: List, *args, **kwargs) -> AsyncIterator[AIMessageChunk]:
+        failure = self.fake.next_failure(self.provider)
+        await asyncio.sleep(self.fake.delay(self.provider))
+        if failure is not None and not failure["mid_stream"]:
+            self._check(failure)
+        reply = self._reply(messages)
+        for i, text in enumerate(self._chunks(reply)):
+            if i:
+                if failure is not None:
+                    self._check(failure)
+                await asyncio.sleep(self.fake.account(self.fake.chunk_delay))
+            yield AIMessageChunk(content=text)
+        yield AIMessageChunk(content="", usage_metadata=_usage(messages, reply))
+
+
+def install(registry, fake: Optional[FakeProvider] = None, **config) -> FakeProvider:
+    """レジストリのクライアント生成を偽のプロバイダに差し替える（configはFakeProviderの引数）"""
+    fake = fake or FakeProvider(**config)
+    registry.set_override(fake.model)
+    return fake
+
+
+def uninstall(registry):
+    """差し替えを元に戻す"""
+    registry.set_override(None)
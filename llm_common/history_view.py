@@ -0,0 +1,63 @@
+"""
+チャット履歴の表示（直近のメッセージだけを描画し、古いメッセージは「以前のメッセージを読み込む」で追加表示する）
+
+Streamlitは再実行のたびに表示するすべての要素を作り直すため、長いセッションでは
+履歴の描画が再実行の時間の大半を占める。ここでは描画するメッセージ数を一定に保ち、
+表示用に整えたMarkdownを本文ごとにキャッシュする。
+Streamlitはrender_historyを呼び出した時点で読み込む（llm_commonのオプション依存 ui。
+pip install -e "..[ui]" で入る）。
+"""
+
+from functools import lru_cache
+from typing import Any, Callable, Mapping, Sequence
+
+# 最初に表示するメッセージ数（「以前のメッセージを読み込む」を押すごとにこの数だけ増やす）
+HISTORY_PAGE_SIZE = 20
+
+# サイドバーなどのプレビューの最大文字数
+PREVIEW_LENGTH = 40
+
+
+def window_start(total: int, shown: int) -> int:
+    """total件のうち最新のshown件を表示する場合の、最初に表示するメッセージの位置"""
+    return max(0, total - shown)
+
+
+@lru_cache(maxsize=1024)
+def to_display_markdown(content: str) -> str:
+    """表示用のMarkdownに整える（中断されたストリームなどで閉じられていないコードブロックを閉じる）
+
+    文字列のハッシュはPythonがキャッシュするため、同じ本文の2回目以降の呼び出しは長さによらず定数時間。
+    """
+    if content.count("```") % 2:
+        return content + "\n```"
+    return content
+
+
+@lru_cache(maxsize=1024)
+def preview(content: str, length: int = PREVIEW_LENGTH) -> str:
+    """改行と連続する空白をまとめた先頭length文字（超える場合は末尾を…にする）"""
+    text = " ".join(content[:length * 4].split())
+    return text if len(text) <= length else text[:length - 1] + "…"
+
+
+def render_history(messages: Sequence[Mapping[str, Any]], key: str,
+                   render_message: Callable[[Mapping[str, Any]], None], page_size: int = HISTORY_PAGE_SIZE):
+    """messagesの最新のメッセージだけをrender_messageで描画する
+
+    表示件数はkeyごと（セッションごと）にst.session_stateで保持する。st.fragmentの中で呼び出すと、
+    「以前のメッセージを読み込む」はそのフラグメントだけを再実行する。
+    """
+    import streamlit as st
+    state_key = f"history_shown_{key}"
+    shown = st.session_state.get(state_key, page_size)
+    start = window_start(len(messages), shown)
+    if start > 0:
+        # コールバックで表示件数を増やす（ボタンによる再実行の前に反映されるので、再実行を追加しない）
+        st.button(
+            f"以前のメッセージを読み込む（残り {start} 件）",
+            key=f"load_earlier_{key}",
+            on_click=lambda: st.session_state.update({state_key: shown + page_size}),
+        )
+    for index in range(start, len(messages)):
+        render_message(messages[index])
@@ -0,0 +1,101 @@
+"""
+起動時間のレポート（python -X importtime の結果をパッケージごとに集計する）
+
+別プロセスでモジュールを読み込み、読み込みにかかった時間をトップレベルの
+パッケージごとに合計して、時間のかかった順に表示する。プロバイダのSDK
+（langchain_openai・langchain_anthropic・langchain_google_genai）が
+読み込まれたかどうかも表示する。
+
+計測は現在のディレクトリで行うため、各サンプルのディレクトリで実行する。
+
+使い方:
+    cd sample0
+    python -m llm_common.importtime_report                      # backendの読み込み
+    python -m llm_common.importtime_report chat_graph --top 15   # sample1
+    python -m llm_common.importtime_report --code "import backend; backend.registry.get('google', 'gemini-2.0-flash')"
+    python -m llm_common.importtime_report --runs 5 --json
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# 読み込まれたかを確認するプロバイダのパッケージ
+PROVIDER_PACKAGES = ("langchain_openai", "langchain_anthropic", "langchain_google_genai", "openai", "anthropic")
+
+# -X importtime の1行（self [us] | cumulative | imported package）
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def measure(code: str) -> List[Tuple[str, int, int, int]]:
+    """codeを別プロセスで実行し、(モジュール名, 入れ子の深さ, 自身の時間, 累積時間) のリストを返す（マイクロ秒）
+
+    子プロセスは現在のディレクトリで実行し、サンプルのモジュールとllm_commonの両方を読み込めるようにする。
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")]))}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.getcwd(),
+        env=env,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "実行に失敗しました")
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, (len(indent) - 1) // 2, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def summarize(entries: List[Tuple[str, int, int, int]]) -> Dict:
+    """トップレベルのパッケージごとに自身の時間を合計する"""
+    packages: Dict[str, int] = {}
+    for name, _, self_us, _ in entries:
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0) + self_us
+    loaded = {name for name, _, _, _ in entries}
+    return {
+        "total_ms": round(sum(self_us for _, _, self_us, _ in entries) / 1000, 1),
+        "modules": len(entries),
+        "packages_ms": {
+            root: round(us / 1000, 1) for root, us in sorted(packages.items(), key=lambda item: -item[1])
+        },
+        "providers_loaded": [package for package in PROVIDER_PACKAGES if package in loaded],
+    }
+
+
+def report(code: str, runs: int = 3) -> Dict:
+    """runs回計測し、合計時間が最も短かった回を返す（ディスクキャッシュの影響を抑えるため）"""
+    results = [summarize(measure(code)) for _ in range(runs)]
+    best = min(results, key=lambda result: result["total_ms"])
+    best["runs_total_ms"] = [result["total_ms"] for result in results]
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="-X importtimeによる起動時間のレポート")
+    parser.add_argument("module", nargs="?", default="backend", help="読み込むモジュール（既定: backend）")
+    parser.add_argument("--code", help="モジュールの読み込みの代わりに実行するコード")
+    parser.add_argument("--runs", type=int, default=3, help="計測回数（最も短い回を表示する）")
+    parser.add_argument("--top", type=int, default=10, help="表示するパッケージ数")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args()
+
+    code = args.code or f"import {args.module}"
+    result = report(code, args.runs)
+    result["code"] = code
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"{code}: {result['total_ms']} ms（{result['modules']} モジュール、各回 {result['runs_total_ms']}）")
+        for root, ms in list(result["packages_ms"].items())[:args.top]:
+            print(f"  {ms:>9.1f} ms  {root}")
+        print(f"読み込まれたプロバイダのSDK: {', '.join(result['providers_loaded']) or 'なし'}")
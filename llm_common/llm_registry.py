@@ -0,0 +1,223 @@
+"""
+プロセス全体で共有するLLMクライアントのレジストリ
+
+(provider, model, temperature, その他パラメータ) をキーとして
+長寿命のクライアントを保持し、ターンごとのクライアント生成や
+TLSハンドシェイクのやり直しを避ける。
+
+プロバイダのSDK（langchain_openaiなど）は読み込みに時間がかかるため、
+そのプロバイダのクライアントを初めて生成する時点で読み込む。
+"""
+
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+import asyncio
+import threading
+
+import httpx
+
+# keep-alive接続プールの設定（全クライアントで共有）
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+
+def _build_openai(model: str, temperature: float, pool: "HTTPPool", **params):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        http_client=pool.sync_client(),
+        http_async_client=pool.async_client(),
+        **params,
+    )
+
+
+def _build_google(model: str, temperature: float, pool: "HTTPPool", **params):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    # Geminiクライアントは内部のチャネルを保持するため、インスタンスの再利用で接続が使い回される
+    return ChatGoogleGenerativeAI(model=model, temperature=temperature, **params)
+
+
+def _build_anthropic(model: str, temperature: float, pool: "HTTPPool", **params):
+    from langchain_anthropic import ChatAnthropic
+    # ChatAnthropicは内部のSDKクライアントをキャッシュするため、インスタンスの再利用で接続が使い回される
+    return ChatAnthropic(model=model, temperature=temperature, **params)
+
+
+# プロバイダ名 -> クライアント生成関数（SDKは各関数の中で読み込む）
+PROVIDER_FACTORIES: Dict[str, Callable[..., Any]] = {
+    "openai": _build_openai,
+    "google": _build_google,
+    "anthropic": _build_anthropic,
+}
+
+
+class HTTPPool:
+    """keep-alive接続を共有するhttpxクライアントを遅延生成して保持するクラス"""
+
+    def __init__(self, limits: httpx.Limits = HTTP_LIMITS, timeout: httpx.Timeout = HTTP_TIMEOUT):
+        self.limits = limits
+        self.timeout = timeout
+        self._sync_client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def sync_client(self) -> httpx.Client:
+        """同期用のhttpxクライアントを取得する"""
+        with self._lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(limits=self.limits, timeout=self.timeout)
+            return self._sync_client
+
+    def async_client(self) -> httpx.AsyncClient:
+        """非同期用のhttpxクライアントを取得する"""
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            return self._async_client
+
+    def _take(self) -> Tuple[Optional[httpx.Client], Optional[httpx.AsyncClient]]:
+        """保持しているクライアントを手放して返す"""
+        with self._lock:
+            clients = (self._sync_client, self._async_client)
+            self._sync_client = None
+            self._async_client = None
+            return clients
+
+    def close(self):
+        """両方のクライアントを閉じる
+
+        イベントループの中から呼ばれた場合、非同期クライアントはそのループのタスクとして閉じる。
+        """
+        sync_client, async_client = self._take()
+        if sync_client is not None:
+            sync_client.close()
+        if async_client is not None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(async_client.aclose())
+            else:
+                task = loop.create_task(async_client.aclose())
+                _closing_tasks.add(task)
+                task.add_done_callback(_closing_tasks.discard)
+
+    async def aclose(self):
+        """両方のクライアントを閉じる（非同期クライアントは閉じ終わるまで待つ）"""
+        sync_client, async_client = self._take()
+        if sync_client is not None:
+            sync_client.close()
+        if async_client is not None:
+            await async_client.aclose()
+
+
+# 閉じている途中の非同期クライアントのタスク（完了前にガベージコレクションされないよう保持する）
+_closing_tasks: Set[asyncio.Task] = set()
+
+
+class LLMRegistry:
+    """LLMクライアントをキー単位で共有するスレッドセーフなレジストリ
+
+    クライアントの生成（SDKの読み込みを含む）はレジストリ全体のロックの外で、キーごとのロックを
+    取って1回だけ行う。あるプロバイダの初回の生成中も、他のキーの取得やキャッシュのヒットは待たされない。
+    """
+
+    def __init__(self):
+        """レジストリの初期化"""
+        self._clients: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+        # 生成中のキーのロック（同じキーの同時の取得は、最初の1つの生成を待つ）
+        self._building: Dict[Tuple, threading.Lock] = {}
+        # set_override・reset・configure_poolのたびに増やし、それ以前に始まった生成の結果は登録しない
+        self._generation = 0
+        self._pool = HTTPPool()
+        self._override: Optional[Callable[..., Any]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def set_override(self, factory: Optional[Callable[..., Any]]):
+        """全プロバイダのクライアント生成を差し替える（テスト・ベンチマーク用。Noneで元に戻す）
+
+        factoryは (provider, model, temperature, **params) を受け取ってクライアントを返す関数。
+        登録済みのクライアントは破棄する。
+        """
+        with self._lock:
+            self._override = factory
+            self._clients.clear()
+            self._generation += 1
+
+    @staticmethod
+    def make_key(provider: str, model: str, temperature: float, **params) -> Tuple:
+        """レジストリのキーを作成する"""
+        return (provider, model, float(temperature), tuple(sorted(params.items())))
+
+    def get(self, provider: str, model: str, temperature: float = 0.7, **params):
+        """クライアントを取得する（なければ生成して登録する）"""
+        if provider not in PROVIDER_FACTORIES:
+            raise ValueError(f"不明なプロバイダ: {provider}")
+        key = self.make_key(provider, model, temperature, **params)
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.hits += 1
+                return client
+            building = self._building.setdefault(key, threading.Lock())
+
+        with building:
+            with self._lock:
+                # 待っている間に他のスレッドが生成していればそれを使う
+                client = self._clients.get(key)
+                if client is not None:
+                    self.hits += 1
+                    return client
+                self.misses += 1
+                generation, override, pool = self._generation, self._override, self._pool
+
+            if override is not None:
+                client = override(provider, model, temperature, **params)
+            else:
+                client = PROVIDER_FACTORIES[provider](model, temperature, pool, **params)
+
+            with self._lock:
+                if self._generation == generation:
+                    self._clients[key] = client
+                if self._building.get(key) is building:
+                    del self._building[key]
+            return client
+
+    def configure_pool(self, max_connections: int, max_keepalive_connections: Optional[int] = None):
+        """共有する接続プールの上限を変更する（登録済みのクライアントは破棄し、次の取得時に新しいプールで作り直す）"""
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections or max_connections,
+            keepalive_expiry=HTTP_LIMITS.keepalive_expiry,
+        )
+        self._replace_pool(HTTPPool(limits=limits)).close()
+
+    def _replace_pool(self, pool: HTTPPool) -> HTTPPool:
+        """登録済みのクライアントを破棄して接続プールを差し替え、古いプールを返す（閉じるのは呼び出し側）"""
+        with self._lock:
+            self._clients.clear()
+            self._generation += 1
+            old_pool, self._pool = self._pool, pool
+            return old_pool
+
+    def reset(self):
+        """登録済みのクライアントと統計を破棄する"""
+        self._replace_pool(HTTPPool()).close()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    async def aclose(self):
+        """登録済みのクライアントを破棄し、接続プールを閉じ終わるまで待つ（ASGIサーバーの終了時など）"""
+        await self._replace_pool(HTTPPool()).aclose()
+
+    def stats(self) -> Dict[str, int]:
+        """ヒット数・ミス数・保持しているクライアント数を返す"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "clients": len(self._clients)}
+
+
+# プロセス全体で共有するレジストリ
+registry = LLMRegistry()
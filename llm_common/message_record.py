@@ -0,0 +1,62 @@
+"""
+会話履歴の1メッセージを表すコンパクトなレコード
+
+`__slots__` でインスタンス辞書を持たず、ロール名とモデル名は intern して
+全メッセージで同じ文字列オブジェクトを共有する。作成日時はdatetimeではなく
+UNIX時刻（float）で保持する。従来の `{"role": ..., "content": ..., "model": ...}`
+形式の辞書と同じように `message["role"]` や `message.get("model")` で参照できる。
+"""
+
+from collections.abc import Mapping
+from typing import Any, Dict, Optional
+import sys
+import time
+
+# 辞書として参照できるキー（値がNoneのキーは存在しないものとして扱う）
+FIELDS = ("role", "content", "model", "created_at", "tokens")
+
+
+class MessageRecord(Mapping):
+    """メッセージ1件分のレコード（読み取りは辞書互換）"""
+
+    __slots__ = FIELDS
+
+    def __init__(self, role: str, content: str, model: Optional[str] = None,
+                 created_at: Optional[float] = None, tokens: Optional[int] = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.model = sys.intern(model) if model else None
+        self.created_at = time.time() if created_at is None else created_at
+        self.tokens = tokens
+
+    @classmethod
+    def from_dict(cls, message: Dict[str, Any]) -> "MessageRecord":
+        """辞書形式のメッセージからレコードを作成する"""
+        return cls(message["role"], message["content"], message.get("model"),
+                   message.get("created_at"), message.get("tokens"))
+
+    def __getitem__(self, key: str) -> Any:
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        """キャッシュ用の値（tokensなど）を辞書と同じ書き方で設定する"""
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return (key for key in FIELDS if getattr(self, key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.to_dict()!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """辞書形式に変換する（JSONなどへの書き出し用）"""
+        return {key: getattr(self, key) for key in self}
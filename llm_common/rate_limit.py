@@ -0,0 +1,327 @@
+"""
+プロバイダごとのレート制限（トークンバケット）と公平な受付キュー
+
+- プロバイダごとに「リクエスト数/分」と「トークン数/分」の2つのバケットを持ち、
+  両方に余裕がある場合だけ問い合わせを通す。トークン数はプロンプトの大きさと
+  出力の見込みから見積もり、応答後に実際の使用量との差を精算する
+- 待っているリクエストはセッションごとのキューに並べ、セッションを順番に回して通す
+  （1つのセッションが大量に送っても、他のセッションが待たされ続けない）
+- 期限までに通せない見込みのリクエストはAdmissionTimeoutErrorで断る
+- プロセス内のすべてのセッション（スレッド・イベントループ）で共有する
+- 上限はアカウントの契約によって異なるため、設定したプロバイダだけを制限する
+  （configure・configure_from_spec、各アプリでは環境変数LLM_RATE_LIMITS。設定しなければ制限しない）
+"""
+
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+import asyncio
+import threading
+import time
+
+# 出力トークン数の見込み（応答後に実際の使用量で精算する）
+EXPECTED_OUTPUT_TOKENS = 512
+
+# プロバイダ -> (リクエスト数/分, トークン数/分) の既定値（既定では制限しない）
+DEFAULT_LIMITS: Dict[str, tuple] = {}
+
+
+class AdmissionTimeoutError(Exception):
+    """期限までにレート制限の枠を確保できなかったことを表す例外"""
+
+    def __init__(self, provider: str, waited: float):
+        super().__init__(f"{provider} のレート制限の待ちが期限を超えました（{waited:.1f}秒待機）")
+        self.provider = provider
+        self.waited = waited
+
+
+class TokenBucket:
+    """1分あたりの量で補充されるトークンバケット（ロックは呼び出し側で取る）"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None, now: float = 0.0):
+        """capacityを省略すると1分ぶんまでの一時的な集中を許す"""
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amountを取り出せるまでの秒数（容量を超える量は容量まで切り詰める）"""
+        self._refill(now)
+        deficit = min(amount, self.capacity) - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def take(self, amount: float):
+        """amountを取り出す（wait_timeが0であることを確認してから呼び出す）"""
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, delta: float):
+        """見積もりとの差を精算する（正なら追加で消費し、負なら返却する）"""
+        self.level = min(self.capacity, self.level - delta)
+
+
+class Grant(NamedTuple):
+    """受け付けたリクエスト（精算に使う）"""
+    provider: str
+    tokens: int
+    waited: float
+
+
+class _Waiter:
+    """受付キューで待っているリクエスト"""
+
+    __slots__ = ("session_id", "tokens", "enqueued_at", "deadline")
+
+    def __init__(self, session_id: str, tokens: int, enqueued_at: float, deadline: float):
+        self.session_id = session_id
+        self.tokens = tokens
+        self.enqueued_at = enqueued_at
+        self.deadline = deadline
+
+
+class ProviderLimiter:
+    """1プロバイダ分のレート制限と受付キュー"""
+
+    def __init__(self, provider: str, requests_per_minute: float, tokens_per_minute: float,
+                 clock=time.monotonic, wait_window: int = 1024):
+        self.provider = provider
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._clock = clock
+        now = clock()
+        self._requests = TokenBucket(requests_per_minute, now=now)
+        self._tokens = TokenBucket(tokens_per_minute, now=now)
+        self._cond = threading.Condition()
+        # 非同期版で待っているタスクを起こすためのフューチャー（イベントループ, フューチャー）
+        self._wakeups: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        # セッションID -> そのセッションの待ち行列（先頭のセッションから順に通す）
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._depth = 0
+        self._waits: Deque[float] = deque(maxlen=wait_window)
+        self.admitted = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+
+    def _enqueue(self, session_id: str, tokens: int, timeout: float) -> _Waiter:
+        now = self._clock()
+        waiter = _Waiter(session_id, tokens, now, now + timeout)
+        self._queues.setdefault(session_id, deque()).append(waiter)
+        self._depth += 1
+        return waiter
+
+    def _remove(self, waiter: _Waiter, rotate: bool = False):
+        """キューから取り除く（rotate=Trueなら、そのセッションを最後尾に回す）"""
+        queue = self._queues[waiter.session_id]
+        queue.remove(waiter)
+        self._depth -= 1
+        if not queue:
+            del self._queues[waiter.session_id]
+        elif rotate:
+            self._queues.move_to_end(waiter.session_id)
+        self._notify()
+
+    def _notify(self):
+        """待っているスレッドと非同期のタスクを起こす（self._condを取った状態で呼び出す）"""
+        self._cond.notify_all()
+        for loop, wakeup in self._wakeups:
+            try:
+                loop.call_soon_threadsafe(_wake, wakeup)
+            except RuntimeError:
+                # イベントループが既に閉じている
+                pass
+        self._wakeups.clear()
+
+    def _poll(self, waiter: _Waiter) -> Optional[float]:
+        """順番が来ていて枠があれば受け付けてNoneを返し、そうでなければ待つ秒数を返す"""
+        now = self._clock()
+        head = self._queues[next(iter(self._queues))][0]
+        if waiter is not head:
+            if now >= waiter.deadline:
+                self._reject(waiter, now)
+            return waiter.deadline - now
+
+        wait = max(self._requests.wait_time(1, now), self._tokens.wait_time(waiter.tokens, now))
+        if wait <= 0:
+            self._requests.take(1)
+            self._tokens.take(waiter.tokens)
+            self._remove(waiter, rotate=True)
+            waited = now - waiter.enqueued_at
+            self._waits.append(waited)
+            self.admitted += 1
+            self.max_wait = max(self.max_wait, waited)
+            return None
+        # 期限までに枠が空かない見込みであれば、待たずに断る
+        if now + wait > waiter.deadline:
+            self._reject(waiter, now)
+        return wait
+
+    def _reject(self, waiter: _Waiter, now: float):
+        self._remove(waiter)
+        self.rejected += 1
+        raise AdmissionTimeoutError(self.provider, now - waiter.enqueued_at)
+
+    def acquire(self, session_id: str, tokens: int, timeout: float = 30.0) -> Grant:
+        """枠が確保できるまで待つ（timeout秒以内に確保できない見込みならAdmissionTimeoutError）"""
+        with self._cond:
+            waiter = self._enqueue(session_id, tokens, timeout)
+            while True:
+                wait = self._poll(waiter)
+                if wait is None:
+                    return Grant(self.provider, tokens, self._waits[-1])
+                self._cond.wait(wait)
+
+    async def aacquire(self, session_id: str, tokens: int, timeout: float = 30.0) -> Grant:
+        """acquireの非同期版（イベントループを止めずに待つ）
+
+        順番が回ってくるか枠が空く見込みの時刻まで、フューチャーで待つ（他のリクエストの受付や
+        精算があれば、その時点で起こされて確認し直す）。
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            waiter = self._enqueue(session_id, tokens, timeout)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._poll(waiter)
+                    if wait is None:
+                        return Grant(self.provider, tokens, self._waits[-1])
+                    wakeup = loop.create_future()
+                    self._wakeups.append((loop, wakeup))
+                try:
+                    await asyncio.wait([wakeup], timeout=wait)
+                finally:
+                    with self._cond:
+                        if (loop, wakeup) in self._wakeups:
+                            self._wakeups.remove((loop, wakeup))
+        except asyncio.CancelledError:
+            with self._cond:
+                if waiter in self._queues.get(waiter.session_id, ()):
+                    self._remove(waiter)
+            raise
+
+    def settle(self, grant: Grant, actual_tokens: Optional[int]):
+        """試行を終えた枠を精算する
+
+        actual_tokensには実際の使用量を指定し、見積もったトークン数との差を精算する。
+        応答を受け取る前に失敗・中断した試行は0を指定して見積もりをすべて返す。
+        使用量が分からない場合はNoneを指定し、見積もりのまま消費したものとする。
+        """
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self._tokens.adjust(actual_tokens - grant.tokens)
+            self._notify()
+
+    def stats(self) -> Dict[str, Any]:
+        """キューの長さ・受付数・拒否数・待ち時間（ミリ秒）と、バケットの残量を返す"""
+        with self._cond:
+            now = self._clock()
+            waits = sorted(self._waits)
+            self._requests.wait_time(0, now)
+            self._tokens.wait_time(0, now)
+
+            def percentile(p):
+                return round(waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000, 1) if waits else 0.0
+
+            return {
+                "queue_depth": self._depth,
+                "waiting_sessions": len(self._queues),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "wait_ms_p50": percentile(50),
+                "wait_ms_p95": percentile(95),
+                "wait_ms_max": round(self.max_wait * 1000, 1),
+                "requests_available": int(self._requests.level),
+                "tokens_available": int(self._tokens.level),
+            }
+
+
+def _wake(wakeup: asyncio.Future):
+    if not wakeup.done():
+        wakeup.set_result(None)
+
+
+class UnlimitedLimiter:
+    """上限を設定していないプロバイダのリミッタ（待たずに通し、受付数だけを数える）"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._lock = threading.Lock()
+        self.admitted = 0
+
+    def acquire(self, session_id: str, tokens: int, timeout: float = 30.0) -> Grant:
+        with self._lock:
+            self.admitted += 1
+        return Grant(self.provider, tokens, 0.0)
+
+    async def aacquire(self, session_id: str, tokens: int, timeout: float = 30.0) -> Grant:
+        return self.acquire(session_id, tokens, timeout)
+
+    def settle(self, grant: Grant, actual_tokens: Optional[int]):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """ProviderLimiter.statsと同じ形式（待ちや拒否は常に0）"""
+        with self._lock:
+            admitted = self.admitted
+        return {
+            "queue_depth": 0,
+            "waiting_sessions": 0,
+            "admitted": admitted,
+            "rejected": 0,
+            "wait_ms_p50": 0.0,
+            "wait_ms_p95": 0.0,
+            "wait_ms_max": 0.0,
+            "requests_available": None,
+            "tokens_available": None,
+        }
+
+
+class RateLimiters:
+    """プロバイダ名ごとにProviderLimiterを保持するスレッドセーフなレジストリ"""
+
+    def __init__(self, limits: Optional[Dict[str, tuple]] = None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self._limiters: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, provider: str, requests_per_minute: float, tokens_per_minute: float):
+        """プロバイダの上限を設定する（待っているリクエストがない時に呼び出す）"""
+        with self._lock:
+            self.limits[provider] = (requests_per_minute, tokens_per_minute)
+            self._limiters.pop(provider, None)
+
+    def configure_from_spec(self, spec: str):
+        """「openai=500:30000,anthropic=50:40000」形式（リクエスト数/分:トークン数/分）の文字列で上限を設定する"""
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            provider, _, values = item.partition("=")
+            requests_per_minute, _, tokens_per_minute = values.partition(":")
+            self.configure(provider, float(requests_per_minute), float(tokens_per_minute))
+
+    def get(self, provider: str):
+        """プロバイダのリミッタを取得する（なければ作成する。上限を設定していなければUnlimitedLimiter）"""
+        with self._lock:
+            limiter = self._limiters.get(provider)
+            if limiter is None:
+                limits = self.limits.get(provider)
+                limiter = ProviderLimiter(provider, *limits) if limits else UnlimitedLimiter(provider)
+                self._limiters[provider] = limiter
+            return limiter
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """全プロバイダのリミッタの統計を返す"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {provider: limiter.stats() for provider, limiter in sorted(limiters.items())}
+
+    def reset(self):
+        """すべてのリミッタを破棄する"""
+        with self._lock:
+            self._limiters.clear()
+
+
+# プロセス全体で共有するリミッタ（すべてのセッションの問い合わせをまとめて制限する）
+limiters = RateLimiters()
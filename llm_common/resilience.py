@@ -0,0 +1,427 @@
+"""
+プロバイダ障害に備えたリトライ・サーキットブレーカー・フォールバック
+
+- 問い合わせの前に、プロバイダのレート制限の枠を共有の受付キューで確保する
+- 一時的なエラー（レート制限・タイムアウト・5xxなど）はジッター付きの指数バックオフで再試行する
+- プロバイダごとのサーキットブレーカーで、連続して失敗しているプロバイダへの問い合わせを止める
+- 候補のモデルを順に試し、すべて失敗した場合はAllModelsFailedErrorを送出する
+  （エラーの文言をAIの応答として扱わないよう、呼び出し側には例外で伝える）
+"""
+
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import asyncio
+import random
+import threading
+import time
+
+from .context_window import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from .rate_limit import EXPECTED_OUTPUT_TOKENS, AdmissionTimeoutError, ProviderLimiter, RateLimiters, limiters
+
+# 再試行の対象とするHTTPステータス
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# 再試行の対象とする例外クラス名の一部（各プロバイダのSDKをインポートせずに判定する）
+RETRYABLE_ERROR_NAMES = (
+    "RateLimit", "Timeout", "APIConnection", "ConnectError", "RemoteProtocol",
+    "InternalServer", "ServiceUnavailable", "Overloaded", "ResourceExhausted", "DeadlineExceeded",
+)
+
+
+def status_code_of(error: BaseException) -> Optional[int]:
+    """例外からHTTPステータスを取り出す（取得できない場合はNone）"""
+    for value in (getattr(error, "status_code", None),
+                  getattr(getattr(error, "response", None), "status_code", None),
+                  getattr(error, "code", None)):
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """再試行すれば成功する見込みのあるエラーかどうかを判定する"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = status_code_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(error).__name__
+    return any(part in name for part in RETRYABLE_ERROR_NAMES)
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため問い合わせなかったことを表す例外"""
+
+    def __init__(self, provider: str):
+        super().__init__(f"{provider} のサーキットブレーカーが開いています")
+        self.provider = provider
+
+
+class AllModelsFailedError(Exception):
+    """候補のすべてのモデルで応答を取得できなかったことを表す例外"""
+
+    def __init__(self, errors: List[Tuple[str, BaseException]]):
+        detail = " / ".join(f"{model}: {error}" for model, error in errors) or "候補のモデルがありません"
+        super().__init__(detail if len(errors) == 1 else f"すべてのモデルで応答の取得に失敗しました（{detail}）")
+        self.errors = errors
+
+
+class RetryPolicy:
+    """ジッター付き指数バックオフによる再試行の設定"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        """max_attempts: 1モデルあたりの最大試行回数（初回を含む）"""
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """attempt回目（0始まり）の失敗後に待つ秒数（上限までの範囲で一様にばらつかせる）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """1プロバイダ分のサーキットブレーカー
+
+    連続した失敗がfailure_thresholdに達すると開き（open）、reset_timeout秒の間は問い合わせを止める。
+    その後は1件だけ試しに通し（half_open）、成功すれば閉じ（closed）、失敗すれば再び開く。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        """現在の状態（openのまま待ち時間を過ぎていればhalf_openとみなす）"""
+        with self._lock:
+            return self._current_state(self._clock())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """問い合わせてよいかを判定する（half_openでは試しの1件だけを通す）"""
+        with self._lock:
+            now = self._clock()
+            state = self._current_state(now)
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN:
+                return False
+            # 試しの問い合わせが結果を記録せずに終わった場合に備え、一定時間で取り直せるようにする
+            if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+            return False
+
+    def record_success(self):
+        """成功を記録する（ブレーカーを閉じる）"""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        """失敗を記録する（しきい値に達するか、試しの問い合わせが失敗すると開く）"""
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.trips += 1
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._probe_started = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """状態・連続失敗数・開いた回数・再開までの秒数を返す"""
+        with self._lock:
+            now = self._clock()
+            state = self._current_state(now)
+            retry_in = max(0.0, self.reset_timeout - (now - self._opened_at)) if state == self.OPEN else 0.0
+            return {"state": state, "failures": self._failures, "trips": self.trips, "retry_in": round(retry_in, 1)}
+
+
+class CircuitBreakers:
+    """プロバイダ名ごとにサーキットブレーカーを保持するスレッドセーフなレジストリ"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str) -> CircuitBreaker:
+        """プロバイダのブレーカーを取得する（なければ作成する）"""
+        with self._lock:
+            breaker = self._breakers.get(provider)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[provider] = breaker
+            return breaker
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """全プロバイダのブレーカーの状態を返す"""
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {provider: breaker.snapshot() for provider, breaker in sorted(breakers.items())}
+
+    def reset(self):
+        """すべてのブレーカーを破棄する"""
+        with self._lock:
+            self._breakers.clear()
+
+
+# プロセス全体で共有するブレーカー（同じプロバイダの障害はすべてのセッションで共有する）
+breakers = CircuitBreakers()
+
+
+class Candidate(NamedTuple):
+    """フォールバックの候補となる1モデル
+
+    prepareは (LLMクライアント, 送信するメッセージ) を返す関数で、そのモデルを試す時点で呼び出す。
+    prompt_tokensはprepareの後に呼び出され、送信するメッセージのトークン数の見積もりを返す
+    （省略するとメッセージから概算する）。
+    """
+    model_type: str
+    provider: str
+    prepare: Callable[[], Tuple[Any, List]]
+    prompt_tokens: Optional[Callable[[], int]] = None
+
+
+def estimate_prompt_tokens(messages: List) -> int:
+    """LangChainのメッセージ列のトークン数を概算する"""
+    total = 0
+    for message in messages:
+        content = message.content
+        if not isinstance(content, str):
+            content = "".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in content)
+        total += estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+
+def usage_total(usage_metadata: Optional[Dict[str, Any]]) -> Optional[int]:
+    """usage_metadataから入出力の合計トークン数を取り出す（取得できない場合はNone）"""
+    if not usage_metadata:
+        return None
+    return (usage_metadata.get("input_tokens") or 0) + (usage_metadata.get("output_tokens") or 0)
+
+
+class _Attempt(NamedTuple):
+    """試す準備ができた候補"""
+    candidate: Candidate
+    breaker: CircuitBreaker
+    limiter: ProviderLimiter
+    llm: Any
+    messages: List
+    tokens: int
+
+
+class ResilientCaller:
+    """候補のモデルを順に、レート制限・再試行・サーキットブレーカーを挟んで呼び出すクラス
+
+    各試行（再試行を含む）の前にプロバイダのレート制限の枠を確保する。枠を期限までに
+    確保できない場合は、そのモデルをあきらめて次の候補に移る。
+    """
+
+    def __init__(self, policy: Optional[RetryPolicy] = None, circuit_breakers: Optional[CircuitBreakers] = None,
+                 rate_limiters: Optional[RateLimiters] = None, admission_timeout: float = 30.0):
+        """admission_timeout: レート制限の枠が空くのを待つ秒数の上限"""
+        self.policy = policy or RetryPolicy()
+        self.breakers = circuit_breakers or breakers
+        self.limiters = rate_limiters or limiters
+        self.admission_timeout = admission_timeout
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.fallbacks = 0
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _should_retry(self, breaker: CircuitBreaker, error: BaseException, attempt: int) -> bool:
+        """失敗を記録し、同じモデルで再試行するかを判定する
+
+        プロバイダの不調とはみなせないエラー（リクエストの不備など）はブレーカーに数えず、次の候補に移る。
+        """
+        if not is_retryable(error):
+            return False
+        breaker.record_failure()
+        if attempt + 1 >= self.policy.max_attempts or not breaker.allow():
+            return False
+        self._count("retries")
+        return True
+
+    def _open(self, candidate: Candidate, errors: List) -> Optional[_Attempt]:
+        """候補を試す準備をする（ブレーカーが開いている・準備に失敗した場合はNone）"""
+        if errors:
+            self._count("fallbacks")
+        try:
+            llm, messages = candidate.prepare()
+            prompt_tokens = candidate.prompt_tokens() if candidate.prompt_tokens else estimate_prompt_tokens(messages)
+        except Exception as e:
+            errors.append((candidate.model_type, e))
+            return None
+        breaker = self.breakers.get(candidate.provider)
+        if not breaker.allow():
+            errors.append((candidate.model_type, CircuitOpenError(candidate.provider)))
+            return None
+        limiter = self.limiters.get(candidate.provider)
+        return _Attempt(candidate, breaker, limiter, llm, messages, prompt_tokens + EXPECTED_OUTPUT_TOKENS)
+
+    def invoke(self, candidates: Iterable[Candidate], session_id: str = "default") -> Tuple[str, Any]:
+        """応答を取得し、(応答したモデル, 応答) を返す（session_idはレート制限の公平性に使う）"""
+        errors: List[Tuple[str, BaseException]] = []
+        for candidate in candidates:
+            opened = self._open(candidate, errors)
+            if opened is None:
+                continue
+            for attempt in range(self.policy.max_attempts):
+                try:
+                    grant = opened.limiter.acquire(session_id, opened.tokens, self.admission_timeout)
+                except AdmissionTimeoutError as e:
+                    errors.append((candidate.model_type, e))
+                    break
+                response = None
+                try:
+                    response = opened.llm.invoke(opened.messages)
+                except Exception as e:
+                    if self._should_retry(opened.breaker, e, attempt):
+                        time.sleep(self.policy.delay(attempt))
+                        continue
+                    errors.append((candidate.model_type, e))
+                    break
+                finally:
+                    # 失敗・中断した試行の枠は見積もりをすべて返す
+                    opened.limiter.settle(grant, 0 if response is None else usage_total(response.usage_metadata))
+                opened.breaker.record_success()
+                return candidate.model_type, response
+        raise AllModelsFailedError(errors)
+
+    async def ainvoke(self, candidates: Iterable[Candidate], session_id: str = "default") -> Tuple[str, Any]:
+        """invokeの非同期版"""
+        errors: List[Tuple[str, BaseException]] = []
+        for candidate in candidates:
+            opened = self._open(candidate, errors)
+            if opened is None:
+                continue
+            for attempt in range(self.policy.max_attempts):
+                try:
+                    grant = await opened.limiter.aacquire(session_id, opened.tokens, self.admission_timeout)
+                except AdmissionTimeoutError as e:
+                    errors.append((candidate.model_type, e))
+                    break
+                response = None
+                try:
+                    response = await opened.llm.ainvoke(opened.messages)
+                except Exception as e:
+                    if self._should_retry(opened.breaker, e, attempt):
+                        await asyncio.sleep(self.policy.delay(attempt))
+                        continue
+                    errors.append((candidate.model_type, e))
+                    break
+                finally:
+                    # 失敗・中断した試行の枠は見積もりをすべて返す
+                    opened.limiter.settle(grant, 0 if response is None else usage_total(response.usage_metadata))
+                opened.breaker.record_success()
+                return candidate.model_type, response
+        raise AllModelsFailedError(errors)
+
+    def stream(self, candidates: Iterable[Candidate], session_id: str = "default") -> Iterator[Tuple[str, Any]]:
+        """ストリーミングで応答を取得し、(応答したモデル, チャンク) を順に返す
+
+        再試行・フォールバックは最初のチャンクを受け取る前の失敗に限る。
+        受信の途中で失敗した場合は、受信済みの内容と重複しないよう例外をそのまま送出する。
+        """
+        errors: List[Tuple[str, BaseException]] = []
+        for candidate in candidates:
+            opened = self._open(candidate, errors)
+            if opened is None:
+                continue
+            for attempt in range(self.policy.max_attempts):
+                try:
+                    grant = opened.limiter.acquire(session_id, opened.tokens, self.admission_timeout)
+                except AdmissionTimeoutError as e:
+                    errors.append((candidate.model_type, e))
+                    break
+                started = False
+                used = 0
+                try:
+                    for chunk in opened.llm.stream(opened.messages):
+                        started = True
+                        used += usage_total(chunk.usage_metadata) or 0
+                        yield candidate.model_type, chunk
+                except Exception as e:
+                    if started:
+                        if is_retryable(e):
+                            opened.breaker.record_failure()
+                        raise
+                    if self._should_retry(opened.breaker, e, attempt):
+                        time.sleep(self.policy.delay(attempt))
+                        continue
+                    errors.append((candidate.model_type, e))
+                    break
+                finally:
+                    # 最初のチャンクの前に失敗・中断した試行は見積もりをすべて返し、受信を始めた後は
+                    # 使用量が分かればその分で、分からなければ見積もりのまま精算する
+                    opened.limiter.settle(grant, used or (None if started else 0))
+                opened.breaker.record_success()
+                return
+        raise AllModelsFailedError(errors)
+
+    async def astream(self, candidates: Iterable[Candidate], session_id: str = "default") -> AsyncIterator[Tuple[str, Any]]:
+        """streamの非同期版"""
+        errors: List[Tuple[str, BaseException]] = []
+        for candidate in candidates:
+            opened = self._open(candidate, errors)
+            if opened is None:
+                continue
+            for attempt in range(self.policy.max_attempts):
+                try:
+                    grant = await opened.limiter.aacquire(session_id, opened.tokens, self.admission_timeout)
+                except AdmissionTimeoutError as e:
+                    errors.append((candidate.model_type, e))
+                    break
+                started = False
+                used = 0
+                try:
+                    async for chunk in opened.llm.astream(opened.messages):
+                        started = True
+                        used += usage_total(chunk.usage_metadata) or 0
+                        yield candidate.model_type, chunk
+                except Exception as e:
+                    if started:
+                        if is_retryable(e):
+                            opened.breaker.record_failure()
+                        raise
+                    if self._should_retry(opened.breaker, e, attempt):
+                        await asyncio.sleep(self.policy.delay(attempt))
+                        continue
+                    errors.append((candidate.model_type, e))
+                    break
+                finally:
+                    # 最初のチャンクの前に失敗・中断した試行は見積もりをすべて返し、受信を始めた後は
+                    # 使用量が分かればその分で、分からなければ見積もりのまま精算する
+                    opened.limiter.settle(grant, used or (None if started else 0))
+                opened.breaker.record_success()
+                return
+        raise AllModelsFailedError(errors)
+
+    def stats(self) -> Dict[str, Any]:
+        """再試行・フォールバックの回数と、ブレーカーの状態・レート制限の統計を返す"""
+        with self._lock:
+            counts = {"retries": self.retries, "fallbacks": self.fallbacks}
+        return {**counts, "breakers": self.breakers.snapshot(), "rate_limits": self.limiters.stats()}
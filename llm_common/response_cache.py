@@ -0,0 +1,189 @@
+"""
+モデル・温度・システムメッセージ・会話履歴のハッシュをキーとする応答キャッシュ
+
+- メモリ上のLRU（件数上限つき）と、任意でSQLiteによるディスク上の2段構成
+- どちらの段もTTLで期限切れにし、件数の上限を超えたものは古い順に追い出す
+- ヒット・ミスの回数を記録する
+- 会話履歴のハッシュはセッションごとのHistoryDigestで連鎖させて保持し、ターンごとに
+  追加されたメッセージだけをハッシュする（履歴全体を毎ターン正規化し直さない）
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Sequence
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+_WHITESPACE = re.compile(r"\s+")
+
+# ディスク上の段の追い出しは、この件数の書き込みごとにまとめて行う
+DISK_EVICT_INTERVAL = 100
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用にテキストを正規化する（Unicode正規化と空白の統一）"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def _chain(digest: bytes, message: Mapping[str, Any]) -> bytes:
+    """直前までのハッシュに、正規化したメッセージ1件をつないだハッシュ"""
+    encoded = json.dumps([message["role"], normalize_text(message["content"])],
+                         ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha256(digest + encoded).digest()
+
+
+class HistoryDigest:
+    """会話履歴のハッシュを追記型で保持するクラス（セッションごとに1つ持つ）
+
+    前回以降に追加されたメッセージだけを直前のハッシュにつなぐため、1ターンあたりの計算量は
+    追加したメッセージ数にのみ比例する。履歴が追記以外で変更された場合は作り直す。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ハッシュを破棄する"""
+        self._digest = b""
+        self._count = 0
+        self._last_source = None
+
+    def update(self, messages: Sequence[Mapping[str, Any]]) -> str:
+        """履歴全体のハッシュ（16進数）を返す"""
+        # 前回ハッシュした範囲が履歴の接頭辞でなくなっていれば作り直す
+        if len(messages) < self._count or (self._count and messages[self._count - 1] is not self._last_source):
+            self.reset()
+        for message in messages[self._count:]:
+            self._digest = _chain(self._digest, message)
+        self._count = len(messages)
+        self._last_source = messages[-1] if messages else None
+        return self._digest.hex()
+
+
+class ResponseCache:
+    """LRU・TTLで管理する応答キャッシュ"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0,
+                 disk_path: Optional[str] = None, max_disk_entries: int = 100_000):
+        """キャッシュの初期化（disk_pathを指定するとディスク上の段を有効にする）"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk = None
+        self._disk_puts = 0
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._disk.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+            self._disk.commit()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, system_message: Optional[str],
+                 messages: Sequence[Mapping[str, Any]], digest: Optional[HistoryDigest] = None) -> str:
+        """モデル・温度・システムメッセージ・正規化した履歴からキーを作成する
+
+        digestにセッションのHistoryDigestを渡すと、前回以降に追加されたメッセージだけをハッシュする
+        （省略すると履歴全体をハッシュする）。
+        """
+        payload = {
+            "model": model,
+            "temperature": temperature,
+            "system": normalize_text(system_message or ""),
+            "history": (digest or HistoryDigest()).update(messages),
+        }
+        encoded = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュされた応答を取得する（なければNone）"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._memory[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT response, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._disk.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._disk.commit()
+                    self._put_memory(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str):
+        """応答をキャッシュに保存する"""
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._put_memory(key, response, expires_at)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, response, expires_at, now),
+                )
+                self._disk_puts += 1
+                if self._disk_puts >= DISK_EVICT_INTERVAL:
+                    self._disk_puts = 0
+                    self._evict_disk(now)
+                self._disk.commit()
+
+    def _put_memory(self, key: str, response: str, expires_at: float):
+        """メモリ上の段に保存し、上限を超えた分を古い順に追い出す"""
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float):
+        """ディスク上の段から期限切れのものと、上限を超えた古いものを削除する"""
+        self._disk.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._disk.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        """すべてのエントリと統計を破棄する"""
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM responses")
+                self._disk.commit()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """ヒット数・ミス数・メモリ上のエントリ数を返す"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._memory),
+            }
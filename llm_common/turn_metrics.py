@@ -0,0 +1,318 @@
+"""
+ターンごとの計測（TTFT・メッセージ作成・プロバイダ・描画の時間とトークン数）
+
+1回の問い合わせ（ターン）をTurnTraceで計測し、終了時にプロセス全体で共有する
+TurnMetricsのヒストグラムに集計する。集計結果はPrometheusのテキスト形式で
+ファイルに書き出すか、HTTPで公開できる。
+
+    trace = metrics.start("stream")
+    with trace.span("provider"):
+        ...
+    trace.first_token()
+    trace.finish(model="gemini-2.0-flash")
+
+区間（span）は入れ子にでき、外側の区間の時間には内側の区間の時間を含めない
+（providerの区間の中でprepを計測すると、providerはプロバイダ側の時間だけになる）。
+"""
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import os
+import threading
+import time
+
+# 時間のヒストグラムの境界（秒）
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# トークン数のヒストグラムの境界
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# 現在のスレッド（タスク）で計測中のターン（span()から参照する）
+_current_turn: ContextVar[Optional["TurnTrace"]] = ContextVar("current_turn", default=None)
+
+
+class Histogram:
+    """ラベルの組ごとに値の分布を数えるヒストグラム（ロックは呼び出し側で取る）"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # ラベルの値の組 -> [各境界以下の件数（非累積）..., 境界を超えた件数, 合計, 件数]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        """Prometheusのテキスト形式の行を返す"""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            braces = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{braces} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{braces} {series[-1]}")
+        return lines
+
+    def reset(self):
+        self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class TurnTrace:
+    """1ターン分の計測"""
+
+    def __init__(self, recorder: "TurnMetrics", kind: str):
+        self._recorder = recorder
+        self._lock = threading.Lock()
+        self._token = None
+        self._finished = False
+        # 区間の時間の合計（入れ子の区間の時間を外側から差し引くために使う）
+        self._recorded = 0.0
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.ttft: Optional[float] = None
+        self.model: Optional[str] = None
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """区間の時間を計測する（同じ名前の区間は合計する）"""
+        start = time.perf_counter()
+        recorded = self._recorded
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                exclusive = max(0.0, duration - (self._recorded - recorded))
+                self.spans[name] = self.spans.get(name, 0.0) + exclusive
+                self._recorded += exclusive
+
+    def timed(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """funcの呼び出しをnameの区間として計測する関数を返す"""
+        def wrapper(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def first_token(self):
+        """最初のテキストを受け取った時点を記録する（2回目以降は無視する）"""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def add_usage(self, usage_metadata: Optional[Dict[str, Any]]):
+        """応答のusage_metadataから入出力のトークン数を加算する"""
+        if usage_metadata:
+            self.input_tokens += usage_metadata.get("input_tokens") or 0
+            self.output_tokens += usage_metadata.get("output_tokens") or 0
+
+    def finish(self, model: Optional[str] = None, status: str = "ok") -> Optional[Dict[str, Any]]:
+        """計測を終えて集計する（2回目以降の呼び出しは無視する）
+
+        どの区間にも含まれない時間はotherとして記録する。
+        """
+        if self._finished:
+            return None
+        self._finished = True
+        total = time.perf_counter() - self.started
+        if model is not None:
+            self.model = model
+        self.spans["other"] = max(0.0, total - self._recorded)
+        return self._recorder.record(self, total, status)
+
+    def __enter__(self) -> "TurnTrace":
+        """with文の中ではspan()でこのターンを計測する"""
+        self._token = _current_turn.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_turn.reset(self._token)
+        self.finish(status="error" if exc_type else "ok")
+        return False
+
+
+def current_turn() -> Optional[TurnTrace]:
+    """with文で開始した計測中のターン（なければNone）"""
+    return _current_turn.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """計測中のターンがあれば、その区間として計測する（なければ何もしない）"""
+    trace = _current_turn.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+class TurnMetrics:
+    """ターンの計測結果をヒストグラムに集計し、直近のターンを保持するスレッドセーフなレジストリ"""
+
+    def __init__(self, recent: int = 200):
+        self._lock = threading.Lock()
+        self.turn_seconds = Histogram(
+            "chat_turn_duration_seconds", "1ターンの所要時間", ("kind", "model", "status"), SECONDS_BUCKETS
+        )
+        self.ttft_seconds = Histogram(
+            "chat_time_to_first_token_seconds", "最初のテキストを受け取るまでの時間", ("model",), SECONDS_BUCKETS
+        )
+        self.span_seconds = Histogram(
+            "chat_turn_span_seconds", "ターン内の区間ごとの時間（入れ子の区間を除く）", ("span", "model"), SECONDS_BUCKETS
+        )
+        self.tokens = Histogram(
+            "chat_turn_tokens", "1ターンの入出力トークン数", ("direction", "model"), TOKEN_BUCKETS
+        )
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=recent)
+        # ターンの外で計測した区間の直近の値（区間名 -> 秒）
+        self._observed: Dict[str, Deque[float]] = {}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self, kind: str = "chat") -> TurnTrace:
+        """ターンの計測を開始する（kindはchat・streamなどの呼び出し方）"""
+        return TurnTrace(self, kind)
+
+    def record(self, trace: TurnTrace, total: float, status: str = "ok") -> Dict[str, Any]:
+        """終了したターンを集計する（TurnTrace.finishから呼び出される）"""
+        model = trace.model or ""
+        entry = {
+            "time": time.time(),
+            "kind": trace.kind,
+            "model": model,
+            "status": status,
+            "total": total,
+            "ttft": trace.ttft,
+            "spans": dict(trace.spans),
+            "input_tokens": trace.input_tokens,
+            "output_tokens": trace.output_tokens,
+        }
+        with self._lock:
+            self.turn_seconds.observe(total, trace.kind, model, status)
+            if trace.ttft is not None:
+                self.ttft_seconds.observe(trace.ttft, model)
+            for name, seconds in trace.spans.items():
+                self.span_seconds.observe(seconds, name, model)
+            if trace.input_tokens or trace.output_tokens:
+                self.tokens.observe(trace.input_tokens, "input", model)
+                self.tokens.observe(trace.output_tokens, "output", model)
+            self._recent.append(entry)
+        return entry
+
+    def observe_span(self, name: str, seconds: float, model: str = ""):
+        """ターンの外で計測した区間（画面の描画など）を記録する"""
+        with self._lock:
+            self.span_seconds.observe(seconds, name, model)
+            self._observed.setdefault(name, deque(maxlen=self._recent.maxlen)).append(seconds)
+
+    @contextmanager
+    def timer(self, name: str, model: str = "") -> Iterator[None]:
+        """with文の中の時間をobserve_spanで記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_span(name, time.perf_counter() - start, model)
+
+    def recent_turns(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """直近のターンを新しい順に返す"""
+        with self._lock:
+            return list(self._recent)[-limit:][::-1]
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """直近のターンの全体・TTFT・区間ごとの時間と、ターンの外で計測した区間のp50/p95（ミリ秒）を返す"""
+        with self._lock:
+            recent = list(self._recent)
+            observed = {name: list(v) for name, v in self._observed.items()}
+        values: Dict[str, List[float]] = {"total": [], "ttft": []}
+        for entry in recent:
+            values["total"].append(entry["total"])
+            if entry["ttft"] is not None:
+                values["ttft"].append(entry["ttft"])
+            for name, seconds in entry["spans"].items():
+                values.setdefault(name, []).append(seconds)
+        for name, seconds in observed.items():
+            values.setdefault(name, []).extend(seconds)
+
+        def percentile(sorted_values, p):
+            return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))] * 1000, 1)
+
+        return {
+            name: {"p50": percentile(sorted(v), 50), "p95": percentile(sorted(v), 95), "count": len(v)}
+            for name, v in values.items() if v
+        }
+
+    def to_prometheus(self) -> str:
+        """全ヒストグラムをPrometheusのテキスト形式で返す"""
+        with self._lock:
+            lines = []
+            for histogram in (self.turn_seconds, self.ttft_seconds, self.span_seconds, self.tokens):
+                lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Prometheusのテキスト形式でファイルに書き出す（node_exporterのtextfile collector向けに置き換えで書く）"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """/metricsでPrometheusのテキスト形式を返すHTTPサーバーをバックグラウンドで起動する（起動済みなら何もしない）"""
+        with self._lock:
+            if self._server is not None:
+                return self._server
+            recorder = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = recorder.to_prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((host, port), Handler)
+            threading.Thread(target=self._server.serve_forever, name="metrics-exporter", daemon=True).start()
+            return self._server
+
+    def reset(self):
+        """集計結果と直近のターンを破棄する"""
+        with self._lock:
+            for histogram in (self.turn_seconds, self.ttft_seconds, self.span_seconds, self.tokens):
+                histogram.reset()
+            self._recent.clear()
+            self._observed.clear()
+
+
+# プロセス全体で共有する計測結果（すべてのセッションのターンをまとめて集計する）
+metrics = TurnMetrics()
@@ -4,6 +4,8 @@
 
 import streamlit as st
 import os
+import time
+import uuid
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -12,6 +14,15 @@ load_dotenv()
 
 # バックエンドのインポート
 from backend import GeminiChatApp
+from session_store import SQLiteSessionStore
+from llm_common.response_cache import ResponseCache
+from title_worker import TitleWorker
+from llm_common.rate_limit import limiters
+from llm_common.turn_metrics import metrics
+from llm_common.history_view import render_history, to_display_markdown
+
+# サイドバーのセッション一覧の1ページあたりの件数
+SESSIONS_PER_PAGE = 50
 
 # ページ設定
 st.set_page_config(
@@ -20,37 +31,104 @@ st.set_page_config(
     layout="wide"
 )
 
+# ページ全体の再実行にかかった時間（サイドバー・会話欄をフラグメントにした効果の確認用）
+script_started = time.perf_counter()
+
+@st.cache_resource
+def get_session_store():
+    """プロセス全体で共有するセッションストア（SQLite）"""
+    return SQLiteSessionStore(os.getenv("CHAT_DB_PATH", "chat_sessions.db"))
+
+@st.cache_resource
+def get_response_cache():
+    """プロセス全体で共有する応答キャッシュ（環境変数RESPONSE_CACHE=1で有効化）"""
+    if os.getenv("RESPONSE_CACHE") != "1":
+        return None
+    return ResponseCache(disk_path=os.getenv("RESPONSE_CACHE_PATH"))
+
+@st.cache_resource
+def configure_rate_limits():
+    """プロバイダごとのレート制限を設定する（例: LLM_RATE_LIMITS=openai=500:30000,google=1000:1000000）"""
+    limiters.configure_from_spec(os.getenv("LLM_RATE_LIMITS", ""))
+    return limiters
+
+@st.cache_resource
+def get_title_worker():
+    """プロセス全体で共有するセッションタイトル生成ワーカー"""
+    return TitleWorker(GeminiChatApp.get_llm("gemini-2.0-flash", temperature=0.2))
+
+@st.cache_resource
+def start_metrics_exporter():
+    """環境変数METRICS_PORTが指定されていれば、/metricsでターンの計測結果を公開する（Prometheus形式）"""
+    port = os.getenv("METRICS_PORT")
+    return metrics.serve(int(port), os.getenv("METRICS_HOST", "127.0.0.1")) if port else None
+
+def get_owner() -> str:
+    """このブラウザのセッションを分けるキー（URLのownerパラメータ。なければ作成してURLに付ける）
+
+    ストアはプロセス全体で共有するため、一覧にはこのキーのセッションだけを表示する。
+    同じURLを開けば再読み込み後も同じセッションを使えるが、URLを知っている人も同じセッションを見られる。
+    """
+    owner = st.query_params.get("owner")
+    if not owner:
+        owner = uuid.uuid4().hex
+        st.query_params["owner"] = owner
+    return owner
+
+configure_rate_limits()
+start_metrics_exporter()
+
 # セッション状態の初期化
 if "chat_app" not in st.session_state:
-    st.session_state.chat_app = GeminiChatApp()
+    st.session_state.chat_app = GeminiChatApp(
+        store=get_session_store(),
+        owner=get_owner(),
+        response_cache=get_response_cache(),
+        title_worker=get_title_worker(),
+        # 既定のモデルが応答できない場合に順に試すモデル（例: FALLBACK_MODELS=gpt-4o,claude-3-7-sonnet）
+        fallback_models=[m for m in os.getenv("FALLBACK_MODELS", "").split(",") if m],
+        # メッセージをメモリに保持するセッション数とおおよその容量（MB）。それ以外のセッションは
+        # ストアに任せてメモリから追い出し、切り替えたときに読み戻す
+        max_hot_sessions=int(os.getenv("MAX_HOT_SESSIONS", "20")),
+        max_hot_bytes=int(float(os.environ["MAX_HOT_SESSION_MB"]) * 1024 * 1024) if os.getenv("MAX_HOT_SESSION_MB") else None,
+    )
 
 # タイトル
 st.title("Gemini 2.0 Pro チャットボット")
 
-# サイドバー設定
-with st.sidebar:
+# サイドバー設定（フラグメントとして、操作してもサイドバーだけを再実行する。
+# セッションの切り替えなど会話欄にも影響する操作ではページ全体を再実行する）
+@st.fragment
+def render_sidebar():
     st.header("チャットセッション")
     
-    # セッション一覧
-    all_sessions = st.session_state.chat_app.get_all_sessions()
+    # セッション一覧（id・名前・更新日時のみを、更新日時の新しい順にページ単位で取得）
+    session_count = st.session_state.chat_app.count_sessions()
     current_session = st.session_state.chat_app.get_current_session()
     current_session_id = current_session.session_id if current_session else None
     
-    # セッション選択
-    session_names = {session_id: session["name"] for session_id, session in all_sessions.items()}
+    page_count = (session_count - 1) // SESSIONS_PER_PAGE + 1
+    page = st.number_input("ページ", min_value=1, max_value=page_count, value=1) if page_count > 1 else 1
+    session_entries = st.session_state.chat_app.list_sessions(
+        offset=(page - 1) * SESSIONS_PER_PAGE, limit=SESSIONS_PER_PAGE
+    )
+    
+    # セッション選択（現在のセッションが別のページにある場合も選択肢に含める）
+    session_names = {entry["session_id"]: entry["name"] for entry in session_entries}
+    if current_session and current_session_id not in session_names:
+        session_names = {current_session_id: current_session.name, **session_names}
     
     # 現在のセッションのインデックスを特定
     session_ids = list(session_names.keys())
     current_index = session_ids.index(current_session_id) if current_session_id in session_ids else 0
     
-    selected_session_name = st.selectbox(
+    selected_session_id = st.selectbox(
         "セッションを選択",
-        options=list(session_names.values()),
-        index=current_index
+        options=session_ids,
+        index=current_index,
+        format_func=session_names.get
     )
-    
-    # 選択されたセッション名からIDを取得
-    selected_session_id = [sid for sid, name in session_names.items() if name == selected_session_name][0]
+    selected_session_name = session_names[selected_session_id]
     
     # セッションが変更された場合に切り替え
     if selected_session_id != current_session_id:
@@ -67,7 +145,7 @@ with st.sidebar:
     
     with col2:
         if st.button("セッション削除", key="delete_session"):
-            if len(all_sessions) > 1:  # 少なくとも1つのセッションは残す
+            if session_count > 1:  # 少なくとも1つのセッションは残す
                 if st.session_state.chat_app.delete_session(selected_session_id):
                     st.success("セッションを削除しました")
                     st.rerun()
@@ -106,6 +184,17 @@ with st.sidebar:
         else:
             st.warning("プロンプトを入力してください")
     
+    # 応答キャッシュ（有効な場合のみ）
+    response_cache = st.session_state.chat_app.response_cache
+    if response_cache is not None and current_session:
+        current_session.cache_bypass = st.checkbox(
+            "このセッションでは応答キャッシュを使わない",
+            value=current_session.cache_bypass,
+            key=f"cache_bypass_{current_session.session_id}"
+        )
+        cache_stats = response_cache.stats()
+        st.caption(f"応答キャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}")
+    
     # API状態の表示
     st.subheader("API接続状態")
     
@@ -116,6 +205,51 @@ with st.sidebar:
     else:
         st.error("Google API: APIキーが設定されていません")
     
+    # プロバイダごとのサーキットブレーカーの状態（問い合わせたことのあるプロバイダのみ）
+    for provider, breaker in st.session_state.chat_app.breaker_states().items():
+        if breaker["state"] == "open":
+            st.warning(f"{provider}: 一時停止中（{breaker['retry_in']}秒後に再試行）")
+        elif breaker["failures"]:
+            st.caption(f"{provider}: 連続失敗 {breaker['failures']} 回")
+    
+    # レート制限の受付キュー（プロセス内の全セッションで共有）
+    for provider, limit in st.session_state.chat_app.rate_limit_stats().items():
+        if limit["queue_depth"] or limit["rejected"]:
+            st.caption(
+                f"{provider}: 待ち {limit['queue_depth']} 件・待ち時間 p95 {limit['wait_ms_p95']}ms・"
+                f"期限切れ {limit['rejected']} 件"
+            )
+    
+    # トークン使用量（プロンプトキャッシュのヒット分を含む）
+    if current_session:
+        usage = current_session.usage
+        st.caption(
+            f"入力 {usage['input_tokens']} トークン（キャッシュヒット {usage['cache_read_tokens']}）/ "
+            f"出力 {usage['output_tokens']} トークン"
+        )
+    
+    # ターンの計測結果（デバッグ用。プロセス内の全セッションの直近のターン）
+    if st.checkbox("計測結果を表示", key="show_metrics"):
+        summary = metrics.summary()
+        if summary:
+            st.caption("直近のターンの区間ごとの時間（ミリ秒）")
+            st.table({name: {"p50": v["p50"], "p95": v["p95"], "件数": v["count"]} for name, v in summary.items()})
+            st.dataframe([
+                {
+                    "モデル": turn["model"],
+                    "種類": turn["kind"],
+                    "結果": turn["status"],
+                    "合計(ms)": round(turn["total"] * 1000, 1),
+                    "TTFT(ms)": round(turn["ttft"] * 1000, 1) if turn["ttft"] is not None else None,
+                    "入力": turn["input_tokens"],
+                    "出力": turn["output_tokens"],
+                }
+                for turn in metrics.recent_turns()
+            ])
+            st.download_button("Prometheus形式でダウンロード", metrics.to_prometheus(), file_name="chat_metrics.prom")
+        else:
+            st.caption("まだ計測結果がありません")
+    
     # 使用方法説明
     st.markdown("---")
     st.subheader("使用方法")
@@ -125,37 +259,60 @@ with st.sidebar:
     3. メッセージ入力欄にテキストを入力してチャット開始
     """)
 
-# チャット履歴の表示
-chat_container = st.container()
-with chat_container:
-    # 現在のセッション情報を表示
-    if current_session:
-        st.caption(f"現在のセッション: {current_session.name}")
-        
-        # チャット履歴を表示
-        for message in st.session_state.chat_app.get_conversation_history():
-            if message["role"] == "human":
-                st.chat_message("user").write(message["content"])
-            elif message["role"] == "ai":
-                st.chat_message("assistant").write(message["content"])
-
-# メッセージ入力
-with st.container():
-    user_input = st.chat_input("メッセージを入力してください...")
-    
-    if user_input:
-        # ユーザーメッセージの表示
-        st.chat_message("user").write(user_input)
+with st.sidebar:
+    render_sidebar()
+
+# 会話欄（フラグメントとして、メッセージを送信しても会話欄だけを再実行する）
+@st.fragment
+def render_chat_pane():
+    fragment_started = time.perf_counter()
+    current_session = st.session_state.chat_app.get_current_session()
+    
+    # チャット履歴の表示
+    with st.container():
+        # 現在のセッション情報を表示
+        if current_session:
+            st.caption(f"現在のセッション: {current_session.name}")
+            
+            def render_message(message):
+                if message["role"] == "human":
+                    st.chat_message("user").markdown(to_display_markdown(message["content"]))
+                elif message["role"] == "ai":
+                    st.chat_message("assistant").markdown(to_display_markdown(message["content"]))
+            
+            # チャット履歴を表示（最新のメッセージのみ。描画にかかった時間をrenderの区間として記録する）
+            with metrics.timer("render"):
+                render_history(
+                    st.session_state.chat_app.get_conversation_history(), current_session.session_id, render_message
+                )
+    
+    # メッセージ入力
+    with st.container():
+        user_input = st.chat_input("メッセージを入力してください...")
         
-        # 処理中の表示
-        with st.spinner("Gemini AIが考え中..."):
-            # LLMからの回答を取得
+        if user_input:
+            # ユーザーメッセージの表示
+            st.chat_message("user").write(user_input)
+            
+            # LLMからの回答をストリーミングで表示
+            # （失敗した場合はエラーを表示したままにするため、リロードしない）
             try:
-                response = st.session_state.chat_app.chat(user_input)
-                # 回答の表示
-                st.chat_message("assistant").write(response)
+                with st.chat_message("assistant"):
+                    st.write_stream(st.session_state.chat_app.stream(user_input))
             except Exception as e:
                 st.error(f"エラーが発生しました: {str(e)}")
-        
-        # 画面のリロード
-        st.rerun()
\ No newline at end of file
+            else:
+                # 計測結果をファイルに書き出す（環境変数METRICS_FILEを指定した場合。node_exporterのtextfile collector向け）
+                if os.getenv("METRICS_FILE"):
+                    metrics.write_prometheus(os.getenv("METRICS_FILE"))
+                
+                # 会話欄だけをリロード（サイドバーは再実行しない）
+                st.rerun(scope="fragment")
+        else:
+            # 応答の生成を含まない再実行の時間だけを記録する
+            metrics.observe_span("rerun_chat_pane", time.perf_counter() - fragment_started)
+
+render_chat_pane()
+
+# ページ全体の再実行の時間（メッセージの送信を含む実行は会話欄のリロードで中断されるため記録されない）
+metrics.observe_span("rerun_page", time.perf_counter() - script_started)
@@ -1,29 +1,261 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Tuple
 import os
+import sys
+import threading
 import uuid
+from collections import OrderedDict
 from datetime import datetime
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
+from itertools import islice
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from prompt import SYSTEM_PROMPT_CLAUDE
+from llm_common.llm_registry import registry
+from llm_common.context_window import ContextWindow
+from llm_common.response_cache import HistoryDigest
+from llm_common.message_record import MessageRecord
+from session_spill import SessionSpill
+from title_worker import build_title_prompt, clean_title
+from llm_common.resilience import Candidate, ResilientCaller, RetryPolicy
+from llm_common.turn_metrics import metrics
+from prompt_cache import (
+    add_usage,
+    build_system_message,
+    current_date_line,
+    mark_history_cacheable,
+    new_usage,
+    usage_from_metadata,
+)
+
+# モデルタイプ -> (プロバイダ, プロバイダ側のモデル名)
+MODEL_SPECS: Dict[str, tuple] = {
+    "gpt-4o": ("openai", "gpt-4o"),
+    "gemini-2.0-pro": ("google", "gemini-2.0-pro"),
+    "claude-3-7-sonnet": ("anthropic", "claude-3-7-sonnet-20250211"),
+    "gemini-2.0-flash": ("google", "gemini-2.0-flash"),
+}
+
+# モデルタイプごとの履歴のトークン予算（出力分の余裕を残したコンテキスト長）
+CONTEXT_BUDGETS: Dict[str, int] = {
+    "gpt-4o": 100_000,
+    "gemini-2.0-pro": 1_000_000,
+    "claude-3-7-sonnet": 180_000,
+    "gemini-2.0-flash": 900_000,
+}
+
+
+def chunk_text(chunk) -> str:
+    """ストリーミングのチャンクからテキスト部分を取り出す"""
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    # Anthropicなどはコンテンツブロックのリストを返す
+    return "".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in content
+    )
+
+
+# 履歴のロール -> LangChainのメッセージクラス
+LLM_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage}
+
+
+def to_llm_message(msg: Dict[str, Any]):
+    """履歴の1メッセージをLangChainのメッセージに変換する"""
+    return LLM_MESSAGE_TYPES[msg["role"]](content=msg["content"])
+
+
+# 自動で付けるセッション名の接頭辞
+DEFAULT_SESSION_NAME_PREFIX = "セッション "
+
+# メッセージ1件あたりの本文以外のメモリ量の見積もり（MessageRecord・LLM用メッセージ・トークン数のキャッシュ）
+MESSAGE_OVERHEAD_BYTES = 1024
+
+
+def message_bytes(content: str) -> int:
+    """メッセージ1件が使うメモリ量のおおよその値"""
+    return sys.getsizeof(content) + MESSAGE_OVERHEAD_BYTES
+
+
+class SessionIndex:
+    """セッション一覧表示用の軽量インデックス
+    
+    セッションごとにid・名前・更新日時だけを保持し、作成・名前変更・削除・
+    メッセージ追加のたびに増分で更新する。エントリは更新日時の古い順に並べて保持するため、
+    更新日時順のページ取得は全件数ではなく取得位置と件数にのみ比例する。
+    """
+    
+    def __init__(self):
+        self._entries = OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, session_id):
+        return session_id in self._entries
+    
+    def upsert(self, session_id: str, name: str, updated_at: datetime):
+        """エントリを追加または更新し、最新として並べ直す"""
+        self._entries[session_id] = {"session_id": session_id, "name": name, "updated_at": updated_at}
+        self._entries.move_to_end(session_id)
+    
+    def touch(self, session_id: str, updated_at: datetime):
+        """更新日時を更新し、最新として並べ直す"""
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            entry["updated_at"] = updated_at
+            self._entries.move_to_end(session_id)
+    
+    def rename(self, session_id: str, name: str):
+        """名前を変更する（並び順は変えない）"""
+        entry = self._entries.get(session_id)
+        if entry is not None:
+            entry["name"] = name
+    
+    def remove(self, session_id: str):
+        """エントリを削除する"""
+        self._entries.pop(session_id, None)
+    
+    def list(self, sort_by: str = "updated_at", descending: bool = True,
+             offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """エントリをソートしてページ単位で返す（返す辞書は変更しないこと）
+        
+        sort_byは"updated_at"または"name"。"updated_at"は保持している並び順をそのまま使い、
+        "name"は全件をソートする。
+        """
+        stop = None if limit is None else offset + limit
+        if sort_by == "updated_at":
+            entries = reversed(self._entries.values()) if descending else iter(self._entries.values())
+            return list(islice(entries, offset, stop))
+        if sort_by == "name":
+            entries = sorted(self._entries.values(), key=lambda entry: entry["name"], reverse=descending)
+            return entries[offset:stop]
+        raise ValueError(f"不明なソートキー: {sort_by}")
+
 
 class ChatSession:
     """チャットセッションを管理するクラス"""
     
-    def __init__(self, session_id=None, name=None):
-        """セッションの初期化"""
+    def __init__(self, session_id=None, name=None, store=None, index=None, spill=None, owner: str = ""):
+        """セッションの初期化
+        
+        storeを指定するとメッセージとメタデータを所有者ownerのものとして永続化し、indexを指定すると
+        更新日時の変更をセッション一覧のインデックスに反映する。spillには、storeがない場合に
+        unloadしたメッセージを書き出す退避先（SessionSpill）を指定する。
+        """
         self.session_id = session_id or str(uuid.uuid4())
-        self.name = name or f"セッション {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        self.messages = []
+        self.owner = owner
+        self.name = name or f"{DEFAULT_SESSION_NAME_PREFIX}{datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        # 会話内容からタイトルを生成済み（またはユーザーが名前を付けた）かどうか
+        self.summary_updated = name is not None
+        self.store = store
+        self.index = index
+        self.spill = spill
+        # メッセージ本文（ストアから復元したセッションやunloadしたセッションではNoneとし、初回アクセス時に読み込む）
+        self._messages = []
+        # 読み込み済みのメッセージが使うメモリ量のおおよその値
+        self.approx_bytes = 0
         self.system_message = None
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
+        # LLMに送信するメッセージ列のキャッシュ（先頭はシステムメッセージ、以降は履歴と1対1）
+        self._llm_messages = None
+        # トークン予算に収まる履歴の範囲（増分で更新される）
+        self.context_window = ContextWindow()
+        # 応答キャッシュのキーに使う履歴のハッシュ（増分で更新される）
+        self.history_digest = HistoryDigest()
+        # 入出力・プロンプトキャッシュのトークン使用量
+        self.usage = new_usage()
+        # Trueにすると、このセッションでは応答キャッシュを使わない（非決定的な応答が欲しい場合）
+        self.cache_bypass = False
     
-    def add_message(self, role: str, content: str):
-        """メッセージを追加する"""
-        self.messages.append({"role": role, "content": content})
+    @classmethod
+    def from_record(cls, record: Dict[str, Any], store, index=None) -> "ChatSession":
+        """ストアのメタデータからセッションを復元する（メッセージ本文は遅延読み込み）"""
+        session = cls(session_id=record["session_id"], name=record["name"], store=store, index=index,
+                      owner=record["owner"])
+        session.system_message = record["system_message"]
+        session.created_at = datetime.fromisoformat(record["created_at"])
+        session.updated_at = datetime.fromisoformat(record["updated_at"])
+        session.summary_updated = not record["name"].startswith(DEFAULT_SESSION_NAME_PREFIX)
+        session._messages = None
+        return session
+    
+    @property
+    def messages(self) -> List[MessageRecord]:
+        """メッセージ一覧（未読み込みの場合はストアまたは退避先から読み込む）"""
+        if self._messages is None:
+            if self.store:
+                self._messages = [
+                    MessageRecord(msg["role"], msg["content"], msg["model"],
+                                  created_at=datetime.fromisoformat(msg["created_at"]).timestamp())
+                    for msg in self.store.load_messages(self.session_id)
+                ]
+            else:
+                self._messages = self.spill.read(self.session_id) if self.spill else []
+            self.approx_bytes = sum(message_bytes(msg.content) for msg in self._messages)
+        return self._messages
+    
+    @property
+    def loaded(self) -> bool:
+        """メッセージ本文がメモリ上にあるかどうか"""
+        return self._messages is not None
+    
+    def unload(self) -> int:
+        """メッセージ本文とLLM用メッセージ列のキャッシュをメモリから解放し、解放したおおよそのバイト数を返す
+        
+        storeがあればメッセージは既に永続化されているので破棄するだけで、なければ退避先に書き出す。
+        次にmessagesを参照した時点で読み戻される。
+        """
+        if self._messages is None:
+            return 0
+        if not self.store:
+            if self.spill is None:
+                return 0
+            self.spill.write(self.session_id, self._messages)
+        freed = self.approx_bytes
+        self._messages = None
+        self.approx_bytes = 0
+        self.invalidate_llm_messages()
+        return freed
+    
+    def save(self):
+        """セッションのメタデータをストアに保存する"""
+        if self.store:
+            self.store.save_session(
+                self.session_id,
+                self.name,
+                self.system_message,
+                self.created_at.isoformat(),
+                self.updated_at.isoformat(),
+                self.owner,
+            )
+    
+    def add_message(self, role: str, content: str, model: Optional[str] = None):
+        """メッセージを追加する（modelには応答したモデルタイプを指定する）"""
         self.updated_at = datetime.now()
+        message = MessageRecord(role, content, model, created_at=self.updated_at.timestamp())
+        # ストアがない場合は退避先から読み戻してから追記する
+        # （ストアがあれば、追記したメッセージも後でストアから読み込まれる）
+        if self._messages is None and not self.store:
+            self.messages
+        if self._messages is not None:
+            self._messages.append(message)
+            self.approx_bytes += message_bytes(content)
+        if self.index is not None:
+            self.index.touch(self.session_id, self.updated_at)
+        if self._llm_messages is not None and role in LLM_MESSAGE_TYPES:
+            self._llm_messages.append(to_llm_message(message))
+        if self.store:
+            self.store.append_message(self.session_id, role, content, self.updated_at.isoformat(), model)
+    
+    def discard_last_message(self):
+        """最後に追加したメッセージを履歴とストアから取り除く（応答を得られなかったターンのユーザーメッセージ）"""
+        if self._messages:
+            message = self._messages.pop()
+            self.approx_bytes -= message_bytes(message.content)
+            if self._llm_messages is not None and message["role"] in LLM_MESSAGE_TYPES:
+                self._llm_messages.pop()
+        if self.store:
+            self.store.remove_last_message(self.session_id)
     
     def get_messages(self):
         """すべてのメッセージを取得する"""
@@ -33,13 +265,39 @@ class ChatSession:
         """システムメッセージを設定する"""
         self.system_message = content
         self.updated_at = datetime.now()
+        if self.index is not None:
+            self.index.touch(self.session_id, self.updated_at)
+        self.invalidate_llm_messages()
+        self.save()
+    
+    def invalidate_llm_messages(self):
+        """LLM用メッセージ列のキャッシュを破棄する（履歴を直接編集した場合に呼び出す）"""
+        self._llm_messages = None
+        self.context_window.reset()
+    
+    def get_llm_messages(self, system_message: SystemMessage) -> List:
+        """LLMに送信するメッセージ列を返す
+        
+        メッセージ列はadd_messageのたびに追記され、システムプロンプトの変更か
+        履歴の編集時にのみ作り直されるため、ターンごとの準備は償却O(1)となる。
+        先頭のシステムメッセージは、渡されたものと異なる場合にだけ差し替える。
+        返すリストはキャッシュそのものなので、呼び出し側で変更しないこと。
+        """
+        if self._llm_messages is None:
+            self._llm_messages = [system_message]
+            self._llm_messages.extend(
+                to_llm_message(msg) for msg in self.messages if msg["role"] in LLM_MESSAGE_TYPES
+            )
+        elif self._llm_messages[0] is not system_message:
+            self._llm_messages[0] = system_message
+        return self._llm_messages
     
     def to_dict(self):
         """セッション情報を辞書形式で返す"""
         return {
             "session_id": self.session_id,
             "name": self.name,
-            "messages": self.messages,
+            "messages": [message.to_dict() for message in self.messages],
             "system_message": self.system_message,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat()
@@ -49,29 +307,122 @@ class ChatSession:
 class GeminiChatApp:
     """Gemini 2.0 Proを使用したチャットアプリケーション（セッション対応）"""
     
-    def __init__(self):
-        """チャットアプリケーションの初期化"""
+    def __init__(self, model_type: str = "gemini-2.0-flash", context_budgets: Optional[Dict[str, int]] = None,
+                 store=None, response_cache=None, temperature: float = 0.7,
+                 title_worker=None, title_min_messages: int = 2,
+                 fallback_models: Optional[List[str]] = None, retry_policy: Optional[RetryPolicy] = None,
+                 max_hot_sessions: Optional[int] = None, max_hot_bytes: Optional[int] = None,
+                 spill_dir: Optional[str] = None, owner: str = ""):
+        """チャットアプリケーションの初期化
+        
+        storeを指定するとセッションを永続化し（ownerには、複数のユーザーで1つのstoreを共有する場合に
+        セッションを分けるキーを指定する。ownerのセッションだけを読み込み・作成する）、response_cacheを指定すると
+        同じ条件の問い合わせに対してキャッシュした応答を返す。title_workerを指定すると、
+        メッセージがtitle_min_messages件に達したセッションのタイトルをバックグラウンドで生成する。
+        model_typeのモデルが応答できない場合は、fallback_modelsのモデルを順に試す。
+        
+        max_hot_sessions（セッション数）またはmax_hot_bytes（メッセージのおおよそのバイト数）を
+        指定すると、最近使ったセッションだけのメッセージをメモリに残し、それ以外はアイドル状態として
+        メモリから追い出す。追い出したメッセージはstoreに任せるか、storeがなければspill_dir
+        （省略時は一時ディレクトリ）に書き出し、切り替えなどで再び使う時点で読み戻す。
+        """
         self.sessions = {}
         self.current_session_id = None
-        self.model = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.7)
+        self.store = store
+        self.owner = owner
+        # メッセージをメモリに保持しているセッション（最近使った順）と、その上限
+        self._hot_sessions = OrderedDict()
+        self.max_hot_sessions = max_hot_sessions
+        self.max_hot_bytes = max_hot_bytes
+        self.spill = None if store else SessionSpill(spill_dir)
+        self.response_cache = response_cache
+        self.temperature = temperature
+        # サイドバーなどの一覧表示用インデックス
+        self.session_index = SessionIndex()
+        self.model_type = model_type
+        self.provider = MODEL_SPECS[model_type][0]
+        self.model = self.get_llm(model_type, temperature)
+        # セッションタイトルの要約用の安価なモデル
+        self.summary_model = self.get_llm("gemini-2.0-flash", temperature=0.2)
+        self.title_worker = title_worker
+        self.title_min_messages = title_min_messages
+        # ワーカーが生成し、まだセッションに反映していないタイトル（セッションID -> タイトル）
+        self._generated_titles: Dict[str, str] = {}
+        self._titles_lock = threading.Lock()
+        # 再試行・サーキットブレーカー・フォールバック
+        for fallback in fallback_models or []:
+            if fallback not in MODEL_SPECS:
+                raise ValueError(f"不明なモデルタイプ: {fallback}")
+        self.fallback_models = [m for m in fallback_models or [] if m != model_type]
+        self.resilience = ResilientCaller(retry_policy)
+        # プロバイダ向けに加工したシステムメッセージ（同じ内容なら同じオブジェクトを使い回す）
+        self._system_messages = {}
+        # 全セッション合計のトークン使用量
+        self.usage = new_usage()
+        # モデルごとのトークン予算（指定があればデフォルトを上書き）
+        self.context_budgets = {**CONTEXT_BUDGETS, **(context_budgets or {})}
+        
+        # 保存済みのセッションを復元（メタデータのみ）
+        if store:
+            records = sorted(store.load_sessions(owner), key=lambda record: record["updated_at"])
+            for record in records:
+                session = ChatSession.from_record(record, store, self.session_index)
+                self.sessions[session.session_id] = session
+                self.session_index.upsert(session.session_id, session.name, session.updated_at)
         
-        # デフォルトセッションを作成
-        self.create_session()
+        if self.sessions:
+            # 最後に更新されたセッションを選択
+            self.current_session_id = max(self.sessions.values(), key=lambda s: s.updated_at).session_id
+            self._touch(self.sessions[self.current_session_id])
+        else:
+            # デフォルトセッションを作成
+            self.create_session()
     
     def create_session(self, name=None):
         """新しいセッションを作成し、そのセッションに切り替える"""
-        session = ChatSession(name=name)
+        session = ChatSession(name=name, store=self.store, index=self.session_index, spill=self.spill,
+                              owner=self.owner)
+        session.save()
         self.sessions[session.session_id] = session
+        self.session_index.upsert(session.session_id, session.name, session.updated_at)
         self.current_session_id = session.session_id
+        self._touch(session)
         return session.session_id
     
     def switch_session(self, session_id):
-        """指定されたIDのセッションに切り替える"""
+        """指定されたIDのセッションに切り替える（メモリから追い出されていれば読み戻す）"""
         if session_id in self.sessions:
             self.current_session_id = session_id
+            self._touch(self.sessions[session_id])
             return True
         return False
     
+    def _touch(self, session: ChatSession):
+        """セッションを最近使ったものとしてメッセージを読み込み、上限を超えた分のアイドル状態のセッションを追い出す"""
+        session.messages
+        self._hot_sessions[session.session_id] = None
+        self._hot_sessions.move_to_end(session.session_id)
+        self._evict_idle()
+    
+    def hot_bytes(self) -> int:
+        """メモリに保持しているメッセージのおおよそのバイト数"""
+        return sum(self.sessions[session_id].approx_bytes for session_id in self._hot_sessions)
+    
+    def _over_limit(self) -> bool:
+        if self.max_hot_sessions is not None and len(self._hot_sessions) > self.max_hot_sessions:
+            return True
+        return self.max_hot_bytes is not None and self.hot_bytes() > self.max_hot_bytes
+    
+    def _evict_idle(self):
+        """最近使っていない順にセッションのメッセージをメモリから追い出す（現在のセッションは残す）"""
+        for session_id in list(self._hot_sessions):
+            if not self._over_limit():
+                break
+            if session_id == self.current_session_id:
+                continue
+            del self._hot_sessions[session_id]
+            self.sessions[session_id].unload()
+    
     def delete_session(self, session_id):
         """指定されたIDのセッションを削除する"""
         if session_id in self.sessions:
@@ -81,12 +432,19 @@ class GeminiChatApp:
                 other_sessions = [s for s in self.sessions if s != session_id]
                 if other_sessions:
                     self.current_session_id = other_sessions[0]
+                    self._touch(self.sessions[other_sessions[0]])
                 else:
                     # 他のセッションがなければ新しいセッションを作成
                     self.create_session()
             
             # セッションを削除
             del self.sessions[session_id]
+            self._hot_sessions.pop(session_id, None)
+            self.session_index.remove(session_id)
+            if self.store:
+                self.store.delete_session(session_id)
+            else:
+                self.spill.delete(session_id)
             return True
         return False
     
@@ -94,66 +452,331 @@ class GeminiChatApp:
         """セッション名を変更する"""
         if session_id in self.sessions:
             self.sessions[session_id].name = new_name
+            # ユーザーが付けた名前は自動タイトルで上書きしない
+            self.sessions[session_id].summary_updated = True
+            self.sessions[session_id].save()
+            self.session_index.rename(session_id, new_name)
             return True
         return False
     
-    def get_llm(model_type: str):
-        if model_type == "gpt-4o":
-            return ChatOpenAI(model="gpt-4o", temperature=0.7)
-        elif model_type == "gemini-2.0-pro":
-            return ChatGoogleGenerativeAI(model="gemini-2.0-pro", temperature=0.7)
-        elif model_type == "claude-3-7-sonnet":
-            return ChatAnthropic(model="claude-3-7-sonnet-20250211", temperature=0.7)
-        elif model_type == "gemini-2.0-flash":
-            return ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=0.7)
-        else:
+    @staticmethod
+    def get_llm(model_type: str, temperature: float = 0.7):
+        """モデルタイプに対応するLLMクライアントを取得する（レジストリで共有される）"""
+        if model_type not in MODEL_SPECS:
             raise ValueError(f"不明なモデルタイプ: {model_type}")
+        provider, model_name = MODEL_SPECS[model_type]
+        return registry.get(provider, model_name, temperature=temperature)
     
     def get_current_session(self):
         """現在のセッションを取得する"""
+        self._apply_generated_titles()
         return self.sessions.get(self.current_session_id)
     
     def get_all_sessions(self):
-        """すべてのセッション情報を取得する"""
-        return {session_id: session.to_dict() for session_id, session in self.sessions.items()}
+        """すべてのセッション情報を取得する（全メッセージを含むため、一覧表示にはlist_sessionsを使う）
+        
+        メモリから追い出されていたセッションは、読み込んだ後で再び追い出す。
+        """
+        sessions = {}
+        for session_id, session in self.sessions.items():
+            loaded = session.loaded
+            sessions[session_id] = session.to_dict()
+            if not loaded:
+                session.unload()
+        return sessions
     
-    def chat(self, user_input: str) -> str:
-        """ユーザー入力に対する応答を生成する"""
-        current_session = self.get_current_session()
-        if not current_session:
-            return "エラー: アクティブなセッションがありません。"
+    def list_sessions(self, sort_by: str = "updated_at", descending: bool = True,
+                      offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """セッションのid・名前・更新日時だけをソート・ページ単位で取得する"""
+        self._apply_generated_titles()
+        return self.session_index.list(sort_by, descending, offset, limit)
+    
+    def count_sessions(self) -> int:
+        """セッション数を取得する"""
+        return len(self.session_index)
+    
+    def _system_message_for(self, session: ChatSession, provider: str) -> SystemMessage:
+        """セッションのシステムメッセージを、プロンプトキャッシュが効く形で取得する"""
+        # システムメッセージが未設定ならデフォルトのプロンプトを使用する（日付は末尾に付ける）
+        system_text = session.system_message or SYSTEM_PROMPT_CLAUDE
+        date_line = None if session.system_message else current_date_line()
+        
+        key = (provider, system_text, date_line)
+        system_message = self._system_messages.get(key)
+        if system_message is None:
+            if len(self._system_messages) >= 64:
+                self._system_messages.clear()
+            system_message = build_system_message(provider, system_text, date_line)
+            self._system_messages[key] = system_message
+        return system_message
+    
+    def _build_llm_messages(self, session: ChatSession, model_type: Optional[str] = None) -> List:
+        """セッションの履歴からLLMに送信するメッセージを作成する（model_typeを省略すると既定のモデル向け）"""
+        model_type = model_type or self.model_type
+        provider = MODEL_SPECS[model_type][0]
+        llm_messages = session.get_llm_messages(self._system_message_for(session, provider))
+        
+        # トークン予算に収まる最新の履歴だけを送信する（システムメッセージは常に残す）
+        start = session.context_window.select(
+            session.get_messages(),
+            self.context_budgets[model_type],
+            session.system_message or SYSTEM_PROMPT_CLAUDE,
+        )
+        if start:
+            llm_messages = llm_messages[:1] + llm_messages[1 + start:]
+        
+        # 直前のターンまでをキャッシュ可能な接頭辞にする
+        return mark_history_cacheable(provider, llm_messages)
+    
+    def _candidates(self, session: ChatSession) -> List[Candidate]:
+        """既定のモデルとフォールバック先を、試す順に並べる（メッセージは試す時点で作成する）"""
+        def prepare(model_type):
+            return lambda: (self.get_llm(model_type, self.temperature), self._build_llm_messages(session, model_type))
+        
+        def prompt_tokens():
+            # 直前のprepareで選択した範囲のトークン数（メッセージごとにキャッシュ済み）
+            window = session.context_window
+            return window.total + window.system_tokens(session.system_message or SYSTEM_PROMPT_CLAUDE)
         
+        return [
+            Candidate(model_type, MODEL_SPECS[model_type][0], prepare(model_type), prompt_tokens)
+            for model_type in [self.model_type, *self.fallback_models]
+        ]
+    
+    def _start_turn(self, user_input: str, session_id: Optional[str] = None, kind: str = "chat"):
+        """ユーザーメッセージを履歴に追加し、問い合わせるモデルの候補とターンの計測を準備する
+        
+        メッセージの作成（prepare）はprepの区間として計測する。
+        """
+        self._apply_generated_titles()
+        session = self.sessions.get(session_id) if session_id else self.get_current_session()
+        if not session:
+            return None, None, None
+        
+        trace = metrics.start(kind)
+        self._touch(session)
         # ユーザーメッセージを追加
-        current_session.add_message("human", user_input)
+        session.add_message("human", user_input)
+        candidates = [
+            candidate._replace(prepare=trace.timed("prep", candidate.prepare))
+            for candidate in self._candidates(session)
+        ]
+        return session, candidates, trace
+    
+    def _cached_reply(self, session: ChatSession) -> Tuple[Optional[str], Optional[str]]:
+        """応答キャッシュを引き、(キー, キャッシュされた応答) を返す（キャッシュを使わない場合のキーはNone）"""
+        if self.response_cache is None or session.cache_bypass:
+            return None, None
+        key = self.response_cache.make_key(
+            self.model_type,
+            self.temperature,
+            session.system_message or SYSTEM_PROMPT_CLAUDE,
+            session.get_messages(),
+            session.history_digest,
+        )
+        return key, self.response_cache.get(key)
+    
+    def _store_reply(self, cache_key: Optional[str], model_type: Optional[str], response: str):
+        """既定のモデルが最後まで返した応答だけをキャッシュする（フォールバック先の応答は保存しない）"""
+        if cache_key and model_type == self.model_type:
+            self.response_cache.put(cache_key, response)
+    
+    def _finish_turn(self, session: ChatSession, chunks: List[str], usage: Optional[Dict[str, int]] = None,
+                     model_type: Optional[str] = None, trace=None, status: str = "ok"):
+        """AIの応答を履歴に追加し、トークン使用量を記録してターンの計測を終える（中断された場合も受信済みの部分を残す）"""
+        with trace.span("store"):
+            if chunks:
+                session.add_message("ai", "".join(chunks), model_type)
+            if usage:
+                add_usage(session.usage, usage)
+                add_usage(self.usage, usage)
+            # 応答の分だけ増えたメモリが上限を超えていれば、アイドル状態のセッションを追い出す
+            self._evict_idle()
+            
+            # タイトル生成はバックグラウンドで行い、応答を待たせない
+            if (self.title_worker is not None and not session.summary_updated
+                    and len(session.get_messages()) >= self.title_min_messages):
+                self.title_worker.submit(session.session_id, session.get_messages(), self._receive_title)
+        trace.finish(model_type, status)
+    
+    def _abort_turn(self, session: ChatSession, trace, model_type: Optional[str] = None):
+        """応答を得られなかったターンのユーザーメッセージを取り除き、ターンの計測を終える
         
-        # LLMに送信するメッセージを作成
-        llm_messages = []
+        再試行したときに、ユーザーのメッセージが2件続けて送信されないようにする。
+        """
+        session.discard_last_message()
+        trace.finish(model_type, "error")
+    
+    def _receive_title(self, session_id: str, title: str):
+        """ワーカーが生成したタイトルを受け取る（ワーカーのスレッドから呼ばれるため、反映は後で行う）"""
+        with self._titles_lock:
+            self._generated_titles[session_id] = title
+    
+    def _apply_generated_titles(self):
+        """ワーカーが生成したタイトルをセッションに反映する（呼び出し側のスレッドで実行する）"""
+        if not self._generated_titles:
+            return
+        with self._titles_lock:
+            titles, self._generated_titles = self._generated_titles, {}
+        for session_id, title in titles.items():
+            session = self.sessions.get(session_id)
+            # 生成中に削除されたセッションは無視する
+            if session is not None:
+                self._apply_title(session, title)
+    
+    def _apply_title(self, session: ChatSession, title: str):
+        """生成したタイトルをセッションに反映する"""
+        if not title or session.summary_updated:
+            return
+        session.name = title
+        session.summary_updated = True
+        session.save()
+        self.session_index.rename(session.session_id, title)
+    
+    def breaker_states(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダごとのサーキットブレーカーの状態を取得する"""
+        return self.resilience.breakers.snapshot()
+    
+    def rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダごとのレート制限の受付キューの長さ・待ち時間を取得する（プロセス全体で共有）"""
+        return self.resilience.limiters.stats()
+    
+    def stream(self, user_input: str, session_id: Optional[str] = None) -> Iterator[str]:
+        """ユーザー入力に対する応答をチャンク単位で生成する
         
-        # システムメッセージがあれば追加
-        if current_session.system_message:
-            llm_messages.append(SystemMessage(content=current_session.system_message))
-        else:
-            llm_messages.append(SystemMessage(content=SYSTEM_PROMPT_CLAUDE))
-        
-        # 会話履歴を追加
-        for msg in current_session.get_messages():
-            if msg["role"] == "human":
-                llm_messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "ai":
-                llm_messages.append(AIMessage(content=msg["content"]))
-        # LLMに問い合わせ
+        ストリームが完了または中断した時点で、受信済みのテキストを履歴に追加する。
+        どのモデルからも応答を得られなかった場合はAllModelsFailedErrorを送出する
+        （エラーの内容は履歴に残さず、ユーザーメッセージも履歴から取り除く）。
+        """
+        session, candidates, trace = self._start_turn(user_input, session_id, "stream")
+        if not session:
+            yield "エラー: アクティブなセッションがありません。"
+            return
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(session)
+        if cached is not None:
+            trace.first_token()
+            self._finish_turn(session, [cached], model_type=self.model_type, trace=trace, status="cached")
+            yield cached
+            return
+        
+        chunks = []
+        usage = new_usage()
+        model_type = None
+        status = "error"
         try:
-            response = self.model.invoke(llm_messages)
-            ai_response = response.content
-            
-            # AIの応答を履歴に追加
-            current_session.add_message("ai", ai_response)
-            
-            return ai_response
-        except Exception as e:
-            error_message = f"エラーが発生しました: {str(e)}"
-            current_session.add_message("ai", error_message)
-            return error_message
+            # 呼び出し側がチャンクを表示している間はconsumerの区間として、プロバイダの時間から除く
+            with trace.span("provider"):
+                for model_type, chunk in self.resilience.stream(candidates, session.session_id):
+                    add_usage(usage, usage_from_metadata(chunk.usage_metadata))
+                    trace.add_usage(chunk.usage_metadata)
+                    text = chunk_text(chunk)
+                    if text:
+                        trace.first_token()
+                        chunks.append(text)
+                        with trace.span("consumer"):
+                            yield text
+            self._store_reply(cache_key, model_type, "".join(chunks))
+            status = "ok"
+        finally:
+            if chunks or status != "error":
+                self._finish_turn(session, chunks, usage, model_type, trace, status)
+            else:
+                self._abort_turn(session, trace, model_type)
+    
+    async def astream(self, user_input: str, session_id: Optional[str] = None) -> AsyncIterator[str]:
+        """streamの非同期版（プロバイダのastreamを使用する）"""
+        session, candidates, trace = self._start_turn(user_input, session_id, "astream")
+        if not session:
+            yield "エラー: アクティブなセッションがありません。"
+            return
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(session)
+        if cached is not None:
+            trace.first_token()
+            self._finish_turn(session, [cached], model_type=self.model_type, trace=trace, status="cached")
+            yield cached
+            return
+        
+        chunks = []
+        usage = new_usage()
+        model_type = None
+        status = "error"
+        try:
+            with trace.span("provider"):
+                async for model_type, chunk in self.resilience.astream(candidates, session.session_id):
+                    add_usage(usage, usage_from_metadata(chunk.usage_metadata))
+                    trace.add_usage(chunk.usage_metadata)
+                    text = chunk_text(chunk)
+                    if text:
+                        trace.first_token()
+                        chunks.append(text)
+                        with trace.span("consumer"):
+                            yield text
+            self._store_reply(cache_key, model_type, "".join(chunks))
+            status = "ok"
+        finally:
+            if chunks or status != "error":
+                self._finish_turn(session, chunks, usage, model_type, trace, status)
+            else:
+                self._abort_turn(session, trace, model_type)
+    
+    def chat(self, user_input: str, session_id: Optional[str] = None) -> str:
+        """ユーザー入力に対する応答を生成する
+        
+        どのモデルからも応答を得られなかった場合はAllModelsFailedErrorを送出する（ユーザーメッセージは履歴に残さない）。
+        """
+        session, candidates, trace = self._start_turn(user_input, session_id, "chat")
+        if not session:
+            return "エラー: アクティブなセッションがありません。"
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(session)
+        if cached is not None:
+            trace.first_token()
+            self._finish_turn(session, [cached], model_type=self.model_type, trace=trace, status="cached")
+            return cached
+        
+        try:
+            with trace.span("provider"):
+                model_type, response = self.resilience.invoke(candidates, session.session_id)
+        except Exception:
+            self._abort_turn(session, trace)
+            raise
+        trace.first_token()
+        trace.add_usage(response.usage_metadata)
+        ai_response = chunk_text(response)
+        self._store_reply(cache_key, model_type, ai_response)
+        self._finish_turn(session, [ai_response], usage_from_metadata(response.usage_metadata), model_type, trace)
+        return ai_response
+    
+    async def achat(self, user_input: str, session_id: Optional[str] = None) -> str:
+        """chatの非同期版（プロバイダのainvokeを使用する）"""
+        session, candidates, trace = self._start_turn(user_input, session_id, "achat")
+        if not session:
+            return "エラー: アクティブなセッションがありません。"
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(session)
+        if cached is not None:
+            trace.first_token()
+            self._finish_turn(session, [cached], model_type=self.model_type, trace=trace, status="cached")
+            return cached
+        
+        try:
+            with trace.span("provider"):
+                model_type, response = await self.resilience.ainvoke(candidates, session.session_id)
+        except Exception:
+            self._abort_turn(session, trace)
+            raise
+        trace.first_token()
+        trace.add_usage(response.usage_metadata)
+        ai_response = chunk_text(response)
+        self._store_reply(cache_key, model_type, ai_response)
+        self._finish_turn(session, [ai_response], usage_from_metadata(response.usage_metadata), model_type, trace)
+        return ai_response
     
     def set_system_prompt(self, system_prompt: str) -> str:
         """現在のセッションのシステムプロンプトを設定"""
@@ -180,35 +803,13 @@ class GeminiChatApp:
             return
         
         try:
-            # 最初の数メッセージを取得して要約用に使用
-            initial_messages = session.get_messages()[:6]  # 最初の6メッセージまでを使用
-            
-            # 要約用のプロンプト
-            summary_prompt = f"""
-            以下はチャット会話の抜粋です。この会話を最も適切に表現する短いタイトル（20文字以内）を作成してください。
-            タイトルは日本語で、会話の主なトピックや目的を表現するものにしてください。
-
-            会話:
-            """
-            
-            # 会話内容を追加
-            for msg in initial_messages:
-                role = "ユーザー" if msg["role"] == "human" else "AI"
-                summary_prompt += f"\n{role}: {msg['content'][:100]}..." if len(msg["content"]) > 100 else f"\n{role}: {msg['content']}"
-            
-            summary_prompt += "\n\nタイトル: "
-            
-            # 要約モデルに問い合わせ
+            # 最初の数メッセージから要約用のプロンプトを作成し、要約モデルに問い合わせ
+            summary_prompt = build_title_prompt(session.get_messages())
             summary_response = self.summary_model.invoke([HumanMessage(content=summary_prompt)])
-            summary = summary_response.content.strip()
-            
-            # 長すぎる場合はカット
-            if len(summary) > 30:
-                summary = summary[:27] + "..."
             
             # タイトルを更新
-            session.name = summary
-            session.summary_updated = True
+            session.summary_updated = False
+            self._apply_title(session, clean_title(summary_response.content))
             
         except Exception as e:
             print(f"セッション名の要約中にエラーが発生しました: {str(e)}")
@@ -0,0 +1,320 @@
+"""
+バックエンドのマイクロベンチマーク（ネットワーク不要）
+
+LLMへの問い合わせは偽のプロバイダ（llm_common/fake_llm.py）に差し替えるため、計測値から
+プロバイダの待ち時間を除いたバックエンド側の時間を求められる。結果はJSONで出力し、
+--outputを指定すると1行1件のJSONLとして追記する（回帰の追跡用）。
+
+使い方:
+    python bench.py message_cache
+    python bench.py memory
+    python bench.py turns --sizes 10 100 1000 10000
+    python bench.py concurrency --latency 0.05 --output bench_results.jsonl
+    python bench.py sessions --sizes 100 500 --turns 50
+"""
+
+import argparse
+import inspect
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from langchain_core.messages import SystemMessage
+
+from llm_common import fake_llm
+from llm_common.llm_registry import registry
+from llm_common.message_record import MessageRecord
+from llm_common.rate_limit import limiters
+
+from backend import ChatSession, GeminiChatApp, LLM_MESSAGE_TYPES, MODEL_SPECS, to_llm_message
+from prompt import SYSTEM_PROMPT_CLAUDE
+
+
+def _make_session(n_messages: int) -> ChatSession:
+    """n_messages件の履歴を持つセッションを作成する"""
+    session = ChatSession()
+    for i in range(n_messages):
+        session.add_message("human" if i % 2 == 0 else "ai", f"メッセージ {i} " * 20)
+    return session
+
+
+def _rebuild_llm_messages(session: ChatSession):
+    """キャッシュを使わずに毎ターン全履歴を変換する（従来の方式）"""
+    llm_messages = [SystemMessage(content=session.system_message or SYSTEM_PROMPT_CLAUDE)]
+    for msg in session.get_messages():
+        if msg["role"] in LLM_MESSAGE_TYPES:
+            llm_messages.append(to_llm_message(msg))
+    return llm_messages
+
+
+def bench_message_cache(sizes=(10, 100, 1000, 10000), turns: int = 50):
+    """ターンごとのメッセージ準備時間を、全件再構築と増分キャッシュで比較する"""
+    results = []
+    system_message = SystemMessage(content=SYSTEM_PROMPT_CLAUDE)
+    for size in sizes:
+        timings = {}
+        for mode in ("rebuild", "cached"):
+            session = _make_session(size)
+            session.get_llm_messages(system_message)  # キャッシュを温める
+            start = time.perf_counter()
+            for _ in range(turns):
+                session.add_message("human", "こんにちは")
+                if mode == "rebuild":
+                    _rebuild_llm_messages(session)
+                else:
+                    session.get_llm_messages(system_message)
+                session.add_message("ai", "こんにちは！")
+            timings[mode] = (time.perf_counter() - start) / turns * 1e6
+        results.append({
+            "history": size,
+            "rebuild_us_per_turn": round(timings["rebuild"], 2),
+            "cached_us_per_turn": round(timings["cached"], 2),
+        })
+    return results
+
+
+def _measure(build) -> int:
+    """build()が確保したメモリ量（バイト）を計測する"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return after - before
+
+
+def bench_memory(sizes=(10000, 100000)):
+    """辞書形式とMessageRecordで、履歴を保持するためのメモリ量を比較する
+
+    本文の文字列は両者で共有し、メッセージごとの入れ物のコストだけを計測する。
+    """
+    results = []
+    for size in sizes:
+        contents = [f"メッセージ {i}" for i in range(size)]
+        roles = ["human" if i % 2 == 0 else "ai" for i in range(size)]
+
+        def build_dicts():
+            return [
+                {"role": role, "content": content, "model": "gemini-2.0-flash",
+                 "created_at": datetime.now(), "tokens": 12}
+                for role, content in zip(roles, contents)
+            ]
+
+        def build_records():
+            return [
+                MessageRecord(role, content, "gemini-2.0-flash", tokens=12)
+                for role, content in zip(roles, contents)
+            ]
+
+        dict_bytes = _measure(build_dicts)
+        record_bytes = _measure(build_records)
+        results.append({
+            "messages": size,
+            "dict_bytes": dict_bytes,
+            "record_bytes": record_bytes,
+            "dict_bytes_per_message": round(dict_bytes / size, 1),
+            "record_bytes_per_message": round(record_bytes / size, 1),
+            "saving_ratio": round(1 - record_bytes / dict_bytes, 3),
+        })
+    return results
+
+
+def _percentile(values, p: float) -> float:
+    """pパーセンタイル（ミリ秒、小数2桁）"""
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2) if values else 0.0
+
+
+def _install_fake(latency: float, tokens_per_second) -> fake_llm.FakeProvider:
+    """偽のプロバイダに差し替え、レート制限で計測が待たされないよう上限を外す"""
+    fake = fake_llm.install(registry, latency=latency, tokens_per_second=tokens_per_second)
+    for provider, _ in MODEL_SPECS.values():
+        limiters.configure(provider, 1e9, 1e12)
+    return fake
+
+
+def _make_app(n_sessions: int, history: int) -> GeminiChatApp:
+    """n_sessions個のセッションにhistory件ずつ履歴を入れたアプリを作成する（永続化なし）"""
+    app = GeminiChatApp()
+    sessions = [app.get_current_session()] + [
+        app.sessions[app.create_session()] for _ in range(n_sessions - 1)
+    ]
+    for session in sessions:
+        for i in range(history):
+            session.add_message("human" if i % 2 == 0 else "ai", f"メッセージ {i} " * 20)
+    return app
+
+
+def bench_turns(sizes=(10, 100, 1000, 10000), turns: int = 50, latency: float = 0.0, tokens_per_second=None):
+    """履歴の長さごとに、1ターンあたりの時間・バックエンド側の時間・メモリ・スループットを計測する
+
+    overheadはターンの所要時間から偽のプロバイダの待ち時間を引いたもの。
+    """
+    fake = _install_fake(latency, tokens_per_second)
+    results = []
+    for size in sizes:
+        app = _make_app(1, size)
+        app.chat("ウォームアップ")
+        row = {"history": size}
+        for mode in ("chat", "stream"):
+            elapsed, overhead = [], []
+            for i in range(turns):
+                simulated = fake.simulated_seconds
+                start = time.perf_counter()
+                if mode == "chat":
+                    app.chat(f"質問 {i}")
+                else:
+                    for _ in app.stream(f"質問 {i}"):
+                        pass
+                elapsed.append(time.perf_counter() - start)
+                overhead.append(elapsed[-1] - (fake.simulated_seconds - simulated))
+            row[f"{mode}_ms_p50"] = _percentile(elapsed, 50)
+            row[f"{mode}_ms_p95"] = _percentile(elapsed, 95)
+            row[f"{mode}_overhead_ms_p50"] = _percentile(overhead, 50)
+            row[f"{mode}_overhead_ms_p95"] = _percentile(overhead, 95)
+            row[f"{mode}_turns_per_sec"] = round(turns / sum(elapsed), 1)
+
+        # 履歴を保持するためのメモリと、1ターンで一時的に確保されるメモリ
+        tracemalloc.start()
+        app = _make_app(1, size)
+        row["history_bytes"] = tracemalloc.get_traced_memory()[0]
+        app.chat("ウォームアップ")
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        app.chat("計測")
+        row["turn_peak_bytes"] = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        results.append(row)
+    return results
+
+
+def bench_concurrency(levels=(1, 8, 64, 256), turns: int = 5, history: int = 100,
+                      latency: float = 0.05, tokens_per_second=None):
+    """同時に会話するセッション数ごとに、スループットとターンのレイテンシを計測する（achatを使用）"""
+    fake = _install_fake(latency, tokens_per_second)
+    results = []
+    for level in levels:
+        app = _make_app(level, history)
+        latencies = []
+
+        async def run_session(session_id):
+            for i in range(turns):
+                start = time.perf_counter()
+                await app.achat(f"質問 {i}", session_id)
+                latencies.append(time.perf_counter() - start)
+
+        async def run_all():
+            await asyncio.gather(*(run_session(session_id) for session_id in list(app.sessions)))
+
+        calls_before, simulated_before = sum(fake.calls.values()), fake.simulated_seconds
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+        calls = sum(fake.calls.values()) - calls_before
+        provider_ms = (fake.simulated_seconds - simulated_before) / calls * 1000 if calls else 0.0
+        results.append({
+            "sessions": level,
+            "turns": len(latencies),
+            "turns_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms_p50": _percentile(latencies, 50),
+            "latency_ms_p95": _percentile(latencies, 95),
+            "latency_ms_p99": _percentile(latencies, 99),
+            "provider_ms_per_turn": round(provider_ms, 2),
+        })
+    return results
+
+
+def bench_sessions(sizes=(100, 500), turns: int = 50, history: int = 50, max_hot_sessions: int = 8):
+    """セッション数ごとに、メッセージを保持するメモリ量とセッションの切り替え時間を計測する
+
+    上限なし（すべて保持）と、max_hot_sessions個だけを保持してそれ以外をディスクに退避する場合を比較する。
+    turnsは切り替えの回数（毎回、最も長く使っていないセッションに切り替える）。
+    """
+    _install_fake(0.0, None)
+    results = []
+    for size in sizes:
+        row = {"sessions": size, "history": history}
+        for mode, limit in (("unbounded", None), ("bounded", max_hot_sessions)):
+            tracemalloc.start()
+            app = GeminiChatApp(max_hot_sessions=limit)
+            for _ in range(size - 1):
+                session = app.get_current_session()
+                for i in range(history):
+                    session.add_message("human" if i % 2 == 0 else "ai", f"メッセージ {i} " * 20)
+                app.create_session()
+            row[f"{mode}_bytes"] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            session_ids = list(app.sessions)
+            switches = []
+            for i in range(turns):
+                start = time.perf_counter()
+                app.switch_session(session_ids[i % len(session_ids)])
+                app.get_conversation_history()
+                switches.append(time.perf_counter() - start)
+            row[f"{mode}_switch_ms_p50"] = _percentile(switches, 50)
+            row[f"{mode}_switch_ms_p95"] = _percentile(switches, 95)
+        row["saving_ratio"] = round(1 - row["bounded_bytes"] / row["unbounded_bytes"], 3)
+        results.append(row)
+    return results
+
+
+def _git_revision() -> str:
+    """計測したコードのリビジョン（取得できない場合は空文字）"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+BENCHMARKS = {
+    "message_cache": bench_message_cache,
+    "memory": bench_memory,
+    "turns": bench_turns,
+    "concurrency": bench_concurrency,
+    "sessions": bench_sessions,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="バックエンドのマイクロベンチマーク")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", help="履歴の件数（turns）またはセッション数（concurrency・sessions）")
+    parser.add_argument("--turns", type=int, help="計測するターン数")
+    parser.add_argument("--latency", type=float, help="偽のプロバイダの最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, help="偽のプロバイダの生成速度")
+    parser.add_argument("--output", help="結果を1行のJSONとして追記するファイル")
+    args = parser.parse_args()
+
+    params = {}
+    if args.sizes:
+        params["levels" if args.benchmark == "concurrency" else "sizes"] = tuple(args.sizes)
+    for name in ("turns", "latency", "tokens_per_second"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    # 選んだベンチマークが受け付けないフラグは無視する（警告を表示する）
+    accepted = inspect.signature(BENCHMARKS[args.benchmark]).parameters
+    ignored = [name for name in params if name not in accepted]
+    if ignored:
+        print(f"{args.benchmark} では使わないため無視します: {', '.join(ignored)}", file=sys.stderr)
+    params = {name: value for name, value in params.items() if name in accepted}
+
+    record = {
+        "sample": "sample0",
+        "benchmark": args.benchmark,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": BENCHMARKS[args.benchmark](**params),
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
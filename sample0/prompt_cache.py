@@ -0,0 +1,80 @@
+"""
+プロバイダのプロンプトキャッシュを利用するためのメッセージ加工と使用量の集計
+
+- Anthropic: システムプロンプトと直前のターンまでの履歴に cache_control を付ける
+- OpenAI / Gemini: 接頭辞が毎ターン同一であれば自動（暗黙）キャッシュが効くため、
+  日付などの変化する部分を接頭辞の末尾に寄せて安定させる
+"""
+
+from typing import Any, Dict, List, Optional
+from datetime import date
+
+from langchain_core.messages import SystemMessage
+
+from prompt import CURRENT_DATE_TEMPLATE
+
+# Anthropicのキャッシュ指定（ephemeralは約5分間保持される）
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def current_date_line(today: Optional[date] = None) -> str:
+    """日付行を作成する（日単位なので同じ日の間はキャッシュを壊さない）"""
+    today = today or date.today()
+    return CURRENT_DATE_TEMPLATE.format(date=today.strftime("%Y/%m/%d"))
+
+
+def build_system_message(provider: str, system_text: str, date_line: Optional[str] = None) -> SystemMessage:
+    """プロバイダに合わせて、キャッシュ可能なシステムメッセージを作成する"""
+    if provider == "anthropic":
+        # 本文のブロックまでをキャッシュし、日付はブレークポイントの後ろに置く
+        blocks = [{"type": "text", "text": system_text, "cache_control": CACHE_CONTROL}]
+        if date_line:
+            blocks.append({"type": "text", "text": date_line})
+        return SystemMessage(content=blocks)
+
+    if date_line:
+        return SystemMessage(content=f"{system_text}\n\n{date_line}")
+    return SystemMessage(content=system_text)
+
+
+def mark_history_cacheable(provider: str, messages: List) -> List:
+    """直前のターンまでの履歴をキャッシュ可能な接頭辞として印を付ける
+
+    Anthropicのみが対象。最新のユーザーメッセージの1つ前のメッセージに
+    ブレークポイントを置いたコピーを返す（元のリストとメッセージは変更しない）。
+    """
+    if provider != "anthropic" or len(messages) < 3:
+        return messages
+
+    previous = messages[-2]
+    content = previous.content
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [*content[:-1], {**content[-1], "cache_control": CACHE_CONTROL}]
+
+    marked = list(messages)
+    marked[-2] = previous.__class__(content=content)
+    return marked
+
+
+def usage_from_metadata(usage_metadata: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """usage_metadataから入出力トークン数とキャッシュのヒット・書き込みトークン数を取り出す"""
+    usage_metadata = usage_metadata or {}
+    details = usage_metadata.get("input_token_details") or {}
+    return {
+        "input_tokens": usage_metadata.get("input_tokens") or 0,
+        "output_tokens": usage_metadata.get("output_tokens") or 0,
+        "cache_read_tokens": details.get("cache_read") or 0,
+        "cache_creation_tokens": details.get("cache_creation") or 0,
+    }
+
+
+def new_usage() -> Dict[str, int]:
+    """使用量の集計用の空の辞書を作成する"""
+    return {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_creation_tokens": 0}
+
+
+def add_usage(total: Dict[str, int], usage: Dict[str, int]):
+    """使用量を集計に加算する"""
+    for key, value in usage.items():
+        total[key] = total.get(key, 0) + value
@@ -0,0 +1,65 @@
+"""
+アイドル状態のセッションのメッセージを書き出すディスク上の退避先
+
+ストアを使わない場合に、メモリから追い出したセッションのメッセージ本文を
+セッションごとに1ファイルへ書き出し、再び使われた時点で読み戻す。
+ファイルは (ロール, 本文, モデル, 作成日時) の配列をJSONにしてzlibで圧縮したもので、
+読み戻した時点で削除する（メモリ上のメッセージが常に最新のため）。
+"""
+
+from typing import List, Optional
+import json
+import os
+import tempfile
+import zlib
+
+from llm_common.message_record import MessageRecord
+
+# 書き出しは頻繁に行うため、圧縮率より速度を優先する
+COMPRESSION_LEVEL = 1
+
+
+class SessionSpill:
+    """セッションのメッセージをディスクに退避・復元する"""
+
+    def __init__(self, directory: Optional[str] = None):
+        """directoryを省略すると、最初の書き出し時に一時ディレクトリを作成する"""
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="chat_sessions_")
+        return os.path.join(self.directory, f"{session_id}.json.z")
+
+    def write(self, session_id: str, messages: List[MessageRecord]) -> int:
+        """メッセージを書き出し、書き出したバイト数を返す（一時ファイルに書いてから置き換える）"""
+        rows = [(m.role, m.content, m.model, m.created_at) for m in messages]
+        data = zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                             COMPRESSION_LEVEL)
+        path = self._path(session_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return len(data)
+
+    def read(self, session_id: str) -> List[MessageRecord]:
+        """書き出したメッセージを読み戻し、ファイルを削除する（書き出していなければ空のリスト）"""
+        path = self._path(session_id)
+        try:
+            with open(path, "rb") as f:
+                rows = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        except FileNotFoundError:
+            return []
+        os.remove(path)
+        return [MessageRecord(role, content, model, created_at) for role, content, model, created_at in rows]
+
+    def delete(self, session_id: str):
+        """書き出したメッセージを削除する"""
+        if self.directory is None:
+            return
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
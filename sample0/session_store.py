@@ -0,0 +1,208 @@
+"""
+SQLite（WALモード）を使ったチャットセッションの永続化ストア
+
+- セッションのメタデータは起動時にまとめて読み込み、メッセージ本文は必要になった時点で
+  （またはページ単位で）読み込む
+- メッセージは1件1行で追記し、書き込みはバッファしてまとめて1トランザクションで行う
+- 接続はスレッドごとに作成し、複数のStreamlitセッション（スレッド）やプロセスからの
+  同時アクセスはWALとbusy_timeoutで捌く
+- セッションは所有者（ブラウザやユーザーを表すキー）ごとに分け、一覧は所有者のものだけを読み込む
+"""
+
+from typing import Any, Dict, List, Optional
+import atexit
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL,
+    system_message TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id);
+"""
+
+# 以前のスキーマで作成したデータベースに追加する列 (テーブル, 列, 定義)
+MIGRATIONS = [
+    ("sessions", "owner", "TEXT NOT NULL DEFAULT ''"),
+    ("messages", "model", "TEXT"),
+]
+
+# 追加した列を使うインデックス（列を追加してから作成する）
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_sessions_owner ON sessions (owner, updated_at);
+"""
+
+
+def _migrate(conn: sqlite3.Connection):
+    """足りない列を追加する"""
+    for table, column, definition in MIGRATIONS:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+class SQLiteSessionStore:
+    """チャットセッションとメッセージをSQLiteに保存するクラス"""
+
+    def __init__(self, path: str = "chat_sessions.db", batch_size: int = 32, flush_interval: float = 1.0):
+        """ストアの初期化
+
+        batch_size件たまるか、flush_interval秒経過するとバッファを書き込む。
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_messages: List[tuple] = []
+        self._pending_updates: Dict[str, List] = {}
+        self._closed = threading.Event()
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            _migrate(conn)
+            conn.executescript(INDEXES)
+
+        # 一定間隔でバッファを書き込むバックグラウンドスレッド
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-store-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        """現在のスレッド用の接続を取得する"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _flush_loop(self):
+        """flush_intervalごとにバッファを書き込む"""
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # 書き込めなかったメッセージはバッファに残っているので、次の間隔で再び書き込む
+                pass
+
+    # --- セッション ---
+
+    def load_sessions(self, owner: str = "") -> List[Dict[str, Any]]:
+        """所有者の全セッションのメタデータを読み込む（メッセージ本文は含まない）"""
+        self.flush()
+        rows = self._connect().execute(
+            "SELECT session_id, owner, name, system_message, created_at, updated_at, message_count "
+            "FROM sessions WHERE owner = ? ORDER BY created_at",
+            (owner,),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def save_session(self, session_id: str, name: str, system_message: Optional[str],
+                     created_at: str, updated_at: str, owner: str = ""):
+        """セッションのメタデータを保存する（なければownerのセッションとして作成する。所有者は変更しない）"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, owner, name, system_message, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET "
+                "name = excluded.name, system_message = excluded.system_message, updated_at = excluded.updated_at",
+                (session_id, owner, name, system_message, created_at, updated_at),
+            )
+
+    def delete_session(self, session_id: str):
+        """セッションとそのメッセージを削除する"""
+        self.flush()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    # --- メッセージ ---
+
+    def append_message(self, session_id: str, role: str, content: str, created_at: str,
+                       model: Optional[str] = None):
+        """メッセージを追記する（バッファに積み、まとめて書き込む。modelは応答したモデルタイプ）"""
+        with self._lock:
+            self._pending_messages.append((session_id, role, content, model, created_at))
+            update = self._pending_updates.setdefault(session_id, [created_at, 0])
+            update[0] = created_at
+            update[1] += 1
+            should_flush = len(self._pending_messages) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """バッファされたメッセージを1トランザクションで書き込む
+
+        バッファを空にするのはコミットに成功した後で、書き込みに失敗した場合はバッファに残す。
+        """
+        with self._lock:
+            if not self._pending_messages:
+                return
+
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT INTO messages (session_id, role, content, model, created_at) VALUES (?, ?, ?, ?, ?)",
+                    self._pending_messages,
+                )
+                conn.executemany(
+                    "UPDATE sessions SET updated_at = ?, message_count = message_count + ? WHERE session_id = ?",
+                    [(updated_at, count, session_id)
+                     for session_id, (updated_at, count) in self._pending_updates.items()],
+                )
+            self._pending_messages = []
+            self._pending_updates = {}
+
+    def remove_last_message(self, session_id: str):
+        """セッションの最後のメッセージを取り消す（書き込み前であればバッファから取り除く）"""
+        with self._lock:
+            for i in range(len(self._pending_messages) - 1, -1, -1):
+                if self._pending_messages[i][0] == session_id:
+                    del self._pending_messages[i]
+                    update = self._pending_updates[session_id]
+                    update[1] -= 1
+                    if not update[1]:
+                        del self._pending_updates[session_id]
+                    return
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM messages WHERE id = (SELECT MAX(id) FROM messages WHERE session_id = ?)", (session_id,)
+            )
+            conn.execute(
+                "UPDATE sessions SET message_count = message_count - 1 WHERE session_id = ? AND message_count > 0",
+                (session_id,),
+            )
+
+    def load_messages(self, session_id: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """セッションのメッセージを古い順に読み込む（offset/limitでページ単位の読み込みも可能）"""
+        self.flush()
+        rows = self._connect().execute(
+            "SELECT role, content, model, created_at FROM messages WHERE session_id = ? ORDER BY id LIMIT ? OFFSET ?",
+            (session_id, -1 if limit is None else limit, offset),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        """バッファを書き込み、バックグラウンドスレッドを止める"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
@@ -0,0 +1,166 @@
+"""
+セッションタイトルをリクエスト処理の外で生成するバックグラウンドワーカー
+
+- タイトル生成待ちのセッションはセッションIDで重複排除する
+- 待ちが複数あれば、まとめて1回の問い合わせでタイトルを生成する
+- 同時に実行する問い合わせ数はスレッドプールのサイズで制限する
+- 会話の抜粋は登録時に呼び出し側のスレッドで取り出し、ワーカーはセッションに触れない
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+import json
+import threading
+import time
+
+from langchain_core.messages import HumanMessage
+
+# タイトル生成に使う会話の先頭メッセージ数と、1メッセージあたりの文字数
+EXCERPT_MESSAGES = 6
+EXCERPT_CHARS = 100
+
+
+def format_excerpt(messages) -> str:
+    """会話の先頭部分を要約用のテキストにする"""
+    lines = []
+    for msg in messages[:EXCERPT_MESSAGES]:
+        role = "ユーザー" if msg["role"] == "human" else "AI"
+        content = msg["content"]
+        lines.append(f"{role}: {content[:EXCERPT_CHARS]}..." if len(content) > EXCERPT_CHARS else f"{role}: {content}")
+    return "\n".join(lines)
+
+
+def build_title_prompt(messages) -> str:
+    """1つの会話のタイトルを生成するプロンプトを作成する"""
+    return (
+        "以下はチャット会話の抜粋です。この会話を最も適切に表現する短いタイトル（20文字以内）を作成してください。\n"
+        "タイトルは日本語で、会話の主なトピックや目的を表現するものにしてください。\n\n"
+        f"会話:\n{format_excerpt(messages)}\n\nタイトル: "
+    )
+
+
+def build_batch_title_prompt(conversations: List) -> str:
+    """複数の会話のタイトルをまとめて生成するプロンプトを作成する"""
+    prompt = (
+        "以下は複数のチャット会話の抜粋です。それぞれの会話を最も適切に表現する短いタイトル（20文字以内）を作成してください。\n"
+        "タイトルは日本語で、会話の主なトピックや目的を表現するものにしてください。\n"
+        '出力は会話の番号順にタイトルだけを並べたJSON配列にしてください。例: ["タイトル1", "タイトル2"]\n'
+    )
+    for i, messages in enumerate(conversations, start=1):
+        prompt += f"\n会話{i}:\n{format_excerpt(messages)}\n"
+    return prompt
+
+
+def parse_batch_titles(text: str, expected: int) -> Optional[List[str]]:
+    """まとめて生成したタイトルのJSON配列を読み取る（件数が合わなければNone）"""
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return None
+    try:
+        titles = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(titles, list) or len(titles) != expected:
+        return None
+    return [str(title) for title in titles]
+
+
+def clean_title(text: str) -> str:
+    """生成されたタイトルを整える（長すぎる場合はカット）"""
+    title = text.strip().strip("「」\"'")
+    if len(title) > 30:
+        title = title[:27] + "..."
+    return title
+
+
+class TitleWorker:
+    """タイトル生成をバックグラウンドで行うワーカー
+
+    submit()で登録されたセッションを、ディスパッチ用スレッドが最大batch_size件ずつ
+    まとめてスレッドプールに渡す。プールが埋まっている間に届いた登録は次のバッチに
+    まとめられる。タイトルが決まるとワーカーのスレッドからon_title(session_id, title)を呼び出す
+    （on_titleではセッションを直接変更せず、呼び出し側のスレッドで反映すること）。
+    """
+
+    def __init__(self, model, max_workers: int = 2, batch_size: int = 8, batch_wait: float = 0.5):
+        """model: タイトル生成に使う安価なモデル、batch_wait: 登録をまとめるために待つ秒数"""
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._pending: "OrderedDict[str, tuple]" = OrderedDict()
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="title-worker")
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="title-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, session_id: str, messages, on_title: Callable) -> bool:
+        """セッションをタイトル生成待ちに登録する（登録済み・処理中の場合は何もしない）
+
+        messagesは会話のメッセージで、タイトル生成に使う先頭部分をこの時点で取り出しておく。
+        """
+        excerpt = list(messages[:EXCERPT_MESSAGES])
+        with self._cond:
+            if self._closed or session_id in self._pending or session_id in self._in_flight:
+                return False
+            self._pending[session_id] = (session_id, excerpt, on_title)
+            self._cond.notify()
+            return True
+
+    def _dispatch_loop(self):
+        """待ちのセッションをまとめてスレッドプールに渡す"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # 後続の登録をまとめるために少し待ってから、プールに空きができるまで待つ
+            time.sleep(self.batch_wait)
+            self._slots.acquire()
+
+            with self._cond:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    session_id, job = self._pending.popitem(last=False)
+                    self._in_flight.add(session_id)
+                    batch.append(job)
+            if batch:
+                self._executor.submit(self._run_batch, batch)
+            else:
+                self._slots.release()
+
+    def _run_batch(self, batch: List[tuple]):
+        """バッチのタイトルを生成して反映する"""
+        try:
+            titles = None
+            if len(batch) > 1:
+                prompt = build_batch_title_prompt([excerpt for _, excerpt, _ in batch])
+                response = self.model.invoke([HumanMessage(content=prompt)])
+                titles = parse_batch_titles(response.content, len(batch))
+            if titles is None:
+                # 1件のみ、またはまとめた結果を読み取れなかった場合は1件ずつ生成する
+                titles = [
+                    self.model.invoke([HumanMessage(content=build_title_prompt(excerpt))]).content
+                    for _, excerpt, _ in batch
+                ]
+            for (session_id, _, on_title), title in zip(batch, titles):
+                on_title(session_id, clean_title(title))
+        except Exception as e:
+            print(f"セッション名の要約中にエラーが発生しました: {str(e)}")
+        finally:
+            with self._cond:
+                for session_id, _, _ in batch:
+                    self._in_flight.discard(session_id)
+            self._slots.release()
+
+    def close(self):
+        """ワーカーを停止する（待ちのセッションは破棄する）"""
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
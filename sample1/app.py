@@ -1,50 +1,36 @@
 import streamlit as st
-from langgraph.graph import StateGraph, END
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_anthropic import ChatAnthropic
+from langgraph.graph import END
 from langchain_core.messages import HumanMessage, SystemMessage
-from typing import List, Dict, Optional, Literal
+from llm_common.llm_registry import registry
+from chat_graph import build_chat_graph, chat
+from llm_common.turn_metrics import metrics
+from llm_common.history_view import HISTORY_PAGE_SIZE, preview, render_history, to_display_markdown
+from typing import List, Dict, Literal
 import uuid
 import datetime
-from typing import Annotated
-from typing_extensions import TypedDict
-from langgraph.graph import StateGraph, START, END
-from langgraph.graph.message import add_messages
+from langgraph.graph import START, END
 
 # LLMモデルの種類を定義
 ModelType = Literal["gpt-4o", "gemini-2.0-pro", "claude-3-7-sonnet"]
 
 
-class State(TypedDict):
-    # Messages have the type "list". The `add_messages` function
-    # in the annotation defines how this state key should be updated
-    # (in this case, it appends messages to the list, rather than overwriting them)
-    messages: Annotated[list, add_messages]
-    current_model: ModelType
-    system_message: Optional[str]
-
-
-# LLMモデルを初期化する関数
+# LLMモデルを取得する関数（クライアントはレジストリで共有される）
 def get_llm(model_type: ModelType):
     if model_type == "gpt-4o":
-        return ChatOpenAI(model="gpt-4o", temperature=0.7)
+        return registry.get("openai", "gpt-4o", temperature=0.7)
     elif model_type == "gemini-2.0-pro":
-        return ChatGoogleGenerativeAI(model="gemini-2.0-pro", temperature=0.7)
+        return registry.get("google", "gemini-2.0-pro", temperature=0.7)
     elif model_type == "claude-3-7-sonnet":
-        return ChatAnthropic(model="claude-3-7-sonnet-20250211", temperature=0.7)
+        return registry.get("anthropic", "claude-3-7-sonnet-20250211", temperature=0.7)
     else:
         raise ValueError(f"不明なモデルタイプ: {model_type}")
 
 
 from typing import List, Dict, Any, TypedDict, Literal, Optional
 import os
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_anthropic import ChatAnthropic
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langgraph.graph import StateGraph, END
+from langgraph.graph import END
 
 # 必要な環境変数を設定（実際の利用時は.envファイルなどで管理）
 # os.environ["OPENAI_API_KEY"] = "your-openai-key"
@@ -60,14 +46,14 @@ class ChatState(TypedDict):
     current_model: ModelType
     system_message: Optional[str]
 
-# LLMモデルを初期化する関数
+# LLMモデルを取得する関数（クライアントはレジストリで共有される）
 def get_llm(model_type: ModelType):
     if model_type == "gpt-4o":
-        return ChatOpenAI(model="gpt-4o", temperature=0.7)
+        return registry.get("openai", "gpt-4o", temperature=0.7)
     elif model_type == "gemini-2.0-pro":
-        return ChatGoogleGenerativeAI(model="gemini-2.0-pro", temperature=0.7)
+        return registry.get("google", "gemini-2.0-pro", temperature=0.7)
     elif model_type == "claude-3-7-sonnet":
-        return ChatAnthropic(model="claude-3-7-sonnet-20250211", temperature=0.7)
+        return registry.get("anthropic", "claude-3-7-sonnet-20250211", temperature=0.7)
     else:
         raise ValueError(f"不明なモデルタイプ: {model_type}")
 
@@ -151,34 +137,32 @@ with st.sidebar:
     current_session = st.session_state["current_session"]
     st.session_state["sessions"][current_session]["model"] = model
 
+    # 会話履歴は本文を表示する画面側と重複するため、最新のメッセージの先頭だけを表示する
     st.markdown("### 会話履歴")
-    for msg in st.session_state["sessions"][current_session]["messages"]:
-        st.markdown(f"**{msg['role'].capitalize()}**: {msg['content']}")
+    sidebar_messages = st.session_state["sessions"][current_session]["messages"]
+    for msg in sidebar_messages[-HISTORY_PAGE_SIZE:]:
+        st.text(f"{msg['role'].capitalize()}: {preview(msg['content'])}")
+    if len(sidebar_messages) > HISTORY_PAGE_SIZE:
+        st.caption(f"ほか {len(sidebar_messages) - HISTORY_PAGE_SIZE} 件")
+
+    # ターンの計測結果（デバッグ用。プロセス内の全セッションの直近のターン）
+    if st.checkbox("計測結果を表示", key="show_metrics"):
+        summary = metrics.summary()
+        if summary:
+            st.caption("直近のターンの区間ごとの時間（ミリ秒）")
+            st.table({name: {"p50": v["p50"], "p95": v["p95"], "件数": v["count"]} for name, v in summary.items()})
+            st.download_button("Prometheus形式でダウンロード", metrics.to_prometheus(), file_name="chat_metrics.prom")
+        else:
+            st.caption("まだ計測結果がありません")
 
 # --- LangGraph Setup ---
-def llm_node(state: Dict) -> Dict:
-    model_name = state["model"]
-    input_text = state["messages"]
-
-    if model_name.startswith("gpt"):
-        llm = ChatOpenAI(model=model_name, temperature=0)
-        messages = [HumanMessage(content=input_text)]
-        response = llm(messages)
-        return {"response": response.content}
-
-    elif model_name.startswith("claude"):
-        return {"response": f"(Claudeによる応答のモック): {input_text}"}
+# グラフの定義はchat_graph.pyにある（ベンチマークなどからStreamlitなしで使うため）
+@st.cache_resource
+def get_chat_graph():
+    """コンパイル済みのグラフをプロセス全体で共有する（再実行やセッションごとにコンパイルしない）"""
+    return build_chat_graph()
 
-    elif model_name.startswith("gemini"):
-        return {"response": f"(Geminiによる応答のモック): {input_text}"}
-
-    return {"response": "不明なモデルが選択されました。"}
-
-builder = StateGraph(State)
-builder.add_node("llm", llm_node)
-builder.set_entry_point("llm")
-builder.set_finish_point("llm")
-chat_graph = builder.compile()
+chat_graph = get_chat_graph()
 
 # --- Chat UI ---
 st.title("🧠 LangGraph チャットアプリ")
@@ -188,16 +172,23 @@ if user_input:
     current_session = st.session_state["current_session"]
     model = st.session_state["sessions"][current_session]["model"]
 
-    st.session_state["sessions"][current_session]["messages"].append({"role": "user", "content": user_input})
+    history = st.session_state["sessions"][current_session]["messages"]
 
     with st.spinner("考え中..."):
-        state = {"input": user_input, "model": model}
-        result = chat_graph.invoke(state)
-        response = result["response"]
+        response = chat(chat_graph, history, user_input, model)
+
+    st.session_state["sessions"][current_session]["messages"].append({"role": "user", "content": user_input})
 
     st.session_state["sessions"][current_session]["messages"].append({"role": "assistant", "content": response})
 
-# Display chat messages
-for msg in st.session_state["sessions"][st.session_state["current_session"]]["messages"]:
+# Display chat messages（最新のメッセージのみ。描画にかかった時間をrenderの区間として記録する）
+def render_message(msg):
     with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
+        st.markdown(to_display_markdown(msg["content"]))
+
+with metrics.timer("render"):
+    render_history(
+        st.session_state["sessions"][st.session_state["current_session"]]["messages"],
+        st.session_state["current_session"],
+        render_message,
+    )
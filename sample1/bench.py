@@ -0,0 +1,181 @@
+"""
+chat_graphのベンチマーク（ネットワーク不要）
+
+gptモデルの問い合わせは偽のプロバイダ（llm_common/fake_llm.py）に差し替えるため、計測値から
+プロバイダの待ち時間を除いたグラフ側の時間を求められる。結果はJSONで出力し、
+--outputを指定すると1行1件のJSONLとして追記する（回帰の追跡用）。
+
+使い方:
+    python bench.py turns --sizes 10 100 1000 10000
+    python bench.py concurrency --latency 0.05 --output bench_results.jsonl
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import inspect
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from llm_common import fake_llm
+from llm_common.llm_registry import registry
+
+from chat_graph import build_chat_graph, chat
+
+MODEL = "gpt-3.5-turbo"
+
+
+def _percentile(values, p: float) -> float:
+    """pパーセンタイル（ミリ秒、小数2桁）"""
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2) if values else 0.0
+
+
+def _make_history(history: int):
+    """画面表示用の形式（role: user / assistant）でhistory件の履歴を作る"""
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"メッセージ {i} " * 20}
+        for i in range(history)
+    ]
+
+
+def _turn(graph, history, user_input: str):
+    """app.pyと同じく、応答を得てから履歴に追加する"""
+    response = chat(graph, history, user_input, MODEL)
+    history.append({"role": "user", "content": user_input})
+    history.append({"role": "assistant", "content": response})
+
+
+def bench_turns(sizes=(10, 100, 1000, 10000), turns: int = 50, latency: float = 0.0, tokens_per_second=None):
+    """履歴の長さごとに、1ターンあたりの時間・グラフ側の時間・メモリ・スループットを計測する
+
+    overheadはターンの所要時間から偽のプロバイダの待ち時間を引いたもの。
+    """
+    fake = fake_llm.install(registry, latency=latency, tokens_per_second=tokens_per_second)
+    graph = build_chat_graph()
+    results = []
+    for size in sizes:
+        history = _make_history(size)
+        _turn(graph, history, "ウォームアップ")
+        elapsed, overhead = [], []
+        for i in range(turns):
+            simulated = fake.simulated_seconds
+            start = time.perf_counter()
+            _turn(graph, history, f"質問 {i}")
+            elapsed.append(time.perf_counter() - start)
+            overhead.append(elapsed[-1] - (fake.simulated_seconds - simulated))
+        row = {
+            "history": size,
+            "chat_ms_p50": _percentile(elapsed, 50),
+            "chat_ms_p95": _percentile(elapsed, 95),
+            "chat_overhead_ms_p50": _percentile(overhead, 50),
+            "chat_overhead_ms_p95": _percentile(overhead, 95),
+            "chat_turns_per_sec": round(turns / sum(elapsed), 1),
+        }
+
+        # 履歴を保持するためのメモリと、1ターンで一時的に確保されるメモリ
+        tracemalloc.start()
+        history = _make_history(size)
+        row["history_bytes"] = tracemalloc.get_traced_memory()[0]
+        _turn(graph, history, "ウォームアップ")
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        _turn(graph, history, "計測")
+        row["turn_peak_bytes"] = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        results.append(row)
+    return results
+
+
+def bench_concurrency(levels=(1, 8, 64, 256), turns: int = 5, history: int = 100,
+                      latency: float = 0.05, tokens_per_second=None):
+    """同時に会話するセッション数ごとに、スループットとターンのレイテンシを計測する
+
+    Streamlitと同じく1セッション1スレッドで、コンパイル済みのグラフを全セッションで共有する。
+    """
+    fake = fake_llm.install(registry, latency=latency, tokens_per_second=tokens_per_second)
+    graph = build_chat_graph()
+    results = []
+    for level in levels:
+        latencies = []
+
+        def run_session(session_history):
+            for i in range(turns):
+                start = time.perf_counter()
+                _turn(graph, session_history, f"質問 {i}")
+                latencies.append(time.perf_counter() - start)
+
+        histories = [_make_history(history) for _ in range(level)]
+        calls_before, simulated_before = sum(fake.calls.values()), fake.simulated_seconds
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            list(executor.map(run_session, histories))
+        elapsed = time.perf_counter() - start
+        calls = sum(fake.calls.values()) - calls_before
+        provider_ms = (fake.simulated_seconds - simulated_before) / calls * 1000 if calls else 0.0
+        results.append({
+            "sessions": level,
+            "turns": len(latencies),
+            "turns_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms_p50": _percentile(latencies, 50),
+            "latency_ms_p95": _percentile(latencies, 95),
+            "latency_ms_p99": _percentile(latencies, 99),
+            "provider_ms_per_turn": round(provider_ms, 2),
+        })
+    return results
+
+
+def _git_revision() -> str:
+    """計測したコードのリビジョン（取得できない場合は空文字）"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+BENCHMARKS = {
+    "turns": bench_turns,
+    "concurrency": bench_concurrency,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chat_graphのベンチマーク")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", help="履歴の件数（turns）またはセッション数（concurrency）")
+    parser.add_argument("--turns", type=int, help="計測するターン数")
+    parser.add_argument("--latency", type=float, help="偽のプロバイダの最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, help="偽のプロバイダの生成速度")
+    parser.add_argument("--output", help="結果を1行のJSONとして追記するファイル")
+    args = parser.parse_args()
+
+    params = {}
+    if args.sizes:
+        params["levels" if args.benchmark == "concurrency" else "sizes"] = tuple(args.sizes)
+    for name in ("turns", "latency", "tokens_per_second"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    # 選んだベンチマークが受け付けないフラグは無視する（警告を表示する）
+    accepted = inspect.signature(BENCHMARKS[args.benchmark]).parameters
+    ignored = [name for name in params if name not in accepted]
+    if ignored:
+        print(f"{args.benchmark} では使わないため無視します: {', '.join(ignored)}", file=sys.stderr)
+    params = {name: value for name, value in params.items() if name in accepted}
+
+    record = {
+        "sample": "sample1",
+        "benchmark": args.benchmark,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": BENCHMARKS[args.benchmark](**params),
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,77 @@
+"""
+LangGraphのチャットグラフ（Streamlitに依存しないのでベンチマークなどから直接使える）
+"""
+
+from typing import Annotated, Any, Dict, List
+from typing_extensions import TypedDict
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.graph import StateGraph
+from langgraph.graph.message import add_messages
+
+from llm_common.llm_registry import registry
+from llm_common.turn_metrics import current_turn, metrics, span
+
+
+class State(TypedDict):
+    # Messages have the type "list". The `add_messages` function
+    # in the annotation defines how this state key should be updated
+    # (in this case, it appends messages to the list, rather than overwriting them)
+    messages: Annotated[list, add_messages]
+    model: str
+
+
+def to_llm_messages(history: List[Dict[str, Any]]) -> List:
+    """画面表示用の履歴（role: user / assistant）をLangChainのメッセージに変換する"""
+    return [
+        HumanMessage(content=msg["content"]) if msg["role"] == "user" else AIMessage(content=msg["content"])
+        for msg in history
+    ]
+
+
+def llm_node(state: State) -> Dict:
+    """選択されたモデルで応答を生成する（追加するメッセージだけを返す）"""
+    model_name = state["model"]
+    input_text = state["messages"][-1].content
+
+    if model_name.startswith("gpt"):
+        llm = registry.get("openai", model_name, temperature=0)
+        with span("provider"):
+            response = llm.invoke(state["messages"])
+        trace = current_turn()
+        if trace is not None:
+            trace.add_usage(getattr(response, "usage_metadata", None))
+        return {"messages": [AIMessage(content=response.content)]}
+
+    elif model_name.startswith("claude"):
+        return {"messages": [AIMessage(content=f"(Claudeによる応答のモック): {input_text}")]}
+
+    elif model_name.startswith("gemini"):
+        return {"messages": [AIMessage(content=f"(Geminiによる応答のモック): {input_text}")]}
+
+    return {"messages": [AIMessage(content="不明なモデルが選択されました。")]}
+
+
+def build_chat_graph():
+    """チャットグラフを構築してコンパイルする"""
+    builder = StateGraph(State)
+    builder.add_node("llm", llm_node)
+    builder.set_entry_point("llm")
+    builder.set_finish_point("llm")
+    return builder.compile()
+
+
+def chat(graph, history: List[Dict[str, Any]], user_input: str, model: str) -> str:
+    """履歴とユーザー入力をグラフに渡し、応答のテキストを返す
+
+    メッセージの変換をprep、プロバイダの呼び出しをprovider、それ以外のグラフの実行を
+    graphの区間としてターンを計測する。
+    """
+    with metrics.start("chat") as trace:
+        trace.model = model
+        with trace.span("prep"):
+            state = {"messages": to_llm_messages(history) + [HumanMessage(content=user_input)], "model": model}
+        with trace.span("graph"):
+            result = graph.invoke(state)
+        trace.first_token()
+        return result["messages"][-1].content
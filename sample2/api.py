@@ -0,0 +1,291 @@
+"""
+マルチLLMチャットのHTTP API（ASGI、FastAPI）
+
+ユーザーごと（X-User-Idヘッダー）にセッションを作成・切り替え・削除し、
+システムプロンプトとモデルを設定して、応答をまとめて（/chat）または
+Server-Sent Eventsで（/chat/stream）受け取る。
+
+- 同じセッションのターンはロックで直列化し、異なるセッションは1つのイベントループで並行に処理する
+- LLMクライアントと接続プールはプロセス全体で共有する（llm_registry）
+- 処理待ちのターンが上限に達した場合は待たせずに503（セッションごとの上限は429）を返す
+- 会話とセッションの所有者・名前はCHAT_CHECKPOINT_DBに保存し、メモリには最近使ったセッションだけを残す
+
+ユーザーの認証は行わず、X-User-Idヘッダーの値をそのまま所有者とする（省略すると"anonymous"）。
+認証済みのユーザーIDをX-User-Idに設定する（クライアントが送ったX-User-Idは取り除く）リバースプロキシの
+内側でのみ公開し、API_TOKENを設定してそのプロキシ以外からの呼び出しを断ること。
+
+起動:
+    uvicorn api:app --host 0.0.0.0 --port 8000
+
+環境変数:
+    CHAT_CHECKPOINT_DB       会話の保存先（SQLite）。省略するとメモリのみ（再起動で消える）
+    API_TOKEN                指定すると Authorization: Bearer <API_TOKEN> のないリクエストを401で断り、
+                             X-User-Idも必須にする
+    API_MAX_SESSIONS         メモリに保持するセッション数の上限（既定: 1024。それ以外は保存先から読み戻す）
+    API_MAX_CONCURRENCY      同時に実行するプロバイダ呼び出しの上限（既定: 256）
+    API_MAX_PENDING          実行中と待機中のターンの上限（既定: 1024）
+    API_MAX_SESSION_PENDING  セッションごとの実行中と待機中のターンの上限（既定: 4）
+    LLM_MAX_CONNECTIONS      プロバイダへの接続プールの上限（既定: llm_registryの設定）
+    LLM_RATE_LIMITS          プロバイダごとのレート制限（例: openai=500:30000,google=1000:1000000）
+    FALLBACK_MODELS          選択中のモデルが応答できない場合に順に試すモデル
+    FAKE_LLM_LATENCY         指定すると偽のプロバイダ（llm_common/fake_llm.py）で応答する（負荷試験用）
+"""
+
+from typing import Any, AsyncIterator, Dict, List, Optional
+from contextlib import asynccontextmanager
+import hmac
+import json
+import os
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from llm_common.llm_registry import registry
+from llm_common.rate_limit import AdmissionTimeoutError, limiters
+from llm_common.resilience import AllModelsFailedError
+from llm_common.turn_metrics import metrics
+
+from backend import ModelType
+from checkpoint import SQLiteCheckpointer
+from session_manager import DEFAULT_MAX_SESSIONS, AsyncChatSessionManager, OverloadedError, SessionBusyError
+
+# 断った場合に、再試行までの待ち時間としてクライアントに返す秒数
+RETRY_AFTER_SECONDS = 1
+
+
+class CreateSessionRequest(BaseModel):
+    name: Optional[str] = None
+    # 指定すると、そのIDのセッションを作成する（保存済みの自分のセッションであれば、その会話から再開する）
+    session_id: Optional[str] = None
+
+
+class RenameSessionRequest(BaseModel):
+    name: str
+
+
+class SystemPromptRequest(BaseModel):
+    system_prompt: str
+
+
+class ModelRequest(BaseModel):
+    model: ModelType
+
+
+class ChatRequest(BaseModel):
+    message: str
+    # 省略すると現在のセッションで応答する
+    session_id: Optional[str] = None
+
+
+def create_manager() -> AsyncChatSessionManager:
+    """環境変数の設定からセッションマネージャを作成する"""
+    path = os.getenv("CHAT_CHECKPOINT_DB")
+    return AsyncChatSessionManager(
+        max_concurrency=int(os.getenv("API_MAX_CONCURRENCY", "256")),
+        checkpointer=SQLiteCheckpointer(path) if path else None,
+        max_pending=int(os.getenv("API_MAX_PENDING", "1024")),
+        max_session_pending=int(os.getenv("API_MAX_SESSION_PENDING", "4")),
+        app_options={"fallback_models": [m for m in os.getenv("FALLBACK_MODELS", "").split(",") if m]},
+        max_sessions=int(os.getenv("API_MAX_SESSIONS", str(DEFAULT_MAX_SESSIONS))),
+    )
+
+
+def configure_providers():
+    """プロバイダ層の設定（接続プール・レート制限・負荷試験用の偽のプロバイダ）"""
+    if os.getenv("LLM_MAX_CONNECTIONS"):
+        registry.configure_pool(int(os.environ["LLM_MAX_CONNECTIONS"]))
+    limiters.configure_from_spec(os.getenv("LLM_RATE_LIMITS", ""))
+    if os.getenv("FAKE_LLM_LATENCY"):
+        from llm_common import fake_llm
+        fake_llm.install(registry, latency=float(os.environ["FAKE_LLM_LATENCY"]))
+
+
+def _rejection(status_code: int, error: Exception) -> JSONResponse:
+    """受け付けなかったターンへの応答（Retry-Afterで再試行までの秒数を示す）"""
+    return JSONResponse({"detail": str(error)}, status_code=status_code,
+                        headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+def create_app(manager: Optional[AsyncChatSessionManager] = None, api_token: Optional[str] = None) -> FastAPI:
+    """APIアプリケーションを作成する（managerを省略すると環境変数の設定から作成する）
+
+    api_tokenを省略すると環境変数API_TOKENを使う。
+    """
+    api_token = api_token or os.getenv("API_TOKEN")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if getattr(app.state, "manager", None) is None:
+            configure_providers()
+            app.state.manager = create_manager()
+        yield
+        # 共有している接続プールを閉じる（非同期クライアントも閉じ終わるまで待つ）
+        await registry.aclose()
+
+    api = FastAPI(title="マルチLLMチャットAPI", lifespan=lifespan)
+    # managerを渡した場合は、lifespanを実行しないASGIクライアント（httpx.ASGITransportなど）からも使える
+    if manager is not None:
+        api.state.manager = manager
+
+    @api.exception_handler(OverloadedError)
+    async def on_overloaded(request: Request, error: OverloadedError):
+        return _rejection(503, error)
+
+    @api.exception_handler(SessionBusyError)
+    async def on_session_busy(request: Request, error: SessionBusyError):
+        return _rejection(429, error)
+
+    @api.exception_handler(AdmissionTimeoutError)
+    async def on_admission_timeout(request: Request, error: AdmissionTimeoutError):
+        return _rejection(503, error)
+
+    @api.exception_handler(AllModelsFailedError)
+    async def on_all_models_failed(request: Request, error: AllModelsFailedError):
+        return JSONResponse({"detail": str(error)}, status_code=502)
+
+    def get_manager(request: Request) -> AsyncChatSessionManager:
+        return request.app.state.manager
+
+    def get_owner(x_user_id: Optional[str] = Header(None), authorization: Optional[str] = Header(None)) -> str:
+        """リクエストの所有者（X-User-Idをそのまま信頼する。API_TOKENがあれば呼び出し元を確認する）"""
+        if api_token:
+            if not hmac.compare_digest(authorization or "", f"Bearer {api_token}"):
+                raise HTTPException(401, "認証されていません", headers={"WWW-Authenticate": "Bearer"})
+            if not x_user_id:
+                raise HTTPException(400, "X-User-Idを指定してください")
+        return x_user_id or "anonymous"
+
+    def owned_session(session_id: str, owner: str, manager: AsyncChatSessionManager) -> str:
+        """ownerのセッションであることを確認する（他のユーザーのセッションは存在しないものとして扱う）"""
+        if not manager.owns(owner, session_id):
+            raise HTTPException(404, "セッションが見つかりません")
+        return session_id
+
+    def session_for_chat(body: ChatRequest, owner: str, manager: AsyncChatSessionManager) -> str:
+        """応答するセッション（指定がなければ現在のセッション。なければ作成する）"""
+        if body.session_id:
+            return owned_session(body.session_id, owner, manager)
+        return manager.current_session(owner) or manager.create_session(owner=owner)
+
+    def session_summary(manager: AsyncChatSessionManager, session_id: str) -> Dict[str, Any]:
+        chat_app = manager.get_session(session_id)
+        return {
+            **manager.get_info(session_id),
+            "model": chat_app.get_current_model(),
+            "system_prompt": chat_app.state["system_message"],
+            "message_count": len(chat_app.get_conversation_history()),
+        }
+
+    @api.get("/healthz")
+    async def healthz(manager: AsyncChatSessionManager = Depends(get_manager)):
+        return {"status": "ok", **manager.stats()}
+
+    @api.get("/metrics", response_class=PlainTextResponse)
+    async def prometheus_metrics():
+        return metrics.to_prometheus()
+
+    @api.post("/sessions", status_code=201)
+    async def create_session(body: CreateSessionRequest, owner: str = Depends(get_owner),
+                             manager: AsyncChatSessionManager = Depends(get_manager)):
+        try:
+            session_id = manager.create_session(body.session_id, name=body.name, owner=owner)
+        except KeyError:
+            raise HTTPException(409, "このIDのセッションは作成できません")
+        return session_summary(manager, session_id)
+
+    @api.get("/sessions")
+    async def list_sessions(owner: str = Depends(get_owner),
+                            manager: AsyncChatSessionManager = Depends(get_manager)):
+        return {"current_session_id": manager.current_session(owner), "sessions": manager.list_sessions(owner)}
+
+    @api.get("/sessions/{session_id}")
+    async def get_session(session_id: str, owner: str = Depends(get_owner),
+                          manager: AsyncChatSessionManager = Depends(get_manager)):
+        return session_summary(manager, owned_session(session_id, owner, manager))
+
+    @api.get("/sessions/{session_id}/messages")
+    async def get_messages(session_id: str, offset: int = 0, limit: Optional[int] = None,
+                           owner: str = Depends(get_owner),
+                           manager: AsyncChatSessionManager = Depends(get_manager)) -> List[Dict[str, Any]]:
+        messages = manager.get_session(owned_session(session_id, owner, manager)).get_conversation_history()
+        stop = None if limit is None else offset + limit
+        return [message.to_dict() for message in messages[offset:stop]]
+
+    @api.post("/sessions/{session_id}/switch")
+    async def switch_session(session_id: str, owner: str = Depends(get_owner),
+                             manager: AsyncChatSessionManager = Depends(get_manager)):
+        manager.switch_session(owned_session(session_id, owner, manager), owner)
+        return {"current_session_id": session_id}
+
+    @api.patch("/sessions/{session_id}")
+    async def rename_session(session_id: str, body: RenameSessionRequest, owner: str = Depends(get_owner),
+                             manager: AsyncChatSessionManager = Depends(get_manager)):
+        manager.rename_session(owned_session(session_id, owner, manager), body.name)
+        return session_summary(manager, session_id)
+
+    @api.delete("/sessions/{session_id}", status_code=204)
+    async def delete_session(session_id: str, owner: str = Depends(get_owner),
+                             manager: AsyncChatSessionManager = Depends(get_manager)):
+        manager.delete_session(owned_session(session_id, owner, manager))
+
+    @api.put("/sessions/{session_id}/system_prompt")
+    async def set_system_prompt(session_id: str, body: SystemPromptRequest, owner: str = Depends(get_owner),
+                                manager: AsyncChatSessionManager = Depends(get_manager)):
+        manager.get_session(owned_session(session_id, owner, manager)).set_system_prompt(body.system_prompt)
+        return session_summary(manager, session_id)
+
+    @api.put("/sessions/{session_id}/model")
+    async def change_model(session_id: str, body: ModelRequest, owner: str = Depends(get_owner),
+                           manager: AsyncChatSessionManager = Depends(get_manager)):
+        manager.get_session(owned_session(session_id, owner, manager)).change_model(body.model)
+        return session_summary(manager, session_id)
+
+    @api.post("/chat")
+    async def chat(body: ChatRequest, owner: str = Depends(get_owner),
+                   manager: AsyncChatSessionManager = Depends(get_manager)):
+        session_id = session_for_chat(body, owner, manager)
+        reply = await manager.achat(session_id, body.message)
+        history = manager.get_session(session_id).get_conversation_history()
+        return {"session_id": session_id, "reply": reply, "model": history[-1].get("model")}
+
+    @api.post("/chat/stream")
+    async def chat_stream(body: ChatRequest, owner: str = Depends(get_owner),
+                          manager: AsyncChatSessionManager = Depends(get_manager)):
+        """応答をServer-Sent Eventsで返す（data: {"text": ...} を繰り返し、最後にevent: done）
+
+        受け付けの可否と最初のチャンクを待ってからレスポンスを開始するため、断った場合や
+        最初の応答の前に失敗した場合は通常のHTTPステータスで返る。送信はクライアントの
+        受信に合わせて進むので、読むのが遅いクライアントの分だけプロバイダからの受信も待つ。
+        """
+        session_id = session_for_chat(body, owner, manager)
+        chunks = manager.astream(session_id, body.message)
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
+
+        async def events() -> AsyncIterator[str]:
+            try:
+                if first is not None:
+                    yield f"data: {json.dumps({'text': first}, ensure_ascii=False)}\n\n"
+                async for text in chunks:
+                    yield f"data: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+                return
+            finally:
+                await chunks.aclose()
+            history = manager.get_session(session_id).get_conversation_history() \
+                if manager.get_info(session_id) is not None else []
+            done = {"session_id": session_id, "model": history[-1].get("model") if history else None}
+            yield f"event: done\ndata: {json.dumps(done, ensure_ascii=False)}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    return api
+
+
+# uvicorn api:app で起動するアプリケーション
+app = create_app()
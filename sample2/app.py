@@ -1,10 +1,16 @@
 import streamlit as st
 from typing import List, Dict, Any, Literal
 import os
+import time
 from dotenv import load_dotenv
 
 # バックエンドのコードをインポート
 from backend import MultiModelChatApp, ModelType
+from llm_common.response_cache import ResponseCache
+from checkpoint import SQLiteCheckpointer
+from llm_common.rate_limit import limiters
+from llm_common.turn_metrics import metrics
+from llm_common.history_view import render_history, to_display_markdown
 
 # 環境変数の読み込み
 load_dotenv()
@@ -16,27 +22,75 @@ st.set_page_config(
     layout="wide",
 )
 
+# ページ全体の再実行にかかった時間（サイドバー・会話欄をフラグメントにした効果の確認用）
+script_started = time.perf_counter()
+
+# 表示名 -> モデルタイプ
+model_options = {
+    "OpenAI GPT-4o": "gpt-4o",
+    "Google Gemini 2.0 Pro": "gemini-2.0-pro",
+    "Anthropic Claude 3.7 Sonnet": "claude-3-7-sonnet"
+}
+
+@st.cache_resource
+def get_response_cache():
+    """プロセス全体で共有する応答キャッシュ（環境変数RESPONSE_CACHE=1で有効化）"""
+    if os.getenv("RESPONSE_CACHE") != "1":
+        return None
+    return ResponseCache(disk_path=os.getenv("RESPONSE_CACHE_PATH"))
+
+@st.cache_resource
+def configure_rate_limits():
+    """プロバイダごとのレート制限を設定する（例: LLM_RATE_LIMITS=openai=500:30000,google=1000:1000000）"""
+    limiters.configure_from_spec(os.getenv("LLM_RATE_LIMITS", ""))
+    return limiters
+
+@st.cache_resource
+def start_metrics_exporter():
+    """環境変数METRICS_PORTが指定されていれば、/metricsでターンの計測結果を公開する（Prometheus形式）"""
+    port = os.getenv("METRICS_PORT")
+    return metrics.serve(int(port), os.getenv("METRICS_HOST", "127.0.0.1")) if port else None
+
+@st.cache_resource
+def get_checkpointer():
+    """プロセス全体で共有する会話の保存先（環境変数CHAT_CHECKPOINT_DBを指定した場合のみ）"""
+    path = os.getenv("CHAT_CHECKPOINT_DB")
+    return SQLiteCheckpointer(path) if path else None
+
+configure_rate_limits()
+start_metrics_exporter()
+
 # セッション状態の初期化
 if "chat_app" not in st.session_state:
-    st.session_state.chat_app = MultiModelChatApp()
+    # 会話を保存する場合は、URLのthreadパラメータをスレッドIDとしてリロード後も同じ会話を続ける
+    checkpointer = get_checkpointer()
+    thread_id = st.query_params.get("thread") if checkpointer is not None else None
+    st.session_state.chat_app = MultiModelChatApp(
+        session_id=thread_id,
+        checkpointer=checkpointer,
+        response_cache=get_response_cache(),
+        # 選択中のモデルが応答できない場合に順に試すモデル（例: FALLBACK_MODELS=gpt-4o,gemini-2.0-pro）
+        fallback_models=[m for m in os.getenv("FALLBACK_MODELS", "").split(",") if m],
+    )
+    if checkpointer is not None:
+        st.query_params["thread"] = st.session_state.chat_app.session_id
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+if "pending_comparison" not in st.session_state:
+    st.session_state.pending_comparison = None
+
 # タイトル
 st.title("マルチLLMチャットボット")
 
-# サイドバー設定
-with st.sidebar:
+# サイドバー設定（フラグメントとして、操作してもサイドバーだけを再実行する。
+# 比較モードの設定はキーを付けたウィジェットの値として会話欄から参照する）
+@st.fragment
+def render_sidebar():
     st.header("設定")
     
     # モデル選択
-    model_options = {
-        "OpenAI GPT-4o": "gpt-4o",
-        "Google Gemini 2.0 Pro": "gemini-2.0-pro",
-        "Anthropic Claude 3.7 Sonnet": "claude-3-7-sonnet"
-    }
-    
     selected_model = st.selectbox(
         "使用するLLMモデルを選択",
         options=list(model_options.keys()),
@@ -49,6 +103,34 @@ with st.sidebar:
         response = st.session_state.chat_app.change_model(model_key)
         st.success(response)
     
+    # 比較モード設定
+    st.subheader("比較モード")
+    compare_mode = st.toggle("複数モデルで回答を比較する", key="compare_mode")
+    st.multiselect(
+        "比較するモデル",
+        options=list(model_options.keys()),
+        default=list(model_options.keys()),
+        disabled=not compare_mode,
+        key="compare_labels"
+    )
+    
+    # ヘッジ設定（応答が遅い場合に別のモデルにも問い合わせ、先に返った方を採用する）
+    st.subheader("ヘッジ（低レイテンシ）モード")
+    hedge_mode = st.toggle("応答が遅い場合に別のモデルにも問い合わせる")
+    hedge_label = st.selectbox(
+        "副モデル",
+        options=list(model_options.keys()),
+        index=1,
+        disabled=not hedge_mode
+    )
+    st.session_state.chat_app.set_hedging(model_options[hedge_label] if hedge_mode else None)
+    if hedge_mode:
+        hedge_stats = st.session_state.chat_app.hedge_stats()
+        st.caption(
+            f"発動 {hedge_stats['fired']} / {hedge_stats['requests']} 回・副モデルの採用 {hedge_stats['secondary_wins']} 回・"
+            f"短縮 約{hedge_stats['saved_seconds']:.1f}秒"
+        )
+    
     # システムプロンプト設定
     st.subheader("システムプロンプト")
     system_prompt = st.text_area(
@@ -64,6 +146,16 @@ with st.sidebar:
         else:
             st.warning("プロンプトを入力してください")
     
+    # 応答キャッシュ（有効な場合のみ）
+    response_cache = st.session_state.chat_app.response_cache
+    if response_cache is not None:
+        st.session_state.chat_app.cache_bypass = st.checkbox(
+            "このセッションでは応答キャッシュを使わない",
+            value=st.session_state.chat_app.cache_bypass
+        )
+        cache_stats = response_cache.stats()
+        st.caption(f"応答キャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}")
+    
     # API状態の表示
     st.subheader("API接続状態")
     
@@ -86,6 +178,43 @@ with st.sidebar:
     else:
         st.error("Anthropic API: APIキーが設定されていません")
     
+    # プロバイダごとのサーキットブレーカーの状態（問い合わせたことのあるプロバイダのみ）
+    for provider, breaker in st.session_state.chat_app.breaker_states().items():
+        if breaker["state"] == "open":
+            st.warning(f"{provider}: 一時停止中（{breaker['retry_in']}秒後に再試行）")
+        elif breaker["failures"]:
+            st.caption(f"{provider}: 連続失敗 {breaker['failures']} 回")
+    
+    # レート制限の受付キュー（プロセス内の全セッションで共有）
+    for provider, limit in st.session_state.chat_app.rate_limit_stats().items():
+        if limit["queue_depth"] or limit["rejected"]:
+            st.caption(
+                f"{provider}: 待ち {limit['queue_depth']} 件・待ち時間 p95 {limit['wait_ms_p95']}ms・"
+                f"期限切れ {limit['rejected']} 件"
+            )
+    
+    # ターンの計測結果（デバッグ用。プロセス内の全セッションの直近のターン）
+    if st.checkbox("計測結果を表示", key="show_metrics"):
+        summary = metrics.summary()
+        if summary:
+            st.caption("直近のターンの区間ごとの時間（ミリ秒）")
+            st.table({name: {"p50": v["p50"], "p95": v["p95"], "件数": v["count"]} for name, v in summary.items()})
+            st.dataframe([
+                {
+                    "モデル": turn["model"],
+                    "種類": turn["kind"],
+                    "結果": turn["status"],
+                    "合計(ms)": round(turn["total"] * 1000, 1),
+                    "TTFT(ms)": round(turn["ttft"] * 1000, 1) if turn["ttft"] is not None else None,
+                    "入力": turn["input_tokens"],
+                    "出力": turn["output_tokens"],
+                }
+                for turn in metrics.recent_turns()
+            ])
+            st.download_button("Prometheus形式でダウンロード", metrics.to_prometheus(), file_name="chat_metrics.prom")
+        else:
+            st.caption("まだ計測結果がありません")
+    
     # 使用方法説明
     st.markdown("---")
     st.subheader("使用方法")
@@ -94,55 +223,114 @@ with st.sidebar:
     2. 必要に応じてシステムプロンプトを設定
     3. メッセージ入力欄にテキストを入力してチャット開始
     4. モデルを切り替えて同じ会話を続けることができます
+    5. 比較モードでは複数モデルの回答を並べて表示し、採用する回答を選べます
     """)
 
-# チャット履歴の表示
-chat_container = st.container()
-with chat_container:
-    # チャット履歴を表示
-    for message in st.session_state.chat_app.get_conversation_history():
-        if message["role"] == "human":
-            st.chat_message("user").write(message["content"])
-        elif message["role"] == "ai":
-            model_name = message.get("model", "unknown")
-            # モデル名を人間が読みやすい形式に変換
-            if model_name == "gpt-4o":
-                display_model = "OpenAI GPT-4o"
-            elif model_name == "gemini-2.0-pro":
-                display_model = "Google Gemini 2.0 Pro"
-            elif model_name == "claude-3-7-sonnet":
-                display_model = "Anthropic Claude 3.7 Sonnet"
-            else:
-                display_model = model_name
-                
-            with st.chat_message("assistant"):
-                st.write(message["content"])
-                st.caption(f"回答モデル: {display_model}")
-
-# メッセージ入力
-with st.container():
-    user_input = st.chat_input("メッセージを入力してください...")
-    
-    if user_input:
-        # ユーザーメッセージの表示
-        st.chat_message("user").write(user_input)
-        
-        # 処理中の表示
-        with st.spinner("AIが考え中..."):
-            # LLMからの回答を取得
-            response = st.session_state.chat_app.chat(user_input)
-        
-        # 回答の表示とセッション状態の更新
-        current_model = st.session_state.chat_app.get_current_model()
-        model_display_name = {
-            "gpt-4o": "OpenAI GPT-4o",
-            "gemini-2.0-pro": "Google Gemini 2.0 Pro",
-            "claude-3-7-sonnet": "Anthropic Claude 3.7 Sonnet"
-        }.get(current_model, current_model)
+with st.sidebar:
+    render_sidebar()
+
+# 会話欄（フラグメントとして、メッセージを送信しても会話欄だけを再実行する）
+@st.fragment
+def render_chat_pane():
+    fragment_started = time.perf_counter()
+    
+    # チャット履歴の表示
+    with st.container():
+        def render_message(message):
+            if message["role"] == "human":
+                st.chat_message("user").markdown(to_display_markdown(message["content"]))
+            elif message["role"] == "ai":
+                model_name = message.get("model", "unknown")
+                # モデル名を人間が読みやすい形式に変換
+                if model_name == "gpt-4o":
+                    display_model = "OpenAI GPT-4o"
+                elif model_name == "gemini-2.0-pro":
+                    display_model = "Google Gemini 2.0 Pro"
+                elif model_name == "claude-3-7-sonnet":
+                    display_model = "Anthropic Claude 3.7 Sonnet"
+                else:
+                    display_model = model_name
+            
+                with st.chat_message("assistant"):
+                    st.markdown(to_display_markdown(message["content"]))
+                    st.caption(f"回答モデル: {display_model}")
+    
+        # チャット履歴を表示（最新のメッセージのみ。描画にかかった時間をrenderの区間として記録する）
+        with metrics.timer("render"):
+            render_history(
+                st.session_state.chat_app.get_conversation_history(), st.session_state.chat_app.session_id, render_message
+            )
+
+    # 比較結果の表示（採用する回答を選択）
+    pending_comparison = st.session_state.pending_comparison
+    if pending_comparison:
+        st.chat_message("user").write(pending_comparison["user_input"])
+        model_display_names = {value: label for label, value in model_options.items()}
+        columns = st.columns(len(pending_comparison["results"]))
+        for column, result in zip(columns, pending_comparison["results"]):
+            with column:
+                st.markdown(f"**{model_display_names.get(result['model'], result['model'])}**")
+                if result["error"]:
+                    st.error(f"エラーが発生しました: {result['error']}")
+                    continue
+                st.write(result["content"])
+                st.caption(
+                    f"レイテンシ: {result['latency']:.2f}秒 / "
+                    f"トークン: 入力 {result['input_tokens']}・出力 {result['output_tokens']}"
+                )
+                # 空の応答は履歴に残せないため採用できない
+                if result["content"] and st.button("この回答を採用", key=f"adopt_{result['model']}"):
+                    st.session_state.chat_app.commit_comparison(pending_comparison["user_input"], result)
+                    st.session_state.pending_comparison = None
+                    st.rerun(scope="fragment")
+
+    # メッセージ入力
+    with st.container():
+        user_input = st.chat_input("メッセージを入力してください...")
+    
+        compare_labels = st.session_state.get("compare_labels", [])
+        if user_input and st.session_state.get("compare_mode") and compare_labels:
+            # 選択したモデルに並行して問い合わせ、結果を比較表示する
+            with st.spinner("複数のモデルに問い合わせ中..."):
+                results = st.session_state.chat_app.compare(
+                    user_input, [model_options[label] for label in compare_labels]
+                )
+            st.session_state.pending_comparison = {"user_input": user_input, "results": results}
+            st.rerun(scope="fragment")
+    
+        elif user_input:
+            # ユーザーメッセージの表示
+            st.chat_message("user").write(user_input)
         
-        with st.chat_message("assistant"):
-            st.write(response)
-            st.caption(f"回答モデル: {model_display_name}")
+            # 回答の表示とセッション状態の更新
+            current_model = st.session_state.chat_app.get_current_model()
+            model_display_name = {
+                "gpt-4o": "OpenAI GPT-4o",
+                "gemini-2.0-pro": "Google Gemini 2.0 Pro",
+                "claude-3-7-sonnet": "Anthropic Claude 3.7 Sonnet"
+            }.get(current_model, current_model)
         
-        # 画面のリロード
-        st.rerun()
\ No newline at end of file
+            # LLMからの回答をストリーミングで表示
+            # （失敗した場合はエラーを表示したままにするため、リロードしない）
+            try:
+                with st.chat_message("assistant"):
+                    st.write_stream(st.session_state.chat_app.stream(user_input))
+                    st.caption(f"回答モデル: {model_display_name}")
+            except Exception as e:
+                st.error(f"エラーが発生しました: {str(e)}")
+            else:
+                # 計測結果をファイルに書き出す（環境変数METRICS_FILEを指定した場合。node_exporterのtextfile collector向け）
+                if os.getenv("METRICS_FILE"):
+                    metrics.write_prometheus(os.getenv("METRICS_FILE"))
+
+                # 会話欄だけをリロード（サイドバーは再実行しない）
+                st.rerun(scope="fragment")
+    
+        else:
+            # 応答の生成を含まない再実行の時間だけを記録する
+            metrics.observe_span("rerun_chat_pane", time.perf_counter() - fragment_started)
+
+render_chat_pane()
+
+# ページ全体の再実行の時間（メッセージの送信を含む実行は会話欄のリロードで中断されるため記録されない）
+metrics.observe_span("rerun_page", time.perf_counter() - script_started)
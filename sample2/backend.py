@@ -1,11 +1,18 @@
-from typing import List, Dict, Any, TypedDict, Literal, Optional
+from typing import List, Dict, Any, AsyncIterator, Iterator, TypedDict, Literal, Optional, Tuple
 import os
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_anthropic import ChatAnthropic
+import uuid
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langgraph.graph import StateGraph, END, START
+from llm_common.llm_registry import registry
+from llm_common.context_window import MESSAGE_OVERHEAD_TOKENS, ContextWindow
+from llm_common.message_record import MessageRecord
+from llm_common.response_cache import HistoryDigest
+from llm_common.resilience import Candidate, ResilientCaller, RetryPolicy
+from hedging import Hedger, HedgePolicy
+from llm_common.turn_metrics import metrics
 
 # 必要な環境変数を設定（実際の利用時は.envファイルなどで管理）
 # os.environ["OPENAI_API_KEY"] = "your-openai-key"
@@ -15,30 +22,82 @@ from langgraph.graph import StateGraph, END, START
 # LLMモデルの種類を定義
 ModelType = Literal["gpt-4o", "gemini-2.0-pro", "claude-3-7-sonnet"]
 
-# チャット状態を表すクラス
+# 会話履歴のreducer（追記のみ。既存のリストに追記し、履歴をコピーしない）
+def append_records(left: Optional[List[MessageRecord]], right) -> List[MessageRecord]:
+    """差分のメッセージを履歴の末尾に追記する"""
+    if not isinstance(right, list):
+        right = [right]
+    if left is None:
+        return list(right)
+    left.extend(right)
+    return left
+
+# チャット状態を表すクラス（更新は変更するキーだけの差分で行い、messagesはreducerで追記する）
 class ChatState(TypedDict):
-    messages: List[Dict[str, Any]]
+    messages: List[MessageRecord]
     current_model: ModelType
     system_message: Optional[str]
 
-# LLMモデルを初期化する関数
-def get_llm(model_type: ModelType):
-    if model_type == "gpt-4o":
-        return ChatOpenAI(model="gpt-4o", temperature=0.7)
-    elif model_type == "gemini-2.0-pro":
-        return ChatGoogleGenerativeAI(model="gemini-2.0-pro", temperature=0.7)
-    elif model_type == "claude-3-7-sonnet":
-        return ChatAnthropic(model="claude-3-7-sonnet-20250211", temperature=0.7)
-    else:
+# reducerを持つステートのキー（それ以外のキーは上書き）
+STATE_REDUCERS = {"messages": append_records}
+
+def apply_update(state: ChatState, update: Dict[str, Any]) -> ChatState:
+    """差分をステートに反映する（reducerを持つキーは追記、それ以外は上書きで、ステートをその場で更新する）"""
+    for key, value in update.items():
+        reducer = STATE_REDUCERS.get(key)
+        state[key] = reducer(state.get(key), value) if reducer else value
+    return state
+
+# 比較モードにおける1モデル分の結果を表すクラス
+class CompareResult(TypedDict):
+    model: ModelType
+    content: str
+    latency: float
+    input_tokens: Optional[int]
+    output_tokens: Optional[int]
+    error: Optional[str]
+
+# モデルタイプ -> (プロバイダ, プロバイダ側のモデル名)
+MODEL_SPECS: Dict[str, tuple] = {
+    "gpt-4o": ("openai", "gpt-4o"),
+    "gemini-2.0-pro": ("google", "gemini-2.0-pro"),
+    "claude-3-7-sonnet": ("anthropic", "claude-3-7-sonnet-20250211"),
+}
+
+# モデルタイプごとの履歴のトークン予算（出力分の余裕を残したコンテキスト長）
+CONTEXT_BUDGETS: Dict[str, int] = {
+    "gpt-4o": 100_000,
+    "gemini-2.0-pro": 1_000_000,
+    "claude-3-7-sonnet": 180_000,
+}
+
+# LLMモデルを取得する関数（クライアントはレジストリで共有される）
+def get_llm(model_type: ModelType, temperature: float = 0.7):
+    if model_type not in MODEL_SPECS:
         raise ValueError(f"不明なモデルタイプ: {model_type}")
+    provider, model_name = MODEL_SPECS[model_type]
+    return registry.get(provider, model_name, temperature=temperature)
 
-# LLMにメッセージを送信して応答を取得する関数
-def query_llm(state: ChatState):
-    """現在のモデルを使用してLLMに問い合わせを行う"""
-    current_model = state["current_model"]
-    llm = get_llm(current_model)
-    
-    # メッセージ履歴を準備
+# ストリーミングのチャンクからテキストを取り出す関数
+def chunk_text(chunk) -> str:
+    """チャンクのコンテンツ（文字列またはコンテンツブロックのリスト）をテキストにする"""
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in content
+    )
+
+# 応答のメタデータからトークン数を取り出す関数
+def usage_tokens(response) -> Dict[str, Optional[int]]:
+    """usage_metadataから入力・出力トークン数を取得する（取得できない場合はNone）"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    return {"input_tokens": usage.get("input_tokens"), "output_tokens": usage.get("output_tokens")}
+
+# ステートからLLMに送信するメッセージを作成する関数
+def build_llm_messages(state: ChatState) -> List:
+    """システムメッセージと会話履歴をLangChainのメッセージに変換する"""
     messages = []
     
     # システムメッセージがあれば追加
@@ -51,82 +110,445 @@ def query_llm(state: ChatState):
             messages.append(HumanMessage(content=msg["content"]))
         elif msg["role"] == "ai":
             messages.append(AIMessage(content=msg["content"]))
+    return messages
+
+# 履歴から作成したLangChainのメッセージを増分で保持するクラス
+class LLMMessageCache:
+    """ステートの会話履歴に対応するLangChainメッセージ列を追記型で保持する
+    
+    新しく増えたメッセージだけを変換するため、ターンごとの準備は償却O(1)となる。
+    システムメッセージが変わった場合や、履歴が編集された場合にのみ作り直す。
+    """
     
-    # LLMに問い合わせ
-    response = llm.invoke(messages)
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """キャッシュを破棄する"""
+        self._messages = []
+        self._system_message = None
+        self._converted = 0
+        self._last_source = None
     
-    # 応答をステートに追加
-    new_messages = state["messages"].copy()
-    new_messages.append({
-        "role": "ai",
-        "content": response.content,
-        "model": current_model
-    })
+    def _is_valid(self, state: ChatState) -> bool:
+        """キャッシュがステートの履歴の接頭辞と一致しているかを確認する"""
+        history = state["messages"]
+        if state["system_message"] is not self._system_message or len(history) < self._converted:
+            return False
+        # 最後に変換したメッセージが同じオブジェクトであれば、履歴は追記のみとみなす
+        return self._converted == 0 or history[self._converted - 1] is self._last_source
     
-    return {"messages": new_messages, "current_model": current_model, "system_message": state["system_message"]}
+    def build(self, state: ChatState) -> List:
+        """ステートに対応するメッセージ列を返す（返すリストを変更しないこと）"""
+        if not self._is_valid(state):
+            self.reset()
+            self._system_message = state["system_message"]
+            if self._system_message:
+                self._messages.append(SystemMessage(content=self._system_message))
+        
+        history = state["messages"]
+        for msg in history[self._converted:]:
+            if msg["role"] == "human":
+                self._messages.append(HumanMessage(content=msg["content"]))
+            elif msg["role"] == "ai":
+                self._messages.append(AIMessage(content=msg["content"]))
+        if len(history) > self._converted:
+            self._converted = len(history)
+            self._last_source = history[-1]
+        return self._messages
 
 # ユーザー入力を処理する関数
 def process_user_input(state: ChatState, user_input: str):
-    """ユーザー入力をメッセージリストに追加"""
-    new_messages = state["messages"].copy()
-    new_messages.append({"role": "human", "content": user_input})
-    
-    return {"messages": new_messages, "current_model": state["current_model"], "system_message": state["system_message"]}
+    """ユーザー入力を追加する差分を返す"""
+    return {"messages": [MessageRecord("human", user_input)]}
 
 # モデルを切り替える関数
 def switch_model(state: ChatState, model: ModelType):
-    """使用するLLMモデルを切り替える"""
-    return {"messages": state["messages"], "current_model": model, "system_message": state["system_message"]}
+    """使用するLLMモデルを切り替える差分を返す"""
+    return {"current_model": model}
 
 # システムメッセージを設定する関数
 def set_system_message(state: ChatState, system_message: str):
-    """システムメッセージを設定"""
-    return {"messages": state["messages"], "current_model": state["current_model"], "system_message": system_message}
-
-# langgraphのワークフローを定義
-def build_chat_graph():
-    # 状態グラフの作成
-    builder = StateGraph(ChatState)
-    
-    # ノードの定義
-    builder.add_node("process_input", process_user_input)
-    builder.add_node("query_llm", query_llm)
-    builder.add_node("switch_model", switch_model)
-    builder.add_node("set_system", set_system_message)
-    
-    # エッジの定義
-    builder.add_edge(START, "process_input")
-    builder.add_edge("process_input", "query_llm")
-    builder.add_edge("query_llm", END)
-    builder.add_edge("switch_model", END)
-    builder.add_edge("set_system", END)
-    
-    # グラフの構築
-    return builder.compile()
+    """システムメッセージを設定する差分を返す"""
+    return {"system_message": system_message}
 
 # チャットアプリケーションクラス
 class MultiModelChatApp:
-    def __init__(self):
-        self.graph = build_chat_graph()
+    def __init__(self, context_budgets: Optional[Dict[str, int]] = None, response_cache=None,
+                 temperature: float = 0.7, fallback_models: Optional[List[ModelType]] = None,
+                 retry_policy: Optional[RetryPolicy] = None, hedge_policy: Optional[HedgePolicy] = None,
+                 session_id: Optional[str] = None, checkpointer=None):
+        # レート制限の受付キューでセッションを区別するためのID（チェックポインタのスレッドIDも兼ねる）
+        self.session_id = session_id or str(uuid.uuid4())
         self.state = {
             "messages": [],
             "current_model": "gpt-4o",  # デフォルトモデル
             "system_message": None
         }
+        # ステートの差分の保存先（checkpoint.pyのMemoryCheckpointer・SQLiteCheckpointer。指定した場合のみ）
+        # 保存済みのスレッドであれば、その会話から再開し、なければスレッドを登録する
+        # （削除されたスレッドには保存されない）。ターンの保存は応答を受け取った時点で1回にまとめる
+        self.checkpointer = checkpointer
+        if checkpointer is not None:
+            saved = checkpointer.load(self.session_id)
+            if saved is None:
+                checkpointer.put_info(self.session_id, created_at=time.time())
+            self.state.update(saved or {})
+        self._message_cache = LLMMessageCache()
+        # モデルごとのトークン予算（指定があればデフォルトを上書き）
+        self.context_budgets = {**CONTEXT_BUDGETS, **(context_budgets or {})}
+        self._context_window = ContextWindow()
+        # 応答キャッシュのキーに使う履歴のハッシュ（増分で更新される）
+        self._history_digest = HistoryDigest()
+        self.temperature = temperature
+        # 応答キャッシュ（指定された場合のみ使用。cache_bypassをTrueにするとこのセッションでは使わない）
+        self.response_cache = response_cache
+        self.cache_bypass = False
+        # 現在のモデルが応答できない場合に順に試すモデルと、再試行・サーキットブレーカー
+        for fallback in fallback_models or []:
+            if fallback not in MODEL_SPECS:
+                raise ValueError(f"不明なモデルタイプ: {fallback}")
+        self.fallback_models = list(fallback_models or [])
+        self.resilience = ResilientCaller(retry_policy)
+        # ヘッジリクエスト（hedge_policyを指定した場合のみ使用）
+        self.hedger = Hedger(self.resilience)
+        self.hedge_policy = hedge_policy
+    
+    def _windowed_messages(self, budget: int) -> List:
+        """システムメッセージと、予算に収まる最新の履歴だけをLLM用メッセージとして返す"""
+        messages = self._message_cache.build(self.state)
+        start = self._context_window.select(self.state["messages"], budget, self.state["system_message"])
+        if start == 0:
+            return messages
+        offset = 1 if self.state["system_message"] else 0
+        return messages[:offset] + messages[offset + start:]
+    
+    def _candidate(self, model: ModelType) -> Candidate:
+        """モデルを問い合わせの候補にする（メッセージは試す時点でモデルの予算に合わせて作成する）"""
+        return Candidate(
+            model,
+            MODEL_SPECS[model][0],
+            lambda: (get_llm(model, self.temperature), self._windowed_messages(self.context_budgets[model])),
+            # 直前のprepareで選択した範囲のトークン数（メッセージごとにキャッシュ済み）
+            lambda: self._context_window.total + self._context_window.system_tokens(self.state["system_message"]),
+        )
+    
+    def _hedge_legs(self, current_model: ModelType, candidates: List[Candidate]):
+        """ヘッジする場合は (主モデル側の候補, 副モデルの候補) を返す（しない場合はNone）"""
+        if self.hedge_policy is None or self.hedge_policy.secondary == current_model:
+            return None
+        secondary = self.hedge_policy.secondary
+        return [c for c in candidates if c.model_type != secondary], [self._candidate(secondary)]
+    
+    def _invoke(self, current_model: ModelType, candidates: List[Candidate], trace) -> Tuple[ModelType, str]:
+        """候補に問い合わせ、(応答したモデル, 応答のテキスト) を返す（トークン数はtraceに記録する）"""
+        legs = self._hedge_legs(current_model, candidates)
+        if legs:
+            model, chunks = self.hedger.invoke(self.hedge_policy, *legs, session_id=self.session_id)
+        else:
+            model, response = self.resilience.invoke(candidates, self.session_id)
+            chunks = [response]
+        for chunk in chunks:
+            trace.add_usage(chunk.usage_metadata)
+        return model, "".join(chunk_text(chunk) for chunk in chunks)
+    
+    async def _ainvoke(self, current_model: ModelType, candidates: List[Candidate], trace) -> Tuple[ModelType, str]:
+        """_invokeの非同期版"""
+        legs = self._hedge_legs(current_model, candidates)
+        if legs:
+            model, chunks = await self.hedger.ainvoke(self.hedge_policy, *legs, session_id=self.session_id)
+        else:
+            model, response = await self.resilience.ainvoke(candidates, self.session_id)
+            chunks = [response]
+        for chunk in chunks:
+            trace.add_usage(chunk.usage_metadata)
+        return model, "".join(chunk_text(chunk) for chunk in chunks)
+    
+    def _stream(self, current_model: ModelType, candidates: List[Candidate]) -> Iterator[Tuple[ModelType, Any]]:
+        """候補に問い合わせ、(応答したモデル, チャンク) を順に返す"""
+        legs = self._hedge_legs(current_model, candidates)
+        if legs:
+            return self.hedger.stream(self.hedge_policy, *legs, session_id=self.session_id)
+        return self.resilience.stream(candidates, self.session_id)
+    
+    def _astream(self, current_model: ModelType, candidates: List[Candidate]) -> AsyncIterator[Tuple[ModelType, Any]]:
+        """_streamの非同期版"""
+        legs = self._hedge_legs(current_model, candidates)
+        if legs:
+            return self.hedger.astream(self.hedge_policy, *legs, session_id=self.session_id)
+        return self.resilience.astream(candidates, self.session_id)
+    
+    def _start_turn(self, user_input: str, kind: str = "chat"):
+        """ユーザー入力を履歴に追加し、現在のモデルと問い合わせる候補（現在のモデル→フォールバック先）、ターンの計測を準備
+        
+        メッセージの作成（prepare）はprepの区間として計測する。
+        """
+        trace = metrics.start(kind)
+        # 保存は応答と合わせて_finish_turnで行う
+        apply_update(self.state, process_user_input(self.state, user_input))
+        current_model = self.state["current_model"]
+        models = [current_model, *(m for m in self.fallback_models if m != current_model)]
+        candidates = [self._candidate(model) for model in models]
+        return current_model, [c._replace(prepare=trace.timed("prep", c.prepare)) for c in candidates], trace
+    
+    def _cached_reply(self, current_model: ModelType) -> Tuple[Optional[str], Optional[str]]:
+        """応答キャッシュを引き、(キー, キャッシュされた応答) を返す（キャッシュを使わない場合のキーはNone）"""
+        if self.response_cache is None or self.cache_bypass:
+            return None, None
+        key = self.response_cache.make_key(
+            current_model, self.temperature, self.state["system_message"], self.state["messages"],
+            self._history_digest,
+        )
+        return key, self.response_cache.get(key)
+    
+    def _end_turn(self, current_model: ModelType, chunks: List[str], trace=None, status: str = "ok") -> Dict[str, Any]:
+        """応答をステートに追加してターンの計測を終え、保存する差分（ユーザー入力と応答）を返す
+        
+        中断された場合も受信済みの部分を残す。応答を1文字も受け取れずに失敗した場合は、
+        再試行でユーザーのメッセージが2件続かないよう、ユーザー入力も履歴から取り除く（何も保存しない）。
+        """
+        if not chunks and status == "error":
+            self.state["messages"].pop()
+            if trace is not None:
+                trace.finish(current_model, status)
+            return {}
+        turn = [self.state["messages"][-1]]
+        if chunks:
+            reply = MessageRecord("ai", "".join(chunks), current_model)
+            apply_update(self.state, {"messages": [reply]})
+            turn.append(reply)
+        if trace is not None:
+            trace.finish(current_model, status)
+        return {"messages": turn}
+    
+    def _finish_turn(self, current_model: ModelType, chunks: List[str], trace=None, status: str = "ok"):
+        """ターンを終え、ユーザー入力と応答を1回の書き込みでチェックポインタに保存する"""
+        self._save(self._end_turn(current_model, chunks, trace, status))
+    
+    async def _afinish_turn(self, current_model: ModelType, chunks: List[str], trace=None, status: str = "ok"):
+        """_finish_turnの非同期版（保存はスレッドで行い、イベントループを止めない）"""
+        await self._asave(self._end_turn(current_model, chunks, trace, status))
+    
+    def _save(self, update: Dict[str, Any]):
+        """差分をチェックポインタに保存する"""
+        if self.checkpointer is not None and update:
+            self.checkpointer.put(self.session_id, update)
+    
+    async def _asave(self, update: Dict[str, Any]):
+        """_saveの非同期版（SQLiteへの書き込みでイベントループを止めないよう、スレッドで保存する）"""
+        if self.checkpointer is not None and update:
+            await asyncio.to_thread(self.checkpointer.put, self.session_id, update)
+    
+    def _apply(self, update: Dict[str, Any]):
+        """差分をステートに反映し、チェックポインタに保存する"""
+        apply_update(self.state, update)
+        self._save(update)
+    
+    def _store_reply(self, cache_key: Optional[str], current_model: ModelType, model: Optional[ModelType],
+                     response: str):
+        """現在のモデルが最後まで返した応答だけをキャッシュする（フォールバック先の応答は保存しない）"""
+        if cache_key and model == current_model:
+            self.response_cache.put(cache_key, response)
+    
+    def breaker_states(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダごとのサーキットブレーカーの状態を取得"""
+        return self.resilience.breakers.snapshot()
+    
+    def set_hedging(self, secondary: Optional[ModelType], percentile: float = 95.0):
+        """ヘッジリクエストを有効にする（secondaryにNoneを指定すると無効にする）
+        
+        現在のモデルの過去のレイテンシのpercentileパーセンタイルを過ぎても応答がなければ、
+        secondaryのモデルにも問い合わせて先に応答した方を採用する。
+        """
+        if secondary is not None and secondary not in MODEL_SPECS:
+            raise ValueError(f"不明なモデルタイプ: {secondary}")
+        self.hedge_policy = HedgePolicy(secondary, percentile) if secondary else None
+    
+    def rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダごとのレート制限の受付キューの長さ・待ち時間を取得（プロセス全体で共有）"""
+        return self.resilience.limiters.stats()
+    
+    def hedge_stats(self) -> Dict[str, Any]:
+        """ヘッジの発動回数・副モデルが採用された回数・短縮できた時間の見込みを取得"""
+        return self.hedger.stats()
+    
+    def stream(self, user_input: str) -> Iterator[str]:
+        """ユーザー入力に対する応答をチャンク単位で生成
+        
+        ストリームが完了または中断した時点で、受信済みのテキストを応答したモデル名付きで履歴に追加する。
+        どのモデルからも応答を得られなかった場合はAllModelsFailedErrorを送出する（ユーザー入力も履歴から取り除く）。
+        """
+        current_model, candidates, trace = self._start_turn(user_input, "stream")
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(current_model)
+        if cached is not None:
+            trace.first_token()
+            self._finish_turn(current_model, [cached], trace, "cached")
+            yield cached
+            return
+        
+        chunks = []
+        model = None
+        status = "error"
+        try:
+            # 呼び出し側がチャンクを表示している間はconsumerの区間として、プロバイダの時間から除く
+            with trace.span("provider"):
+                for model, chunk in self._stream(current_model, candidates):
+                    trace.add_usage(chunk.usage_metadata)
+                    text = chunk_text(chunk)
+                    if text:
+                        trace.first_token()
+                        chunks.append(text)
+                        with trace.span("consumer"):
+                            yield text
+            self._store_reply(cache_key, current_model, model, "".join(chunks))
+            status = "ok"
+        finally:
+            self._finish_turn(model, chunks, trace, status)
+    
+    async def astream(self, user_input: str) -> AsyncIterator[str]:
+        """streamの非同期版（プロバイダのastreamを使用）"""
+        current_model, candidates, trace = self._start_turn(user_input, "astream")
+        
+        # キャッシュにあれば、通常のAIの応答として履歴に追加して返す
+        cache_key, cached = self._cached_reply(current_model)
+        if cached is not None:
+            trace.first_token()
+            await self._afinish_turn(current_model, [cached], trace, "cached")
+            yield cached
+            return
+        
+        chunks = []
+        model = None
+        status = "error"
+        try:
+            # 呼び出し側がチャンクを表示している間はconsumerの区間として、プロバイダの時間から除く
+            with trace.span("provider"):
+                async for model, chunk in self._astream(current_model, candidates):
+                    trace.add_usage(chunk.usage_metadata)
+                    text = chunk_text(chunk)
+                    if text:
+                        trace.first_token()
+                        chunks.append(text)
+                        with trace.span("consumer"):
+                            yield text
+            self._store_reply(cache_key, current_model, model, "".join(chunks))
+            status = "ok"
+        finally:
+            await self._afinish_turn(model, chunks, trace, status)
     
     def chat(self, user_input: str):
-        """ユーザー入力に対する応答を生成"""
-        self.state = self.graph.invoke("process_input", {"user_input": user_input}, self.state)
-        return self.state["messages"][-1]["content"]
+        """ユーザー入力に対する応答を生成（応答を得られなかった場合はユーザー入力を履歴に残さない）"""
+        current_model, candidates, trace = self._start_turn(user_input, "chat")
+        cache_key, response = self._cached_reply(current_model)
+        model = current_model
+        status = "cached"
+        if response is None:
+            try:
+                with trace.span("provider"):
+                    model, response = self._invoke(current_model, candidates, trace)
+            except Exception:
+                self._end_turn(current_model, [], trace, "error")
+                raise
+            self._store_reply(cache_key, current_model, model, response)
+            status = "ok"
+        trace.first_token()
+        self._finish_turn(model, [response], trace, status)
+        return response
+    
+    async def achat(self, user_input: str):
+        """chatの非同期版（プロバイダのainvokeを使用）"""
+        current_model, candidates, trace = self._start_turn(user_input, "achat")
+        cache_key, response = self._cached_reply(current_model)
+        model = current_model
+        status = "cached"
+        if response is None:
+            try:
+                with trace.span("provider"):
+                    model, response = await self._ainvoke(current_model, candidates, trace)
+            except Exception:
+                self._end_turn(current_model, [], trace, "error")
+                raise
+            self._store_reply(cache_key, current_model, model, response)
+            status = "ok"
+        trace.first_token()
+        await self._afinish_turn(model, [response], trace, status)
+        return response
+    
+    def _compare_one(self, model: ModelType, messages: List) -> CompareResult:
+        """比較モードで1つのモデルに問い合わせる"""
+        start = time.perf_counter()
+        trace = metrics.start("compare")
+        try:
+            with trace.span("provider"):
+                _, response = self.resilience.invoke(
+                    [Candidate(model, MODEL_SPECS[model][0], lambda: (get_llm(model, self.temperature), messages))], self.session_id
+                )
+            trace.first_token()
+            trace.add_usage(response.usage_metadata)
+            trace.finish(model)
+            return {"model": model, "content": chunk_text(response), "latency": time.perf_counter() - start,
+                    **usage_tokens(response), "error": None}
+        except Exception as e:
+            trace.finish(model, "error")
+            return {"model": model, "content": "", "latency": time.perf_counter() - start,
+                    "input_tokens": None, "output_tokens": None, "error": str(e)}
+    
+    async def _acompare_one(self, model: ModelType, messages: List) -> CompareResult:
+        """_compare_oneの非同期版"""
+        start = time.perf_counter()
+        trace = metrics.start("compare")
+        try:
+            with trace.span("provider"):
+                _, response = await self.resilience.ainvoke(
+                    [Candidate(model, MODEL_SPECS[model][0], lambda: (get_llm(model, self.temperature), messages))], self.session_id
+                )
+            trace.first_token()
+            trace.add_usage(response.usage_metadata)
+            trace.finish(model)
+            return {"model": model, "content": chunk_text(response), "latency": time.perf_counter() - start,
+                    **usage_tokens(response), "error": None}
+        except Exception as e:
+            trace.finish(model, "error")
+            return {"model": model, "content": "", "latency": time.perf_counter() - start,
+                    "input_tokens": None, "output_tokens": None, "error": str(e)}
+    
+    def _compare_messages(self, user_input: str, models: List[ModelType]) -> List:
+        """比較モードで送信するメッセージを作成する（ユーザー入力を含めて、最も小さいモデルの予算に収める）"""
+        budget = min(self.context_budgets[model] for model in models) if models else 0
+        budget -= self._context_window.counter(user_input) + MESSAGE_OVERHEAD_TOKENS
+        return self._windowed_messages(max(budget, 0)) + [HumanMessage(content=user_input)]
+    
+    def compare(self, user_input: str, models: List[ModelType]) -> List[CompareResult]:
+        """同じ入力と履歴を複数のモデルに並行して送信し、結果を並べて返す
+        
+        履歴は変更しない。採用する回答はcommit_comparisonで確定する。
+        """
+        messages = self._compare_messages(user_input, models)
+        with ThreadPoolExecutor(max_workers=max(len(models), 1)) as executor:
+            return list(executor.map(lambda model: self._compare_one(model, messages), models))
+    
+    async def acompare(self, user_input: str, models: List[ModelType]) -> List[CompareResult]:
+        """compareの非同期版"""
+        messages = self._compare_messages(user_input, models)
+        return list(await asyncio.gather(*(self._acompare_one(model, messages) for model in models)))
+    
+    def commit_comparison(self, user_input: str, result: CompareResult):
+        """比較結果から選んだ回答を、モデル名付きで履歴に確定する（失敗した・空の結果はValueError）"""
+        if result["error"] or not result["content"]:
+            raise ValueError(f"{result['model']} の比較結果は応答を含まないため採用できません")
+        apply_update(self.state, process_user_input(self.state, user_input))
+        self._finish_turn(result["model"], [result["content"]])
     
     def change_model(self, model: ModelType):
         """使用するモデルを変更"""
-        self.state = self.graph.invoke("switch_model", {"model": model}, self.state)
+        self._apply(switch_model(self.state, model))
         return f"モデルを {model} に切り替えました"
     
     def set_system_prompt(self, system_prompt: str):
         """システムプロンプトを設定"""
-        self.state = self.graph.invoke("set_system", {"system_message": system_prompt}, self.state)
+        self._apply(set_system_message(self.state, system_prompt))
         return "システムプロンプトを設定しました"
     
     def get_current_model(self):
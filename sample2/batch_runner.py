@@ -0,0 +1,293 @@
+"""
+JSONLファイルの会話をまとめてモデルに問い合わせるバッチ実行（夜間の回帰用プロンプトなど）
+
+入力は1行1件のJSONで、次の形式とする（modelを省略すると--modelのモデルを使う）:
+
+    {"id": "q1", "model": "gpt-4o", "system": "...",
+     "history": [{"role": "human", "content": "..."}, {"role": "ai", "content": "..."}],
+     "prompt": "..."}
+
+historyの代わりにmessagesも使え、ロールはhuman/ai/systemのほかuser/assistantも受け付ける。
+入力は1行ずつ読み、同じモデルの会話をbatch_size件ずつプロバイダのabatchに渡す。
+会話ごとにプロバイダのレート制限（llm_common/rate_limit.py）の枠を確保してから問い合わせ、
+429・5xxなどの再試行できる失敗はRetryPolicyに従って待ってから、失敗した会話だけを再び問い合わせる。
+結果は終わった順に1行1件のJSONとして出力ファイルに追記する（入力の順序は保たない）。
+
+出力ファイルに成功した結果があるidは読み飛ばすため、途中で止まっても同じコマンドで再開できる
+（失敗した会話は次の実行で再び問い合わせる）。idを省略した行は行番号をidとする。
+
+使い方:
+    python batch_runner.py prompts.jsonl results.jsonl --model gpt-4o --concurrency 32
+    python batch_runner.py prompts.jsonl results.jsonl --fake-latency 0.05   # 偽のプロバイダで試す
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from llm_common.rate_limit import EXPECTED_OUTPUT_TOKENS, AdmissionTimeoutError, limiters
+from llm_common.resilience import RetryPolicy, estimate_prompt_tokens, is_retryable, usage_total
+
+from backend import MODEL_SPECS, chunk_text, get_llm, usage_tokens
+
+# 入力のロール -> LangChainのメッセージクラス
+ROLE_TYPES = {
+    "human": HumanMessage,
+    "user": HumanMessage,
+    "ai": AIMessage,
+    "assistant": AIMessage,
+    "system": SystemMessage,
+}
+
+# レート制限の受付キューでバッチ実行を区別するID（対話のセッションと順番に通される）
+BATCH_SESSION_ID = "batch"
+
+# レート制限の枠が空くのを待つ秒数の上限（対話と違い、待たせても構わない）
+ADMISSION_TIMEOUT = 600.0
+
+
+def load_completed(output_path: str) -> Set[str]:
+    """出力ファイルから成功した結果のidを集める（1行ずつ読み、idだけを保持する）
+
+    書き込み途中で止まった末尾の不完全な行は切り詰める。
+    """
+    completed: Set[str] = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "rb+") as f:
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("error") is None and "id" in record:
+                completed.add(str(record["id"]))
+        f.truncate(end)
+    return completed
+
+
+def read_items(input_path: str) -> Iterator[Tuple[str, Any]]:
+    """入力を1行ずつ読み、(id, 会話) を返す
+
+    JSONとして読めない行は会話の代わりに例外を返す。オブジェクトでない行（配列など）は
+    そのまま返し、BatchRunner.addで失敗として書き込む。
+    """
+    with open(input_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                yield str(line_number), e
+                continue
+            item_id = item.get("id", line_number) if isinstance(item, dict) else line_number
+            yield str(item_id), item
+
+
+def to_llm_messages(item: Dict[str, Any]) -> List:
+    """入力の1件をLLMに送信するメッセージにする"""
+    messages = []
+    if item.get("system"):
+        messages.append(SystemMessage(content=item["system"]))
+    for message in item.get("history") or item.get("messages") or []:
+        role = message["role"]
+        if role not in ROLE_TYPES:
+            raise ValueError(f"不明なロール: {role}")
+        messages.append(ROLE_TYPES[role](content=message["content"]))
+    if item.get("prompt"):
+        messages.append(HumanMessage(content=item["prompt"]))
+    if not messages:
+        raise ValueError("メッセージがありません")
+    return messages
+
+
+class BatchRunner:
+    """同じモデルの会話をまとめてabatchに渡し、結果を出力ファイルに追記する
+
+    同時に問い合わせる会話はconcurrency件まで（batch_size件ずつのバッチを
+    concurrency // batch_size個まで並行に実行する）。メモリに保持するのは
+    モデルごとに溜めている途中のバッチと実行中のバッチだけで、入力の件数によらない。
+    """
+
+    def __init__(self, output, model: Optional[str] = None, temperature: float = 0.7,
+                 concurrency: int = 32, batch_size: int = 8, retry_policy: Optional[RetryPolicy] = None,
+                 rate_limiters=None, admission_timeout: float = ADMISSION_TIMEOUT):
+        self.output = output
+        self.model = model
+        self.temperature = temperature
+        self.batch_size = max(1, min(batch_size, concurrency))
+        self.max_batches = max(1, concurrency // self.batch_size)
+        # 再試行の設定と、対話のセッションと共有するレート制限
+        self.policy = retry_policy or RetryPolicy()
+        self.limiters = rate_limiters or limiters
+        self.admission_timeout = admission_timeout
+        self._buffers: Dict[str, List[Tuple[str, List]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {"succeeded": 0, "failed": 0, "skipped": 0, "retried": 0}
+
+    def _write(self, record: Dict[str, Any]):
+        self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _fail(self, item_id: str, model: Optional[str], error: BaseException):
+        self._write({"id": item_id, "model": model, "content": None, "error": f"{type(error).__name__}: {error}"})
+        self.stats["failed"] += 1
+
+    async def add(self, item_id: str, item: Any):
+        """会話を1件追加する（モデルごとのバッチがbatch_size件に達したら実行する）"""
+        model = self.model
+        try:
+            if isinstance(item, Exception):
+                raise item
+            if not isinstance(item, dict):
+                raise ValueError(f"会話はJSONのオブジェクトで指定してください（{type(item).__name__}）")
+            model = item.get("model") or self.model
+            if not model:
+                raise ValueError("モデルが指定されていません")
+            messages = to_llm_messages(item)
+        except Exception as e:
+            self._fail(item_id, model, e)
+            return
+        buffer = self._buffers.setdefault(model, [])
+        buffer.append((item_id, messages))
+        if len(buffer) >= self.batch_size:
+            await self._submit(model, self._buffers.pop(model))
+
+    async def _submit(self, model: str, batch: List[Tuple[str, List]]):
+        """実行中のバッチが上限に達していれば1つ終わるまで待ってから、バッチを開始する"""
+        while len(self._tasks) >= self.max_batches:
+            done, self._tasks = await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        self._tasks.add(asyncio.create_task(self._run(model, batch)))
+
+    async def _admit(self, limiter, model: str, batch: List[Tuple[str, List]]):
+        """会話ごとにレート制限の枠を確保し、(確保できた会話, 枠) を返す（確保できなかった会話は失敗にする）"""
+        admitted, grants = [], []
+        for item_id, messages in batch:
+            tokens = estimate_prompt_tokens(messages) + EXPECTED_OUTPUT_TOKENS
+            try:
+                grants.append(await limiter.aacquire(BATCH_SESSION_ID, tokens, self.admission_timeout))
+            except AdmissionTimeoutError as e:
+                self._fail(item_id, model, e)
+                continue
+            admitted.append((item_id, messages))
+        return admitted, grants
+
+    async def _run(self, model: str, batch: List[Tuple[str, List]]):
+        """1バッチを問い合わせて結果を書き込む
+
+        再試行できる失敗はその会話だけを集めて再び問い合わせ、試行回数を使い切った会話や
+        再試行できない失敗は例外の内容を書き込む。
+        """
+        start = time.perf_counter()
+        try:
+            llm = get_llm(model, self.temperature)
+            limiter = self.limiters.get(MODEL_SPECS[model][0])
+        except Exception as e:
+            for item_id, _ in batch:
+                self._fail(item_id, model, e)
+            self.output.flush()
+            return
+
+        for attempt in range(self.policy.max_attempts):
+            admitted, grants = await self._admit(limiter, model, batch)
+            try:
+                responses = await llm.abatch(
+                    [messages for _, messages in admitted],
+                    config={"max_concurrency": self.batch_size},
+                    return_exceptions=True,
+                )
+            except Exception as e:
+                responses = [e] * len(admitted)
+            elapsed = round(time.perf_counter() - start, 3)
+            retry = []
+            for (item_id, messages), grant, response in zip(admitted, grants, responses):
+                # 失敗した会話の枠は見積もりをすべて返す
+                failed = isinstance(response, BaseException)
+                limiter.settle(grant, 0 if failed else usage_total(response.usage_metadata))
+                if failed:
+                    if is_retryable(response) and attempt + 1 < self.policy.max_attempts:
+                        retry.append((item_id, messages))
+                    else:
+                        self._fail(item_id, model, response)
+                    continue
+                self._write({"id": item_id, "model": model, "content": chunk_text(response),
+                             **usage_tokens(response), "batch_seconds": elapsed, "error": None})
+                self.stats["succeeded"] += 1
+            self.output.flush()
+            if not retry:
+                return
+            self.stats["retried"] += len(retry)
+            await asyncio.sleep(self.policy.delay(attempt))
+            batch = retry
+
+    async def finish(self):
+        """溜めている途中のバッチを実行し、すべてのバッチの終了を待つ"""
+        for model in list(self._buffers):
+            await self._submit(model, self._buffers.pop(model))
+        if self._tasks:
+            for result in await asyncio.gather(*self._tasks, return_exceptions=True):
+                if isinstance(result, BaseException):
+                    raise result
+            self._tasks.clear()
+        self.output.flush()
+
+
+async def run(input_path: str, output_path: str, model: Optional[str] = None, temperature: float = 0.7,
+              concurrency: int = 32, batch_size: int = 8, resume: bool = True,
+              max_attempts: int = 3) -> Dict[str, Any]:
+    """入力ファイルの会話をすべて問い合わせ、件数と所要時間を返す"""
+    completed = load_completed(output_path) if resume else set()
+    start = time.perf_counter()
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as output:
+        runner = BatchRunner(output, model, temperature, concurrency, batch_size,
+                             retry_policy=RetryPolicy(max_attempts=max_attempts))
+        for item_id, item in read_items(input_path):
+            # 成功済みのidと、入力内で重複したidは読み飛ばす
+            if item_id in completed:
+                runner.stats["skipped"] += 1
+                continue
+            completed.add(item_id)
+            await runner.add(item_id, item)
+        await runner.finish()
+    elapsed = time.perf_counter() - start
+    processed = runner.stats["succeeded"] + runner.stats["failed"]
+    return {**runner.stats, "seconds": round(elapsed, 2),
+            "items_per_sec": round(processed / elapsed, 1) if elapsed else 0.0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSONLの会話をまとめてモデルに問い合わせる")
+    parser.add_argument("input", help="入力のJSONLファイル")
+    parser.add_argument("output", help="結果を追記するJSONLファイル（成功済みのidは読み飛ばす）")
+    parser.add_argument("--model", help="入力にmodelがない会話に使うモデルタイプ")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に問い合わせる会話数の上限")
+    parser.add_argument("--batch-size", type=int, default=8, help="1回のabatchに渡す会話数")
+    parser.add_argument("--no-resume", action="store_true", help="出力ファイルを作り直し、すべての会話を問い合わせる")
+    parser.add_argument("--max-attempts", type=int, default=3, help="会話ごとの最大試行回数（429・5xxなどで再試行する）")
+    parser.add_argument("--rate-limits", help="プロバイダごとのレート制限（例: openai=500:30000,google=1000:1000000）")
+    parser.add_argument("--fake-latency", type=float, help="偽のプロバイダ（llm_common/fake_llm.py）で応答する（動作確認用）")
+    args = parser.parse_args()
+
+    if args.rate_limits:
+        limiters.configure_from_spec(args.rate_limits)
+    if args.fake_latency is not None:
+        from llm_common import fake_llm
+        from llm_common.llm_registry import registry
+        fake_llm.install(registry, latency=args.fake_latency)
+
+    result = asyncio.run(run(args.input, args.output, args.model, args.temperature,
+                             args.concurrency, args.batch_size, not args.no_resume, args.max_attempts))
+    print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
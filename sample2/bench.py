@@ -0,0 +1,213 @@
+"""
+MultiModelChatAppのベンチマーク（ネットワーク不要）
+
+LLMへの問い合わせは偽のプロバイダ（llm_common/fake_llm.py）に差し替えるため、計測値から
+プロバイダの待ち時間を除いたバックエンド側の時間を求められる。結果はJSONで出力し、
+--outputを指定すると1行1件のJSONLとして追記する（回帰の追跡用）。
+
+使い方:
+    python bench.py turns --sizes 10 100 1000 10000
+    python bench.py concurrency --latency 0.05 --output bench_results.jsonl
+    python bench.py sessions --sessions 1000
+"""
+
+import argparse
+import inspect
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from llm_common import fake_llm
+from llm_common.llm_registry import registry
+from llm_common.message_record import MessageRecord
+from llm_common.rate_limit import limiters
+
+from backend import MODEL_SPECS, MultiModelChatApp
+from session_manager import AsyncChatSessionManager
+
+
+def _percentile(values, p: float) -> float:
+    """pパーセンタイル（ミリ秒、小数2桁）"""
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2) if values else 0.0
+
+
+def _install_fake(latency: float, tokens_per_second) -> fake_llm.FakeProvider:
+    """偽のプロバイダに差し替え、レート制限で計測が待たされないよう上限を外す"""
+    fake = fake_llm.install(registry, latency=latency, tokens_per_second=tokens_per_second)
+    for provider, _ in MODEL_SPECS.values():
+        limiters.configure(provider, 1e9, 1e12)
+    return fake
+
+
+def _prefill(app: MultiModelChatApp, history: int):
+    """history件の履歴を入れる（ユーザーと現在のモデルの応答を交互に）"""
+    model = app.get_current_model()
+    for i in range(history):
+        if i % 2 == 0:
+            app.state["messages"].append(MessageRecord("human", f"メッセージ {i} " * 20))
+        else:
+            app.state["messages"].append(MessageRecord("ai", f"メッセージ {i} " * 20, model))
+
+
+def bench_turns(sizes=(10, 100, 1000, 10000), turns: int = 50, latency: float = 0.0, tokens_per_second=None):
+    """履歴の長さごとに、1ターンあたりの時間・バックエンド側の時間・メモリ・スループットを計測する
+
+    overheadはターンの所要時間から偽のプロバイダの待ち時間を引いたもの。
+    """
+    fake = _install_fake(latency, tokens_per_second)
+    results = []
+    for size in sizes:
+        app = MultiModelChatApp()
+        _prefill(app, size)
+        app.chat("ウォームアップ")
+        row = {"history": size}
+        for mode in ("chat", "stream"):
+            elapsed, overhead = [], []
+            for i in range(turns):
+                simulated = fake.simulated_seconds
+                start = time.perf_counter()
+                if mode == "chat":
+                    app.chat(f"質問 {i}")
+                else:
+                    for _ in app.stream(f"質問 {i}"):
+                        pass
+                elapsed.append(time.perf_counter() - start)
+                overhead.append(elapsed[-1] - (fake.simulated_seconds - simulated))
+            row[f"{mode}_ms_p50"] = _percentile(elapsed, 50)
+            row[f"{mode}_ms_p95"] = _percentile(elapsed, 95)
+            row[f"{mode}_overhead_ms_p50"] = _percentile(overhead, 50)
+            row[f"{mode}_overhead_ms_p95"] = _percentile(overhead, 95)
+            row[f"{mode}_turns_per_sec"] = round(turns / sum(elapsed), 1)
+
+        # 履歴を保持するためのメモリと、1ターンで一時的に確保されるメモリ
+        tracemalloc.start()
+        app = MultiModelChatApp()
+        _prefill(app, size)
+        row["history_bytes"] = tracemalloc.get_traced_memory()[0]
+        app.chat("ウォームアップ")
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        app.chat("計測")
+        row["turn_peak_bytes"] = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        results.append(row)
+    return results
+
+
+def bench_concurrency(levels=(1, 8, 64, 256), turns: int = 5, history: int = 100,
+                      latency: float = 0.05, tokens_per_second=None):
+    """同時に会話するセッション数ごとに、スループットとターンのレイテンシを計測する
+
+    AsyncChatSessionManagerで1つのイベントループ上に全セッションを載せる。
+    """
+    fake = _install_fake(latency, tokens_per_second)
+    results = []
+    for level in levels:
+        latencies = []
+
+        async def run_session(manager, session_id):
+            for i in range(turns):
+                start = time.perf_counter()
+                await manager.achat(session_id, f"質問 {i}")
+                latencies.append(time.perf_counter() - start)
+
+        async def run_all():
+            # セマフォをイベントループ内で作るため、マネージャもここで作る
+            manager = AsyncChatSessionManager(max_concurrency=max(levels), max_sessions=level)
+            session_ids = [manager.create_session() for _ in range(level)]
+            for session_id in session_ids:
+                _prefill(manager.get_session(session_id), history)
+            await asyncio.gather(*(run_session(manager, session_id) for session_id in session_ids))
+
+        calls_before, simulated_before = sum(fake.calls.values()), fake.simulated_seconds
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+        calls = sum(fake.calls.values()) - calls_before
+        provider_ms = (fake.simulated_seconds - simulated_before) / calls * 1000 if calls else 0.0
+        results.append({
+            "sessions": level,
+            "turns": len(latencies),
+            "turns_per_sec": round(len(latencies) / elapsed, 1),
+            "latency_ms_p50": _percentile(latencies, 50),
+            "latency_ms_p95": _percentile(latencies, 95),
+            "latency_ms_p99": _percentile(latencies, 99),
+            "provider_ms_per_turn": round(provider_ms, 2),
+        })
+    return results
+
+
+def bench_sessions(sessions: int = 1000):
+    """セッション（MultiModelChatApp）1つあたりの作成時間とメモリを計測する"""
+    MultiModelChatApp()
+    tracemalloc.start()
+    start = time.perf_counter()
+    apps = [MultiModelChatApp() for _ in range(sessions)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "sessions": len(apps),
+        "create_us_per_session": round(elapsed / sessions * 1e6, 1),
+        "bytes_per_session": current // sessions,
+    }
+
+
+def _git_revision() -> str:
+    """計測したコードのリビジョン（取得できない場合は空文字）"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+BENCHMARKS = {
+    "turns": bench_turns,
+    "concurrency": bench_concurrency,
+    "sessions": bench_sessions,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MultiModelChatAppのベンチマーク")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", help="履歴の件数（turns）またはセッション数（concurrency）")
+    parser.add_argument("--turns", type=int, help="計測するターン数")
+    parser.add_argument("--sessions", type=int, help="作成するセッション数（sessions）")
+    parser.add_argument("--latency", type=float, help="偽のプロバイダの最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, help="偽のプロバイダの生成速度")
+    parser.add_argument("--output", help="結果を1行のJSONとして追記するファイル")
+    args = parser.parse_args()
+
+    params = {}
+    if args.sizes:
+        params["levels" if args.benchmark == "concurrency" else "sizes"] = tuple(args.sizes)
+    for name in ("turns", "sessions", "latency", "tokens_per_second"):
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    # 選んだベンチマークが受け付けないフラグは無視する（警告を表示する）
+    accepted = inspect.signature(BENCHMARKS[args.benchmark]).parameters
+    ignored = [name for name in params if name not in accepted]
+    if ignored:
+        print(f"{args.benchmark} では使わないため無視します: {', '.join(ignored)}", file=sys.stderr)
+    params = {name: value for name, value in params.items() if name in accepted}
+
+    record = {
+        "sample": "sample2",
+        "benchmark": args.benchmark,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": BENCHMARKS[args.benchmark](**params),
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
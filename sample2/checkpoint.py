@@ -0,0 +1,236 @@
+"""
+スレッドID（セッションID）ごとのチャットステートの保存先（チェックポインタ）
+
+MultiModelChatAppのステートの差分（{"messages": [追加するメッセージ]} や {"current_model": ...}）を
+そのまま受け取り、メッセージは追記、それ以外のキーは上書きで保存する。
+1ターンの保存にかかる時間は追加したメッセージ数にのみ比例し、履歴の長さによらない。
+スレッドはput_infoで登録し、putは登録済みのスレッドにのみ保存する（削除したスレッドが、
+実行中だったターンの保存で復活しないようにするため）。
+LangGraphのチェックポインタ（BaseCheckpointSaver）ではなく、MultiModelChatApp専用の保存先である。
+スレッドごとに、ステートのほかセッション一覧に表示する情報（所有者・名前・作成日時・更新日時）も保存する。
+
+- MemoryCheckpointer: プロセス内のメモリに保持する
+- SQLiteCheckpointer: SQLite（WALモード）にメッセージを1件1行で追記する
+"""
+
+from typing import Any, Dict, List, Optional
+import sqlite3
+import threading
+import time
+
+from llm_common.message_record import MessageRecord
+
+# メッセージ以外に保存するステートのキー
+STATE_KEYS = ("current_model", "system_message")
+
+# スレッドの情報として保存するキー（updated_atはステートを保存するたびに更新する）
+INFO_KEYS = ("owner", "name", "created_at")
+
+
+def _info(thread_id: str, values: Dict[str, Any]) -> Dict[str, Any]:
+    """セッション一覧に表示する情報（session_manager.SessionInfoの形式）"""
+    return {"session_id": thread_id, "name": values.get("name") or "", "owner": values.get("owner") or "",
+            "created_at": values.get("created_at") or values["updated_at"], "updated_at": values["updated_at"]}
+
+
+class MemoryCheckpointer:
+    """スレッドごとのステートをメモリに保持するチェックポインタ（スレッドセーフ）"""
+
+    def __init__(self):
+        self._threads: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _thread(self, thread_id: str) -> Dict[str, Any]:
+        saved = self._threads.get(thread_id)
+        if saved is None:
+            saved = self._threads[thread_id] = {"messages": [], "info": {}, "updated_at": time.time()}
+        return saved
+
+    def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """保存されたステートを返す（なければNone）"""
+        with self._lock:
+            saved = self._threads.get(thread_id)
+            if saved is None:
+                return None
+            state = {key: saved[key] for key in STATE_KEYS if key in saved}
+            return {**state, "messages": list(saved["messages"])}
+
+    def put(self, thread_id: str, update: Dict[str, Any]):
+        """ステートの差分を保存する（put_infoで登録していない・削除済みのスレッドには保存しない）"""
+        with self._lock:
+            saved = self._threads.get(thread_id)
+            if saved is None:
+                return
+            saved["updated_at"] = time.time()
+            for key, value in update.items():
+                if key == "messages":
+                    saved["messages"].extend(value)
+                elif key in STATE_KEYS:
+                    saved[key] = value
+
+    def put_info(self, thread_id: str, **values):
+        """スレッドの情報（owner・name・created_at）を保存する（指定したキーだけを上書きする）"""
+        with self._lock:
+            saved = self._thread(thread_id)
+            saved["info"].update((key, value) for key, value in values.items() if key in INFO_KEYS)
+
+    def load_info(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """スレッドの情報を返す（なければNone）"""
+        with self._lock:
+            saved = self._threads.get(thread_id)
+            return None if saved is None else _info(thread_id, {**saved["info"], "updated_at": saved["updated_at"]})
+
+    def list_info(self, owner: str) -> List[Dict[str, Any]]:
+        """所有者のスレッドの情報を更新日時の新しい順に返す"""
+        with self._lock:
+            infos = [_info(thread_id, {**saved["info"], "updated_at": saved["updated_at"]})
+                     for thread_id, saved in self._threads.items() if saved["info"].get("owner", "") == owner]
+        return sorted(infos, key=lambda info: info["updated_at"], reverse=True)
+
+    def delete(self, thread_id: str):
+        """スレッドのステートを削除する"""
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def list_threads(self) -> List[str]:
+        """保存されているスレッドIDの一覧"""
+        with self._lock:
+            return list(self._threads)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    current_model TEXT,
+    system_message TEXT,
+    owner TEXT,
+    name TEXT,
+    created_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS thread_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_thread_messages_thread ON thread_messages (thread_id, id);
+"""
+
+# 以前のスキーマで作成したデータベースに追加する列 (テーブル, 列, 定義)
+MIGRATIONS = [
+    ("threads", "owner", "TEXT"),
+    ("threads", "name", "TEXT"),
+    ("threads", "created_at", "REAL"),
+]
+
+# 追加した列を使うインデックス（列を追加してから作成する）
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_threads_owner ON threads (owner, updated_at);
+"""
+
+
+class SQLiteCheckpointer:
+    """スレッドごとのステートをSQLiteに保存するチェックポインタ
+
+    接続はスレッドごとに作成し、複数のセッション（スレッド）やプロセスからの
+    同時アクセスはWALとbusy_timeoutで捌く。
+    """
+
+    def __init__(self, path: str = "chat_checkpoints.db"):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            for table, column, definition in MIGRATIONS:
+                if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            conn.executescript(INDEXES)
+
+    def _connect(self) -> sqlite3.Connection:
+        """現在のスレッド用の接続を取得する"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """保存されたステートを返す（なければNone）"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT current_model, system_message FROM threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        messages = [
+            MessageRecord(role, content, model, created_at)
+            for role, content, model, created_at in conn.execute(
+                "SELECT role, content, model, created_at FROM thread_messages WHERE thread_id = ? ORDER BY id",
+                (thread_id,),
+            )
+        ]
+        state = {"messages": messages}
+        for key, value in zip(STATE_KEYS, row):
+            if value is not None:
+                state[key] = value
+        return state
+
+    def put(self, thread_id: str, update: Dict[str, Any]):
+        """ステートの差分を1トランザクションで保存する（put_infoで登録していない・削除済みのスレッドには保存しない）"""
+        values = {key: update[key] for key in STATE_KEYS if key in update}
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE threads SET updated_at = ? WHERE thread_id = ?", (time.time(), thread_id))
+            if cursor.rowcount == 0:
+                return
+            for key, value in values.items():
+                conn.execute(f"UPDATE threads SET {key} = ? WHERE thread_id = ?", (value, thread_id))
+            conn.executemany(
+                "INSERT INTO thread_messages (thread_id, role, content, model, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(thread_id, m["role"], m["content"], m.get("model"), m.get("created_at", time.time()))
+                 for m in update.get("messages", [])],
+            )
+
+    def put_info(self, thread_id: str, **values):
+        """スレッドの情報（owner・name・created_at）を保存する（指定したキーだけを上書きする）"""
+        values = {key: value for key, value in values.items() if key in INFO_KEYS}
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO threads (thread_id, updated_at) VALUES (?, ?) ON CONFLICT(thread_id) DO NOTHING",
+                (thread_id, time.time()),
+            )
+            for key, value in values.items():
+                conn.execute(f"UPDATE threads SET {key} = ? WHERE thread_id = ?", (value, thread_id))
+
+    def load_info(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """スレッドの情報を返す（なければNone）"""
+        row = self._connect().execute(
+            "SELECT owner, name, created_at, updated_at FROM threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return _info(thread_id, dict(zip((*INFO_KEYS, "updated_at"), row)))
+
+    def list_info(self, owner: str) -> List[Dict[str, Any]]:
+        """所有者のスレッドの情報を更新日時の新しい順に返す"""
+        rows = self._connect().execute(
+            "SELECT thread_id, owner, name, created_at, updated_at FROM threads "
+            "WHERE owner = ? ORDER BY updated_at DESC",
+            (owner,),
+        )
+        return [_info(row[0], dict(zip((*INFO_KEYS, "updated_at"), row[1:]))) for row in rows]
+
+    def delete(self, thread_id: str):
+        """スレッドのステートを削除する"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM thread_messages WHERE thread_id = ?", (thread_id,))
+            conn.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+
+    def list_threads(self) -> List[str]:
+        """保存されているスレッドIDの一覧（更新日時の新しい順）"""
+        return [row[0] for row in self._connect().execute("SELECT thread_id FROM threads ORDER BY updated_at DESC")]
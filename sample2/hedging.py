@@ -0,0 +1,354 @@
+"""
+ヘッジリクエスト（2つのモデルに問い合わせて先に返った方を採用する）
+
+主モデルに問い合わせ、主モデルの過去のレイテンシの指定パーセンタイルを過ぎても
+応答がなければ副モデルにも問い合わせる。先に応答した方を採用し、もう一方は打ち切る。
+
+- 通常の問い合わせ（invoke / ainvoke）は、先に最後まで応答した方を採用する
+- ストリーミング（stream / astream）は、先に最初のチャンクを返した方を採用する
+  （表示を始めた後に応答を差し替えないため）
+- 同期版はスレッドでストリーミングを受信し、打ち切る側はチャンクの区切りで受信を止める。
+  非同期版は打ち切る側のタスクをキャンセルする
+- 送信するメッセージは問い合わせを始める前に呼び出し元で作成しておき、各レッグからは
+  セッションの状態（メッセージのキャッシュやコンテキストウィンドウ）に触れない
+"""
+
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import queue
+import threading
+import time
+
+from llm_common.resilience import AllModelsFailedError, Candidate, ResilientCaller
+
+PRIMARY = "primary"
+SECONDARY = "secondary"
+
+
+class LatencyTracker:
+    """キーごとに直近のレイテンシを保持し、パーセンタイルを求めるクラス"""
+
+    def __init__(self, window: int = 256):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        """レイテンシを記録する"""
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def count(self, key: str) -> int:
+        """記録済みのサンプル数"""
+        with self._lock:
+            return len(self._samples.get(key, ()))
+
+    def percentile(self, key: str, p: float) -> Optional[float]:
+        """pパーセンタイルのレイテンシ（サンプルがなければNone）"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def expected_beyond(self, key: str, elapsed: float) -> Optional[float]:
+        """elapsed秒を過ぎても応答がなかった場合の、レイテンシの中央値の見込み（該当するサンプルがなければNone）"""
+        with self._lock:
+            samples = sorted(s for s in self._samples.get(key, ()) if s > elapsed)
+        return samples[len(samples) // 2] if samples else None
+
+
+# プロセス全体で共有するレイテンシの記録（モデルのレイテンシはセッションによらない）
+latency_tracker = LatencyTracker()
+
+
+class HedgePolicy:
+    """ヘッジの設定"""
+
+    def __init__(self, secondary: str, percentile: float = 95.0, min_samples: int = 20,
+                 default_delay: float = 2.0, min_delay: float = 0.05, max_delay: float = 30.0):
+        """secondary: 副モデル、percentile: 副モデルに問い合わせるまでの待ち時間に使う主モデルのパーセンタイル
+
+        サンプルがmin_samples件に満たない間はdefault_delay秒待つ。
+        """
+        self.secondary = secondary
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+
+class Hedger:
+    """ヘッジリクエストを実行し、発動回数と短縮できたレイテンシを集計するクラス"""
+
+    def __init__(self, caller: ResilientCaller, tracker: Optional[LatencyTracker] = None):
+        """caller: 各モデルへの問い合わせ（再試行・サーキットブレーカー）に使うクラス"""
+        self.caller = caller
+        self.tracker = tracker or latency_tracker
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.fired = 0
+        self.secondary_wins = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def _key(primary: List[Candidate], complete: bool) -> str:
+        return f"{primary[0].model_type}:{'total' if complete else 'first_chunk'}"
+
+    def delay_for(self, policy: HedgePolicy, key: str) -> float:
+        """副モデルに問い合わせるまでの待ち時間"""
+        if self.tracker.count(key) < policy.min_samples:
+            return policy.default_delay
+        delay = self.tracker.percentile(key, policy.percentile)
+        return min(policy.max_delay, max(policy.min_delay, delay))
+
+    @staticmethod
+    def _prepared(candidates: List[Candidate]) -> List[Candidate]:
+        """候補のLLMクライアントと送信するメッセージを、呼び出し元でまとめて作成しておく
+
+        2つのレッグ（同期版では別々のスレッド）から同時にprepareを呼び出すと、セッションの
+        メッセージのキャッシュやコンテキストウィンドウを同時に更新してしまうため、分岐する前に作成する。
+        作成に失敗した候補は、そのレッグで試す時点で同じ例外を送出する。
+        """
+        prepared = []
+        for candidate in candidates:
+            try:
+                llm, messages = candidate.prepare()
+                tokens = candidate.prompt_tokens() if candidate.prompt_tokens else None
+            except Exception as e:
+                def fail(error=e):
+                    raise error
+                prepared.append(candidate._replace(prepare=fail))
+                continue
+            prepared.append(candidate._replace(
+                prepare=lambda llm=llm, messages=messages: (llm, messages),
+                prompt_tokens=None if tokens is None else lambda tokens=tokens: tokens,
+            ))
+        return prepared
+
+    def _record(self, key: str, winner: str, fired: bool, primary_pending: bool, elapsed: float):
+        """結果を集計する
+
+        主モデルが応答した場合はそのレイテンシを記録する。副モデルが先に応答した場合、
+        主モデルのレイテンシは分からないため、elapsed秒を超えた過去のサンプルの中央値との差を
+        短縮できた時間の見込みとする。このとき主モデルのレイテンシはelapsed秒以上だったので、
+        elapsedを下限として記録する（主モデルが勝った場合だけを記録すると、遅い応答が記録から
+        抜け落ちて待ち時間のパーセンタイルが下がり続け、ヘッジが次第に発動しやすくなるため）。
+        """
+        saved = 0.0
+        if winner == PRIMARY:
+            self.tracker.record(key, elapsed)
+        elif primary_pending:
+            expected = self.tracker.expected_beyond(key, elapsed)
+            saved = max(0.0, expected - elapsed) if expected is not None else 0.0
+            self.tracker.record(key, elapsed)
+        with self._lock:
+            self.requests += 1
+            self.fired += fired
+            self.secondary_wins += winner == SECONDARY
+            self.saved_seconds += saved
+
+    @staticmethod
+    def _merge_error(errors: List, name: str, error: BaseException):
+        if isinstance(error, AllModelsFailedError):
+            errors.extend(error.errors)
+        else:
+            errors.append((name, error))
+
+    # --- 同期版 ---
+
+    def _run_leg(self, name: str, candidates: List[Candidate], session_id: str, events: queue.Queue,
+                 cancel: threading.Event):
+        """一方のモデルの応答を受信してeventsに送る（cancelが立てばチャンクの区切りで受信をやめる）"""
+        stream = self.caller.stream(candidates, session_id)
+        try:
+            for model, chunk in stream:
+                if cancel.is_set():
+                    return
+                events.put((name, "chunk", model, chunk))
+            events.put((name, "done", None, None))
+        except Exception as e:
+            events.put((name, "error", None, e))
+        finally:
+            stream.close()
+
+    def _race(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+              complete: bool, session_id: str) -> Iterator[Tuple[str, Any]]:
+        """主モデルと（遅れた場合は）副モデルに問い合わせ、採用した方の (モデル, チャンク) を返す"""
+        key = self._key(primary, complete)
+        primary, secondary = self._prepared(primary), self._prepared(secondary)
+        events: queue.Queue = queue.Queue()
+        cancels: Dict[str, threading.Event] = {}
+
+        def start(name, candidates):
+            cancels[name] = threading.Event()
+            threading.Thread(target=self._run_leg, args=(name, candidates, session_id, events, cancels[name]),
+                             name=f"hedge-{name}", daemon=True).start()
+
+        started = time.perf_counter()
+        deadline = started + self.delay_for(policy, key)
+        start(PRIMARY, primary)
+        buffers: Dict[str, List] = {PRIMARY: [], SECONDARY: []}
+        errors: List = []
+        failed = set()
+        winner = None
+        done = False
+        try:
+            while winner is None:
+                timeout = None if SECONDARY in cancels else max(0.0, deadline - time.perf_counter())
+                try:
+                    name, kind, model, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    start(SECONDARY, secondary)
+                    continue
+                if kind == "error":
+                    # 採用前に失敗した側の受信済みの内容は捨てる
+                    self._merge_error(errors, name, payload)
+                    failed.add(name)
+                    if SECONDARY not in cancels:
+                        start(SECONDARY, secondary)
+                    elif failed == set(cancels):
+                        raise AllModelsFailedError(errors)
+                    continue
+                if kind == "chunk":
+                    buffers[name].append((model, payload))
+                done = kind == "done"
+                if done or not complete:
+                    winner = name
+
+            loser = SECONDARY if winner == PRIMARY else PRIMARY
+            if loser in cancels:
+                cancels[loser].set()
+            self._record(key, winner, SECONDARY in cancels, PRIMARY not in failed, time.perf_counter() - started)
+
+            yield from buffers[winner]
+            while not done:
+                name, kind, model, payload = events.get()
+                if name != winner:
+                    continue
+                if kind == "error":
+                    raise payload
+                if kind == "done":
+                    done = True
+                else:
+                    yield model, payload
+        finally:
+            for cancel in cancels.values():
+                cancel.set()
+
+    def invoke(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+               session_id: str = "default") -> Tuple[str, List[Any]]:
+        """先に最後まで応答した方の (モデル, チャンクのリスト) を返す"""
+        chunks = list(self._race(policy, primary, secondary, True, session_id))
+        return chunks[0][0] if chunks else primary[0].model_type, [chunk for _, chunk in chunks]
+
+    def stream(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+               session_id: str = "default") -> Iterator[Tuple[str, Any]]:
+        """先に最初のチャンクを返した方の (モデル, チャンク) を順に返す"""
+        return self._race(policy, primary, secondary, False, session_id)
+
+    # --- 非同期版 ---
+
+    async def _arun_leg(self, name: str, candidates: List[Candidate], session_id: str, events: asyncio.Queue):
+        """_run_legの非同期版（打ち切りはタスクのキャンセルで行う）"""
+        try:
+            async for model, chunk in self.caller.astream(candidates, session_id):
+                events.put_nowait((name, "chunk", model, chunk))
+            events.put_nowait((name, "done", None, None))
+        except Exception as e:
+            events.put_nowait((name, "error", None, e))
+
+    async def _arace(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+                     complete: bool, session_id: str) -> AsyncIterator[Tuple[str, Any]]:
+        """_raceの非同期版"""
+        key = self._key(primary, complete)
+        primary, secondary = self._prepared(primary), self._prepared(secondary)
+        events: asyncio.Queue = asyncio.Queue()
+        tasks: Dict[str, asyncio.Task] = {}
+
+        def start(name, candidates):
+            tasks[name] = asyncio.ensure_future(self._arun_leg(name, candidates, session_id, events))
+
+        started = time.perf_counter()
+        deadline = started + self.delay_for(policy, key)
+        start(PRIMARY, primary)
+        buffers: Dict[str, List] = {PRIMARY: [], SECONDARY: []}
+        errors: List = []
+        failed = set()
+        winner = None
+        done = False
+        try:
+            while winner is None:
+                try:
+                    if SECONDARY in tasks:
+                        name, kind, model, payload = await events.get()
+                    else:
+                        name, kind, model, payload = await asyncio.wait_for(
+                            events.get(), max(0.0, deadline - time.perf_counter())
+                        )
+                except asyncio.TimeoutError:
+                    start(SECONDARY, secondary)
+                    continue
+                if kind == "error":
+                    # 採用前に失敗した側の受信済みの内容は捨てる
+                    self._merge_error(errors, name, payload)
+                    failed.add(name)
+                    if SECONDARY not in tasks:
+                        start(SECONDARY, secondary)
+                    elif failed == set(tasks):
+                        raise AllModelsFailedError(errors)
+                    continue
+                if kind == "chunk":
+                    buffers[name].append((model, payload))
+                done = kind == "done"
+                if done or not complete:
+                    winner = name
+
+            loser = SECONDARY if winner == PRIMARY else PRIMARY
+            if loser in tasks:
+                tasks[loser].cancel()
+            self._record(key, winner, SECONDARY in tasks, PRIMARY not in failed, time.perf_counter() - started)
+
+            for item in buffers[winner]:
+                yield item
+            while not done:
+                name, kind, model, payload = await events.get()
+                if name != winner:
+                    continue
+                if kind == "error":
+                    raise payload
+                if kind == "done":
+                    done = True
+                else:
+                    yield model, payload
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    async def ainvoke(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+                      session_id: str = "default") -> Tuple[str, List[Any]]:
+        """invokeの非同期版"""
+        chunks = [item async for item in self._arace(policy, primary, secondary, True, session_id)]
+        return chunks[0][0] if chunks else primary[0].model_type, [chunk for _, chunk in chunks]
+
+    def astream(self, policy: HedgePolicy, primary: List[Candidate], secondary: List[Candidate],
+                session_id: str = "default") -> AsyncIterator[Tuple[str, Any]]:
+        """streamの非同期版"""
+        return self._arace(policy, primary, secondary, False, session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        """問い合わせ数・ヘッジの発動回数と割合・副モデルが採用された回数・短縮できた時間の見込みを返す"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "fired": self.fired,
+                "fire_rate": round(self.fired / self.requests, 3) if self.requests else 0.0,
+                "secondary_wins": self.secondary_wins,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "saved_ms_per_hedge": round(self.saved_seconds / self.fired * 1000, 1) if self.fired else 0.0,
+            }
@@ -0,0 +1,132 @@
+"""
+HTTP API（api.py）の負荷試験
+
+同時に会話するユーザー数を段階的に増やし、各ユーザーがセッションを作成して
+turns回ずつ応答を受け取ったときのスループットとレイテンシ（p50/p95/p99）を計測する。
+既定ではAPIを同じプロセスで動かし（httpx.ASGITransport）、LLMは偽のプロバイダ（llm_common/fake_llm.py）で
+応答する。--urlを指定すると起動済みのサーバーに対して計測する（サーバー側は
+FAKE_LLM_LATENCYを指定して起動すると、プロバイダを呼び出さずに計測できる）。
+
+使い方:
+    python loadtest.py --levels 1 8 64 256 --turns 5
+    python loadtest.py --mode stream --latency 0.1 --tokens-per-second 50
+    FAKE_LLM_LATENCY=0.05 uvicorn api:app --port 8000 &
+    python loadtest.py --url http://127.0.0.1:8000 --output loadtest_results.jsonl
+"""
+
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import platform
+import time
+from datetime import datetime
+
+import httpx
+
+from api import create_app
+from bench import _git_revision, _install_fake, _percentile
+from session_manager import AsyncChatSessionManager
+
+
+async def _turn(client: httpx.AsyncClient, user: str, session_id: str, message: str, mode: str) -> Dict[str, Any]:
+    """1ターン分のリクエストを送り、ステータスと所要時間（streamでは最初のチャンクまでの時間も）を返す"""
+    headers = {"X-User-Id": user}
+    body = {"message": message, "session_id": session_id}
+    start = time.perf_counter()
+    if mode == "chat":
+        response = await client.post("/chat", json=body, headers=headers)
+        return {"status": response.status_code, "seconds": time.perf_counter() - start, "ttfb": None}
+    ttfb = None
+    async with client.stream("POST", "/chat/stream", json=body, headers=headers) as response:
+        async for line in response.aiter_lines():
+            if ttfb is None and line.startswith("data:"):
+                ttfb = time.perf_counter() - start
+            if line.startswith("event: error"):
+                return {"status": 599, "seconds": time.perf_counter() - start, "ttfb": ttfb}
+        return {"status": response.status_code, "seconds": time.perf_counter() - start, "ttfb": ttfb}
+
+
+async def _run_level(client: httpx.AsyncClient, level: int, turns: int, mode: str) -> Dict[str, Any]:
+    """level人のユーザーが同時にturns回ずつ会話する"""
+    results: List[Dict[str, Any]] = []
+
+    async def run_user(index: int):
+        user = f"loadtest-{level}-{index}"
+        response = await client.post("/sessions", json={}, headers={"X-User-Id": user})
+        response.raise_for_status()
+        session_id = response.json()["session_id"]
+        for i in range(turns):
+            results.append(await _turn(client, user, session_id, f"質問 {i}", mode))
+        await client.delete(f"/sessions/{session_id}", headers={"X-User-Id": user})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(index) for index in range(level)))
+    elapsed = time.perf_counter() - start
+
+    ok = [result for result in results if result["status"] == 200]
+    latencies = [result["seconds"] for result in ok]
+    row = {
+        "users": level,
+        "turns": len(results),
+        "ok": len(ok),
+        "rejected": sum(1 for result in results if result["status"] in (429, 503)),
+        "errors": sum(1 for result in results if result["status"] not in (200, 429, 503)),
+        "turns_per_sec": round(len(ok) / elapsed, 1),
+        "latency_ms_p50": _percentile(latencies, 50),
+        "latency_ms_p95": _percentile(latencies, 95),
+        "latency_ms_p99": _percentile(latencies, 99),
+    }
+    if mode == "stream":
+        ttfbs = [result["ttfb"] for result in ok if result["ttfb"] is not None]
+        row["ttfb_ms_p50"] = _percentile(ttfbs, 50)
+        row["ttfb_ms_p95"] = _percentile(ttfbs, 95)
+    return row
+
+
+async def run(levels=(1, 8, 64, 256), turns: int = 5, mode: str = "chat", url: Optional[str] = None,
+              latency: float = 0.05, tokens_per_second=None, max_pending: Optional[int] = None) -> List[Dict[str, Any]]:
+    """同時ユーザー数ごとに計測する（urlを省略するとAPIを同じプロセスで動かす）"""
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    if url:
+        client = httpx.AsyncClient(base_url=url, limits=limits, timeout=120.0)
+    else:
+        _install_fake(latency, tokens_per_second)
+        manager = AsyncChatSessionManager(max_concurrency=max(levels), max_pending=max_pending)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(manager)),
+                                   base_url="http://loadtest", timeout=120.0)
+    async with client:
+        return [await _run_level(client, level, turns, mode) for level in levels]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP APIの負荷試験")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 8, 64, 256], help="同時に会話するユーザー数")
+    parser.add_argument("--turns", type=int, default=5, help="ユーザーごとのターン数")
+    parser.add_argument("--mode", choices=["chat", "stream"], default="chat")
+    parser.add_argument("--url", help="起動済みのサーバーのURL（省略するとAPIを同じプロセスで動かす）")
+    parser.add_argument("--latency", type=float, default=0.05, help="偽のプロバイダの最初の応答までの秒数")
+    parser.add_argument("--tokens-per-second", type=float, help="偽のプロバイダの生成速度")
+    parser.add_argument("--max-pending", type=int, help="実行中と待機中のターンの上限（超えた分は503）")
+    parser.add_argument("--output", help="結果を1行のJSONとして追記するファイル")
+    args = parser.parse_args()
+
+    params = {"levels": args.levels, "turns": args.turns, "mode": args.mode}
+    if args.url:
+        params["url"] = args.url
+    else:
+        params.update(latency=args.latency, tokens_per_second=args.tokens_per_second, max_pending=args.max_pending)
+
+    record = {
+        "sample": "sample2",
+        "benchmark": "loadtest",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": asyncio.run(run(**params)),
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
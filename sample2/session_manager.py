@@ -0,0 +1,232 @@
+"""
+多数のチャットセッションを1つのイベントループで並行処理する非同期セッションマネージャ
+"""
+
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple, TypedDict
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from backend import MultiModelChatApp
+from checkpoint import MemoryCheckpointer
+
+# メモリに保持するセッション（MultiModelChatApp）数の既定の上限
+DEFAULT_MAX_SESSIONS = 1024
+
+
+class OverloadedError(Exception):
+    """処理待ちのターンが上限に達したため受け付けなかったことを表す例外"""
+
+    def __init__(self, pending: int):
+        super().__init__(f"処理待ちのターンが上限（{pending}件）に達しています")
+        self.pending = pending
+
+
+class SessionBusyError(Exception):
+    """同じセッションで処理待ちのターンが上限に達したため受け付けなかったことを表す例外"""
+
+    def __init__(self, session_id: str):
+        super().__init__(f"セッション {session_id} は前のターンを処理中です")
+        self.session_id = session_id
+
+
+class SessionInfo(TypedDict):
+    """セッション一覧に表示する情報"""
+    session_id: str
+    name: str
+    owner: str
+    created_at: float
+    updated_at: float
+
+
+class AsyncChatSessionManager:
+    """セッションIDごとにMultiModelChatAppを保持し、非同期に応答を生成するクラス
+
+    同じセッション内のターンはロックで直列化し、異なるセッションは
+    スレッドを使わずに同一イベントループ上で並行に処理する。
+    セッションは所有者（ユーザー）ごとに一覧・切り替えができる。
+
+    会話と所有者・名前はチェックポインタに保存し、メモリに保持するMultiModelChatAppは
+    最近使ったmax_sessions個までとする（それ以外は処理中のターンがなければ破棄し、
+    次に使う時点でチェックポインタから読み戻す）。SQLiteCheckpointerを使えば、
+    プロセスを再起動しても同じセッションIDで会話を続けられる。
+    """
+
+    def __init__(self, max_concurrency: int = 256, checkpointer=None,
+                 max_pending: Optional[int] = None, max_session_pending: Optional[int] = None,
+                 app_options: Optional[Dict[str, Any]] = None, max_sessions: int = DEFAULT_MAX_SESSIONS):
+        """マネージャの初期化（max_concurrencyは同時に実行するプロバイダ呼び出しの上限）
+
+        checkpointerには、各セッションのステートと情報をセッションIDをスレッドIDとして保存する先を
+        指定する（省略するとMemoryCheckpointer。会話はプロセス内のメモリにのみ残る）。
+        max_pending（全体）・max_session_pending（セッションごと）を指定すると、実行中と待機中の
+        ターンの合計がその数に達した時点で、待たせずにOverloadedError・SessionBusyErrorで断る。
+        app_optionsはセッションごとのMultiModelChatAppに渡す引数（response_cache・fallback_modelsなど）。
+        max_sessionsはメモリに保持するMultiModelChatAppの数の上限。
+        """
+        # メモリに保持しているセッション（最近使った順）
+        self.sessions: "OrderedDict[str, MultiModelChatApp]" = OrderedDict()
+        self.max_sessions = max_sessions
+        self.checkpointer = checkpointer if checkpointer is not None else MemoryCheckpointer()
+        self.app_options = app_options or {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+        self.max_session_pending = max_session_pending
+        self._pending = 0
+        self._session_pending: Dict[str, int] = {}
+        # 所有者ごとの現在のセッション（最近使った順に上限まで。ない場合は最後に更新されたセッション）
+        self.current: "OrderedDict[str, str]" = OrderedDict()
+        self.evicted = 0
+
+    def create_session(self, session_id: Optional[str] = None, name: Optional[str] = None,
+                       owner: str = "") -> str:
+        """新しいセッションを作成し、所有者の現在のセッションにする
+
+        チェックポインタに保存済みのIDであれば、その会話から再開する（他の所有者のIDであればKeyError）。
+        """
+        session_id = session_id or str(uuid.uuid4())
+        info = self.checkpointer.load_info(session_id)
+        if info is not None and info["owner"] != owner:
+            raise KeyError(session_id)
+        if info is None or name:
+            now = time.time()
+            values = {"owner": owner,
+                      "name": name or f"セッション {time.strftime('%Y-%m-%d %H:%M', time.localtime(now))}"}
+            if info is None:
+                values["created_at"] = now
+            self.checkpointer.put_info(session_id, **values)
+        self.get_session(session_id)
+        self._set_current(owner, session_id)
+        return session_id
+
+    def get_session(self, session_id: str) -> MultiModelChatApp:
+        """セッションを取得する（メモリになければチェックポインタから読み戻す。存在しない場合はKeyError）"""
+        app = self.sessions.get(session_id)
+        if app is not None:
+            self.sessions.move_to_end(session_id)
+            return app
+        if self.checkpointer.load_info(session_id) is None:
+            raise KeyError(session_id)
+        app = MultiModelChatApp(session_id=session_id, checkpointer=self.checkpointer, **self.app_options)
+        self.sessions[session_id] = app
+        self._locks[session_id] = asyncio.Lock()
+        self._evict_idle()
+        return app
+
+    def _evict_idle(self):
+        """上限を超えた分だけ、使われていない順に処理中のターンがないセッションをメモリから破棄する"""
+        # 最後に使ったセッション（取得したばかりのもの）は残す
+        for session_id in list(self.sessions)[:-1]:
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if session_id in self._session_pending or self._locks[session_id].locked():
+                continue
+            del self.sessions[session_id]
+            del self._locks[session_id]
+            self.evicted += 1
+
+    def _set_current(self, owner: str, session_id: str):
+        self.current[owner] = session_id
+        self.current.move_to_end(owner)
+        while len(self.current) > self.max_sessions:
+            self.current.popitem(last=False)
+
+    def get_info(self, session_id: str) -> Optional[SessionInfo]:
+        """セッションの情報（存在しない場合はNone）"""
+        return self.checkpointer.load_info(session_id)
+
+    def owns(self, owner: str, session_id: str) -> bool:
+        """session_idのセッションがownerのものかどうか"""
+        info = self.get_info(session_id)
+        return info is not None and info["owner"] == owner
+
+    def list_sessions(self, owner: str = "") -> List[SessionInfo]:
+        """所有者のセッションを更新日時の新しい順に返す"""
+        return self.checkpointer.list_info(owner)
+
+    def current_session(self, owner: str = "") -> Optional[str]:
+        """所有者の現在のセッションID（なければ最後に更新されたセッション。1つもなければNone）"""
+        session_id = self.current.get(owner)
+        if session_id is None:
+            sessions = self.list_sessions(owner)
+            session_id = sessions[0]["session_id"] if sessions else None
+        return session_id
+
+    def switch_session(self, session_id: str, owner: str = "") -> bool:
+        """所有者の現在のセッションを切り替える"""
+        if not self.owns(owner, session_id):
+            return False
+        self._set_current(owner, session_id)
+        return True
+
+    def rename_session(self, session_id: str, name: str) -> bool:
+        """セッション名を変更する"""
+        if self.get_info(session_id) is None:
+            return False
+        self.checkpointer.put_info(session_id, name=name)
+        return True
+
+    def delete_session(self, session_id: str) -> bool:
+        """セッションを削除する（所有者の現在のセッションだった場合は、最後に更新された別のセッションに切り替える）
+
+        実行中・待機中のターンがあるセッションは、ターンの保存と競合しないようSessionBusyErrorで断る。
+        """
+        info = self.get_info(session_id)
+        if info is None:
+            return False
+        if session_id in self._session_pending:
+            raise SessionBusyError(session_id)
+        self.sessions.pop(session_id, None)
+        self._locks.pop(session_id, None)
+        self.checkpointer.delete(session_id)
+        if self.current.get(info["owner"]) == session_id:
+            del self.current[info["owner"]]
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """メモリに保持しているセッション数・破棄した回数と、実行中・待機中のターン数"""
+        return {"sessions": len(self.sessions), "evicted": self.evicted, "pending": self._pending}
+
+    @asynccontextmanager
+    async def _turn(self, session_id: str):
+        """ターンを受け付け、セッションのロックとプロバイダ呼び出しの枠を確保する
+
+        上限に達していれば待たせずに断る（呼び出し側は時間をおいて再試行する）。
+        """
+        session_pending = self._session_pending.get(session_id, 0)
+        if self.max_pending is not None and self._pending >= self.max_pending:
+            raise OverloadedError(self.max_pending)
+        if self.max_session_pending is not None and session_pending >= self.max_session_pending:
+            raise SessionBusyError(session_id)
+        self._pending += 1
+        self._session_pending[session_id] = session_pending + 1
+        try:
+            async with self._locks[session_id], self._semaphore:
+                yield
+        finally:
+            self._pending -= 1
+            remaining = self._session_pending.pop(session_id) - 1
+            if remaining:
+                self._session_pending[session_id] = remaining
+            else:
+                self._evict_idle()
+
+    async def achat(self, session_id: str, user_input: str) -> str:
+        """指定セッションで応答を生成する"""
+        app = self.get_session(session_id)
+        async with self._turn(session_id):
+            return await app.achat(user_input)
+
+    async def astream(self, session_id: str, user_input: str) -> AsyncIterator[str]:
+        """指定セッションで応答をチャンク単位で生成する"""
+        app = self.get_session(session_id)
+        async with self._turn(session_id):
+            async for text in app.astream(user_input):
+                yield text
+
+    async def achat_many(self, requests: Iterable[Tuple[str, str]]) -> List[str]:
+        """(セッションID, ユーザー入力) の組をまとめて並行に処理する"""
+        return await asyncio.gather(*(self.achat(session_id, user_input) for session_id, user_input in requests))